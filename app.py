@@ -1,8 +1,13 @@
 from flask import Flask
 from majavahbot.web.blueprint import blueprint
+from majavahbot.web.dashboard import dashboard_data
 
 app = Flask(__name__, template_folder='majavahbot/web/templates')
 app.register_blueprint(blueprint)
 
+# set up the schema, tasks and build info once instead of on every request, if the database
+# is not reachable yet, the first request tries again and shows an error page if that fails
+dashboard_data.try_init()
+
 if __name__ == '__main__':
     app.run()
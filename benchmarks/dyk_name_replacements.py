@@ -0,0 +1,56 @@
+'''
+Compares applying the ship template replacements one by one (the reference implementation in
+the task 6 tests) with the single-pass expand_ship_templates() on a real Recent additions
+archive month, and checks they give identical results.
+
+Usage: python -m benchmarks.dyk_name_replacements [year] [month] [--file path] [--rounds n]
+'''
+from majavahbot.api import get_mediawiki_api
+from majavahbot.tasks.task_6_dyk_entries import expand_ship_templates
+from tests.test_task_6_dyk_entries import apply_name_replacements
+import argparse
+import time
+
+
+def measure(function, rows: list, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for row in rows:
+            function(row)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('year', nargs='?', default='2019')
+    parser.add_argument('month', nargs='?', default='January')
+    parser.add_argument('--file', dest='file', default=None, help='Read the archive from a file')
+    parser.add_argument('--rounds', dest='rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.file is not None:
+        with open(args.file, encoding='utf-8') as file:
+            text = file.read()
+    else:
+        page_name = 'Wikipedia:Recent additions/%s/%s' % (args.year, args.month)
+        text = get_mediawiki_api('en', 'wikipedia').get_page(page_name).get()
+
+    rows = [row.lower() for row in text.split('\n')]
+
+    mismatches = [
+        row for row in rows if apply_name_replacements(row) != expand_ship_templates(row)
+    ]
+    if len(mismatches) > 0:
+        print('%s rows differ, for example: %s' % (len(mismatches), mismatches[0]))
+        exit(1)
+
+    sequential = measure(apply_name_replacements, rows, args.rounds)
+    single_pass = measure(expand_ship_templates, rows, args.rounds)
+
+    print('%s rows, %s rounds, results are identical' % (len(rows), args.rounds))
+    print('Replacements one by one:      %.3f s' % sequential)
+    print('expand_ship_templates:        %.3f s (%.1fx)' % (single_pass, sequential / single_pass))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,10 @@
 from majavahbot.api import task_database, get_mediawiki_api, ReplicaDatabase
-from majavahbot.api.consts import JOB_STATUS_FAIL, JOB_STATUS_DONE
-from majavahbot.tasks import task_registry
+from majavahbot.tasks import task_registry, run_job
+from majavahbot.tasks.supervisor import TaskSupervisor
 import argparse
 from sys import exit
 
-task_database.request()
 task_database.init()
-task_registry.add_all_tasks()
-task_database.close()
 
 
 def str2bool(v):
@@ -27,6 +24,7 @@ def cli_whoami():
 
 
 def cli_task_list():
+    task_registry.add_all_tasks()
     for task in task_registry.get_tasks():
         print("Task %i (%s) on wiki %s | Approved: %s | Trial: %s | Bot flag: %s | Supports manual run: %s"
               % (task.number, task.name, task.site, str(task.approved), str(task.trial),
@@ -63,16 +61,7 @@ def cli_task(number: int, run: bool, manual: bool, config: bool, job_name="cronj
         if task.is_continuous:
             task.run()
         else:
-            job_id = task_database.start_job(job_name, task.number, task.get_mediawiki_api().get_site().dbName())
-            try:
-                task.run()
-                task_database.stop_job(job_id, JOB_STATUS_DONE)
-            except Exception as e:
-                task_database.stop_job(job_id, JOB_STATUS_FAIL)
-                raise e
-            except KeyboardInterrupt as e:
-                task_database.stop_job(job_id, JOB_STATUS_FAIL)
-                raise e
+            run_job(task, job_name)
     elif manual:
         print("Manually running task", task.number)
         task.do_manual_run()
@@ -81,6 +70,15 @@ def cli_task(number: int, run: bool, manual: bool, config: bool, job_name="cronj
         exit(1)
 
 
+def cli_supervisor(scheduled: bool, interval: int, job_name: str, health_interval: int, health_file: str):
+    task_registry.add_all_tasks()
+    tasks = [task for task in task_registry.get_tasks() if task.is_continuous or scheduled]
+
+    print("Supervising tasks", ', '.join([str(task.number) for task in tasks]))
+    supervisor = TaskSupervisor(tasks, scheduled_interval=interval if scheduled else None, job_name=job_name)
+    supervisor.run(health_interval=health_interval, health_file=health_file)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(dest='subparser')
@@ -105,6 +103,22 @@ if __name__ == '__main__':
     task_parser.add_argument(
         '--param', dest='param', type=str, nargs='?', default="", help='Additional param passed to the job')
 
+    supervisor_parser = subparsers.add_parser('supervisor')
+    supervisor_parser.add_argument(
+        '--scheduled', dest='scheduled', type=str2bool, nargs='?', const=True, default=False,
+        help='Also run non-continuous tasks periodically')
+    supervisor_parser.add_argument(
+        '--interval', dest='interval', type=int, nargs='?', default=3600,
+        help='Seconds to wait between runs of non-continuous tasks')
+    supervisor_parser.add_argument(
+        '--job-name', dest='job_name', type=str, nargs='?', default="supervisor", help='Job name to record to database')
+    supervisor_parser.add_argument(
+        '--health-interval', dest='health_interval', type=int, nargs='?', default=60,
+        help='Seconds between task health reports')
+    supervisor_parser.add_argument(
+        '--health-file', dest='health_file', type=str, nargs='?', default=None,
+        help='File to write task health reports to as JSON')
+
     kwargs = vars(parser.parse_args())
     subparser = kwargs.pop('subparser')
 
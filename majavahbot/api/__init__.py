@@ -1,2 +1,8 @@
 from majavahbot.api.mediawiki import MediawikiApi, get_mediawiki_api
-from majavahbot.api.database import ReplicaDatabase, TaskDatabase, task_database
+from majavahbot.api.database import (
+    ReplicaDatabase,
+    TaskDatabase,
+    task_database,
+    get_connection_pool_metrics,
+)
+from majavahbot.api.throttle import throttle, get_throttle_metrics
@@ -1,6 +1,12 @@
+from os import path
+
 JOB_STATUS_RUNNING = 'running'
 JOB_STATUS_DONE = 'done'
 JOB_STATUS_FAIL = 'fail'
 
 MEDIAWIKI_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 HUMAN_DATE_FORMAT = '%d %b %Y %H:%M:%S'
+REPLICA_DATE_FORMAT = '%Y%m%d%H%M%S'
+
+# directory for data that is kept between runs but can be safely deleted
+CACHE_DIRECTORY = path.expanduser('~/.cache/majavahbot')
@@ -0,0 +1,159 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import traceback
+
+
+def close_stream(stream):
+    '''Closes a stream so that a thread blocked reading the next event from it wakes up'''
+    # EventStreams reads from an sseclient EventSource, which reads from a requests response
+    source = getattr(stream, 'source', None)
+    for resource in [getattr(source, 'resp', None), source, stream]:
+        close = getattr(resource, 'close', None)
+        if close is None:
+            continue
+        try:
+            close()
+        except Exception:
+            # for example a generator that is being iterated in another thread
+            pass
+
+
+class ContinuousRunner:
+    '''
+    Runs a blocking handler for events coming from a blocking iterator (usually EventStreams)
+    on an asyncio event loop.
+
+    Events are mapped to keys (for example page titles). Events for a key that is already waiting
+    to be processed are coalesced into that pending run, and events for a key that is currently
+    being processed schedule exactly one more run after the current one finishes. Handlers for
+    different keys run concurrently, up to max_concurrency at a time.
+    '''
+
+    def __init__(self, handler, coalesce_seconds=5, max_concurrency=2):
+        self.handler = handler
+        self.coalesce_seconds = coalesce_seconds
+        self.max_concurrency = max_concurrency
+
+        self.loop = None
+        self.semaphore = None
+        self.executor = None
+        self.stream = None
+        self.iterator = None
+        self.stopped = False
+
+        self.scheduled = set()
+        self.running = set()
+        self.dirty = set()
+        self.futures = set()
+
+        self.received_count = 0
+        self.coalesced_count = 0
+        self.processed_count = 0
+        self.failed_count = 0
+
+    def __repr__(self):
+        return 'ContinuousRunner{scheduled=%s,running=%s,processed=%s}' % (
+            len(self.scheduled),
+            len(self.running),
+            self.processed_count,
+        )
+
+    def get_metrics(self) -> dict:
+        return {
+            'received': self.received_count,
+            'coalesced': self.coalesced_count,
+            'processed': self.processed_count,
+            'failed': self.failed_count,
+            'scheduled': len(self.scheduled),
+            'running': len(self.running),
+        }
+
+    def stop(self):
+        '''
+        Stops reading new events; already scheduled runs are still finished. The stream is
+        closed, so this does not have to wait for the next event to arrive.
+        '''
+        self.stopped = True
+        for stream in [self.iterator, self.stream]:
+            if stream is not None:
+                close_stream(stream)
+
+    def submit(self, key):
+        '''Schedules a run for key. Must be called from the event loop thread.'''
+        self.received_count += 1
+
+        if key in self.running:
+            self.dirty.add(key)
+            self.coalesced_count += 1
+            return
+
+        if key in self.scheduled:
+            self.coalesced_count += 1
+            return
+
+        self._schedule(key)
+
+    def _schedule(self, key):
+        self.scheduled.add(key)
+        future = asyncio.ensure_future(self._process(key))
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+
+    async def _process(self, key):
+        # wait a bit so that bursts of events for the same key result in a single run
+        await asyncio.sleep(self.coalesce_seconds)
+
+        async with self.semaphore:
+            self.scheduled.discard(key)
+            self.running.add(key)
+            try:
+                await self.loop.run_in_executor(self.executor, self.handler, key)
+                self.processed_count += 1
+            except Exception:
+                self.failed_count += 1
+                traceback.print_exc()
+            finally:
+                self.running.discard(key)
+
+        if key in self.dirty:
+            self.dirty.discard(key)
+            self._schedule(key)
+
+    async def consume(self, stream, get_key, should_process=None):
+        self.stream = stream
+        self.iterator = iter(stream)
+
+        while not self.stopped:
+            try:
+                event = await self.loop.run_in_executor(self.executor, next, self.iterator, None)
+            except Exception:
+                # reading fails when stop() closes the stream under the reader
+                if self.stopped:
+                    break
+                raise
+            if event is None:
+                break
+            if should_process is not None and not should_process(event):
+                continue
+            self.submit(get_key(event))
+
+        while len(self.futures) > 0:
+            await asyncio.wait(list(self.futures))
+
+    def run(self, stream, get_key, should_process=None):
+        '''
+        Blocks until the stream runs dry or stop() is called, and every scheduled run has
+        finished. get_key(event) maps an event to the key passed to the handler, and
+        events for which should_process(event) returns False are ignored.
+        '''
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        # one extra thread for reading the stream
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency + 1)
+
+        try:
+            self.loop.run_until_complete(self.consume(stream, get_key, should_process))
+        finally:
+            self.loop.close()
+            self.executor.shutdown(wait=False)
@@ -1,5 +1,6 @@
 import mysql.connector
 from majavahbot.api.consts import JOB_STATUS_RUNNING
+from majavahbot.api.utils import TtlCache
 from majavahbot.config import (
     analytics_db_hostname,
     analytics_db_option_file,
@@ -8,25 +9,253 @@ from majavahbot.config import (
     own_db_option_file,
     own_db_database,
 )
+from collections import OrderedDict
 from datetime import datetime
+import json
+import threading
+import time
+
+# Connections are pooled per (host, database), so queries made outside of an explicit
+# request() reuse an already authenticated connection instead of doing a new handshake.
+POOL_MAX_SIZE = 5
+POOL_MAX_IDLE_SECONDS = 5 * 60
+POOL_CHECKOUT_TIMEOUT = 30
+# connections idle for longer than this are pinged before they are reused
+POOL_HEALTH_CHECK_IDLE_SECONDS = 30
+
+# maximum amount of keys in a single IN (...) list, and rows fetched from the server at once
+IN_QUERY_CHUNK_SIZE = 500
+IN_QUERY_FETCH_SIZE = 1000
+
+# maximum amount of rows written to the task_data table with a single statement
+TASK_DATA_CHUNK_SIZE = 100
+
+# how long a replication lag reading is reused, and how often it is polled while waiting for it
+REPLAG_CACHE_SECONDS = 10
+REPLAG_WAIT_INITIAL_DELAY = 15
+REPLAG_WAIT_MAX_DELAY = 5 * 60
+
+# db name => replication lag in seconds, shared by all replica connections
+replag_cache = TtlCache(REPLAG_CACHE_SECONDS)
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        host,
+        port,
+        option_files,
+        database,
+        max_size=POOL_MAX_SIZE,
+        max_idle_seconds=POOL_MAX_IDLE_SECONDS,
+        health_check_idle_seconds=POOL_HEALTH_CHECK_IDLE_SECONDS,
+    ):
+        self.host = host
+        self.port = port
+        self.option_files = option_files
+        self.database = database
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.health_check_idle_seconds = health_check_idle_seconds
+
+        self.lock = threading.Condition()
+        # (connection, time it was returned to the pool) tuples, most recently used last
+        self.idle = []
+        self.in_use = 0
+
+        self.created_count = 0
+        self.reused_count = 0
+        self.discarded_count = 0
+        self.checkout_wait_count = 0
+        self.health_check_count = 0
+
+    def __repr__(self):
+        return 'ConnectionPool{host=%s,database=%s,size=%s,in_use=%s}' % (
+            self.host,
+            self.database,
+            self.size(),
+            self.in_use,
+        )
+
+    def size(self) -> int:
+        return len(self.idle) + self.in_use
+
+    def _connect(self):
+        return mysql.connector.connect(
+            host=self.host, port=self.port, option_files=self.option_files, database=self.database
+        )
+
+    def _disconnect(self, connection):
+        # not holding the lock, disconnecting talks to the server
+        try:
+            connection.disconnect()
+        except mysql.connector.Error:
+            pass
+
+    def _release_slot(self, discarded=False):
+        with self.lock:
+            self.in_use -= 1
+            if discarded:
+                self.discarded_count += 1
+            self.lock.notify()
+
+    def _is_healthy(self, connection) -> bool:
+        # is_connected() pings the server, so this is never called while holding the lock
+        try:
+            return connection.is_connected()
+        except mysql.connector.Error:
+            return False
+
+    def evict_idle(self):
+        '''Disconnects connections that have been idle for longer than max_idle_seconds'''
+        with self.lock:
+            now = time.time()
+            evicted = [entry for entry in self.idle if now - entry[1] > self.max_idle_seconds]
+            if len(evicted) == 0:
+                return
+            self.idle = [entry for entry in self.idle if now - entry[1] <= self.max_idle_seconds]
+            self.discarded_count += len(evicted)
+            self.lock.notify_all()
+
+        for connection, returned_at in evicted:
+            self._disconnect(connection)
+
+    def checkout(self, timeout=POOL_CHECKOUT_TIMEOUT):
+        self.evict_idle()
+
+        while True:
+            with self.lock:
+                while len(self.idle) == 0 and self.size() >= self.max_size:
+                    self.checkout_wait_count += 1
+                    if not self.lock.wait(timeout):
+                        raise PoolExhaustedError(
+                            'Timed out waiting for a connection to %s/%s'
+                            % (self.host, self.database)
+                        )
+
+                # either take an idle connection or reserve a slot for a new one
+                self.in_use += 1
+                if len(self.idle) == 0:
+                    break
+                connection, returned_at = self.idle.pop()
+                if time.time() - returned_at <= self.health_check_idle_seconds:
+                    self.reused_count += 1
+                    return connection
+                self.health_check_count += 1
+
+            # the server may have closed a connection that has been idle for a while
+            if self._is_healthy(connection):
+                with self.lock:
+                    self.reused_count += 1
+                return connection
+            self._disconnect(connection)
+            self._release_slot(discarded=True)
+
+        try:
+            connection = self._connect()
+        except Exception:
+            self._release_slot()
+            raise
+
+        with self.lock:
+            self.created_count += 1
+        return connection
+
+    def checkin(self, connection, failed=False):
+        '''
+        Returns a connection to the pool. If a query on it failed, any open transaction is rolled
+        back, and the connection is discarded if that does not work.
+        '''
+        if failed:
+            try:
+                connection.rollback()
+            except Exception:
+                self._disconnect(connection)
+                self._release_slot(discarded=True)
+                return
+
+        with self.lock:
+            self.in_use -= 1
+            self.idle.append((connection, time.time()))
+            self.lock.notify()
+
+    def close_all(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+            self.discarded_count += len(idle)
+
+        for connection, returned_at in idle:
+            self._disconnect(connection)
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            return {
+                'host': self.host,
+                'database': self.database,
+                'max_size': self.max_size,
+                'size': self.size(),
+                'idle': len(self.idle),
+                'in_use': self.in_use,
+                'created': self.created_count,
+                'reused': self.reused_count,
+                'discarded': self.discarded_count,
+                'checkout_waits': self.checkout_wait_count,
+                'health_checks': self.health_check_count,
+            }
+
+
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(host, port, option_files, database) -> ConnectionPool:
+    key = (host, database)
+    with connection_pools_lock:
+        if key not in connection_pools:
+            connection_pools[key] = ConnectionPool(host, port, option_files, database)
+        return connection_pools[key]
+
+
+def get_connection_pool_metrics() -> list:
+    with connection_pools_lock:
+        pools = list(connection_pools.values())
+    return [pool.get_metrics() for pool in pools]
 
 
 class BaseDatabase:
     def __init__(self, host, port, option_files, database):
-        self.open = 0
-        self.database = mysql.connector.connect(
-            host=host, port=port, option_files=option_files, database=database
-        )
+        self.pool = get_connection_pool(host, port, option_files, database)
+        # every thread checks out its own connection from the pool
+        self.local = threading.local()
+
+    @property
+    def open(self) -> int:
+        return getattr(self.local, 'open', 0)
+
+    @property
+    def database(self):
+        return getattr(self.local, 'connection', None)
 
     def request(self):
         if self.open < 1:
-            self.database.connect()
-        self.open += 1
+            self.local.connection = self.pool.checkout()
+        self.local.open = self.open + 1
 
     def close(self):
-        self.open -= 1
+        self.local.open = self.open - 1
         if self.open < 1:
-            self.database.disconnect()
+            self.pool.checkin(self.local.connection, getattr(self.local, 'failed', False))
+            self.local.connection = None
+            self.local.failed = False
+
+    def _mark_failed(self):
+        '''Makes close() roll back the connection before it is reused'''
+        self.local.failed = True
 
     def commit(self):
         self.database.commit()
@@ -34,33 +263,48 @@ class BaseDatabase:
     def run(self, sql: str, values=(), get_id=False):
         last_row_id = None
         self.request()
-        cursor = self.database.cursor(buffered=True)
-        cursor.execute(sql, values)
-        if get_id:
-            last_row_id = cursor.lastrowid
-        cursor.close()
-        self.commit()
-        self.close()
+        try:
+            cursor = self.database.cursor(buffered=True)
+            cursor.execute(sql, values)
+            if get_id:
+                last_row_id = cursor.lastrowid
+            cursor.close()
+            self.commit()
+        except Exception:
+            self._mark_failed()
+            raise
+        finally:
+            self.close()
         return last_row_id
 
     def get_one(self, sql: str, values=()):
         self.request()
-        cursor = self.database.cursor(buffered=True)
-        cursor.execute(sql, values)
-        results = cursor.fetchone()
-        cursor.close()
-        self.commit()
-        self.close()
+        try:
+            cursor = self.database.cursor(buffered=True)
+            cursor.execute(sql, values)
+            results = cursor.fetchone()
+            cursor.close()
+            self.commit()
+        except Exception:
+            self._mark_failed()
+            raise
+        finally:
+            self.close()
         return results
 
     def get_all(self, sql: str, values=()):
         self.request()
-        cursor = self.database.cursor(buffered=True)
-        cursor.execute(sql, values)
-        results = cursor.fetchall()
-        cursor.close()
-        self.commit()
-        self.close()
+        try:
+            cursor = self.database.cursor(buffered=True)
+            cursor.execute(sql, values)
+            results = cursor.fetchall()
+            cursor.close()
+            self.commit()
+        except Exception:
+            self._mark_failed()
+            raise
+        finally:
+            self.close()
         return results
 
 
@@ -77,11 +321,96 @@ class ReplicaDatabase(BaseDatabase):
             database=db + '_p',
         )
 
-    def get_replag(self):
+    def get_all_in_chunks(self, sql: str, keys, chunk_size=IN_QUERY_CHUNK_SIZE):
+        '''
+        Runs a query containing a single "IN (%s)" for a large set of keys, splitting them into
+        chunks of at most chunk_size. Yields the resulting rows as they are fetched.
+
+        Every full chunk reuses the same prepared statement, only the last one needs another.
+        '''
+        keys = list(OrderedDict.fromkeys(keys))
+        if len(keys) == 0:
+            return
+
+        # placeholder count => (prepared cursor, statement)
+        statements = {}
+        # cursor with rows that have not been fetched yet
+        unread = None
+
+        self.request()
+        try:
+            for i in range(0, len(keys), chunk_size):
+                chunk = keys[i : i + chunk_size]
+
+                if len(chunk) not in statements:
+                    statements[len(chunk)] = (
+                        self.database.cursor(prepared=True),
+                        sql % ','.join(['%s'] * len(chunk)),
+                    )
+                cursor, statement = statements[len(chunk)]
+
+                cursor.execute(statement, tuple(chunk))
+                unread = cursor
+                while True:
+                    rows = cursor.fetchmany(IN_QUERY_FETCH_SIZE)
+                    if len(rows) == 0:
+                        break
+                    for row in rows:
+                        yield row
+                unread = None
+        except Exception:
+            self._mark_failed()
+            raise
+        finally:
+            # also runs when the caller stops iterating early, the connection can't be used
+            # for anything else before the remaining rows are read
+            try:
+                if unread is not None:
+                    unread.fetchall()
+                for cursor, statement in statements.values():
+                    cursor.close()
+                self.commit()
+            except Exception:
+                self._mark_failed()
+            self.close()
+
+    def _load_replag(self, db_name):
         query = 'SELECT lag FROM heartbeat_p.heartbeat JOIN meta_p.wiki ON shard = SUBSTRING_INDEX(slice, ".", 1) WHERE dbname = %s;'
-        results = self.get_one(query, (self.db_name,))
+        results = self.get_one(query, (db_name,))
         return results[0]
 
+    def get_replag(self):
+        '''Returns the replication lag in seconds, reusing readings up to a few seconds old'''
+        return replag_cache.get_or_load(self.db_name, self._load_replag)
+
+    def wait_for_replag(
+        self,
+        max_replag,
+        timeout,
+        initial_delay=REPLAG_WAIT_INITIAL_DELAY,
+        max_delay=REPLAG_WAIT_MAX_DELAY,
+    ) -> bool:
+        '''
+        Polls the replication lag with exponential backoff until it is at most max_replag
+        seconds. Returns False if that did not happen in timeout seconds.
+        '''
+        deadline = time.time() + timeout
+        delay = initial_delay
+
+        while True:
+            replag = self.get_replag()
+            if replag <= max_replag:
+                return True
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+
+            delay = min(delay, remaining)
+            print('Replag is %s seconds, checking again in %d seconds' % (replag, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
 
 class TaskDatabase(BaseDatabase):
     def __init__(self):
@@ -94,7 +423,12 @@ class TaskDatabase(BaseDatabase):
 
     def init(self):
         self.request()
+        try:
+            self.create_tables()
+        finally:
+            self.close()
 
+    def create_tables(self):
         self.run(
             'create table if not exists tasks (id integer primary key not null, name varchar(255) not null,'
             'approved tinyint(1) default 0 not null);'
@@ -111,8 +445,15 @@ class TaskDatabase(BaseDatabase):
             'task_id integer not null, task_wiki varchar(16) not null,'
             'started_at timestamp not null default now(), ended_at timestamp default 0);'
         )
-
-        self.close()
+        self.run(
+            'alter table jobs add column if not exists lag_waited integer default 0 not null;'
+        )
+        self.run(
+            'create table if not exists task_data (task_id integer not null,'
+            'data_key varchar(255) not null, data_value mediumtext not null,'
+            'updated_at timestamp default current_timestamp on update current_timestamp not null,'
+            'primary key (task_id, data_key));'
+        )
 
     def insert_task(self, number, name):
         self.run(
@@ -130,6 +471,9 @@ class TaskDatabase(BaseDatabase):
             (number,),
         )
 
+        return self._parse_trial(results)
+
+    def _parse_trial(self, results):
         if results is None:
             return None
 
@@ -153,6 +497,45 @@ class TaskDatabase(BaseDatabase):
 
         return results
 
+    def register_tasks(self, tasks: dict) -> dict:
+        '''
+        Upserts all given tasks (a dict of number => name) and loads their approval and trial
+        status. Returns a dict of number => (approved, trial), where trial is what get_trial()
+        would return for that task.
+        '''
+        if len(tasks) == 0:
+            return {}
+
+        numbers = sorted(tasks.keys())
+        values = []
+        for number in numbers:
+            values += [number, tasks[number]]
+
+        self.request()
+        try:
+            self.run(
+                'insert into tasks(id, name) values %s on duplicate key update name = values(name);'
+                % ','.join(['(%s, %s)'] * len(numbers)),
+                tuple(values),
+            )
+
+            rows = self.get_all(
+                'select tasks.id, tasks.approved, task_trials.* from tasks '
+                'left join task_trials on task_trials.id = ('
+                'select latest.id from task_trials latest where latest.task_id = tasks.id '
+                'order by latest.created_at desc limit 1) '
+                'where tasks.id in (%s);' % ','.join(['%s'] * len(numbers)),
+                tuple(numbers),
+            )
+        finally:
+            self.close()
+
+        states = {}
+        for row in rows:
+            trial = None if row[2] is None else self._parse_trial(row[2:])
+            states[row[0]] = (bool(row[1]), trial)
+        return states
+
     def record_trial_edit(self, trial_id: int):
         self.run('update task_trials set edits_done = edits_done + 1 where id = %s;', (trial_id,))
 
@@ -178,5 +561,59 @@ class TaskDatabase(BaseDatabase):
             ),
         )
 
+    def record_job_lag_wait(self, job_id: int, seconds: int):
+        '''Adds to the time a job spent waiting for replication lag to drop'''
+        self.run(
+            'update jobs set lag_waited = lag_waited + %s where id = %s',
+            (
+                seconds,
+                job_id,
+            ),
+        )
+
+    def get_task_data(self, task_id: int, key_prefix: str = '') -> dict:
+        '''Returns all values stored by a task whose key starts with key_prefix'''
+        escaped_prefix = key_prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        results = self.get_all(
+            'select data_key, data_value from task_data where task_id = %s and data_key like %s;',
+            (task_id, escaped_prefix + '%'),
+        )
+        return {key: json.loads(value) for key, value in results}
+
+    def set_task_data(self, task_id: int, values: dict):
+        '''Stores JSON-serializable values for a task, replacing any values with the same keys'''
+        items = list(values.items())
+
+        self.request()
+        try:
+            for i in range(0, len(items), TASK_DATA_CHUNK_SIZE):
+                chunk = items[i : i + TASK_DATA_CHUNK_SIZE]
+                params = []
+                for key, value in chunk:
+                    params += [task_id, key, json.dumps(value)]
+                self.run(
+                    'insert into task_data (task_id, data_key, data_value) values %s '
+                    'on duplicate key update data_value = values(data_value);'
+                    % ','.join(['(%s, %s, %s)'] * len(chunk)),
+                    tuple(params),
+                )
+        finally:
+            self.close()
+
+    def delete_task_data(self, task_id: int, keys: list):
+        keys = list(keys)
+
+        self.request()
+        try:
+            for i in range(0, len(keys), TASK_DATA_CHUNK_SIZE):
+                chunk = keys[i : i + TASK_DATA_CHUNK_SIZE]
+                self.run(
+                    'delete from task_data where task_id = %%s and data_key in (%s);'
+                    % ','.join(['%s'] * len(chunk)),
+                    tuple([task_id] + chunk),
+                )
+        finally:
+            self.close()
+
 
 task_database = TaskDatabase()
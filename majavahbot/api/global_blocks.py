@@ -0,0 +1,223 @@
+from majavahbot.api.consts import REPLICA_DATE_FORMAT
+from majavahbot.api.database import ReplicaDatabase
+from bisect import bisect_right
+from datetime import datetime, timedelta
+import ipaddress
+import threading
+import time
+
+# centralauth_p is on the same replica section as metawiki
+GLOBAL_BLOCKS_QUERY = '''
+select gb_address, gb_by, gb_timestamp, gb_expiry
+from centralauth_p.globalblocks
+where gb_expiry > %s
+'''
+
+GLOBAL_BLOCKS_FOR_ADDRESSES_QUERY = '''
+select gb_address, gb_by, gb_timestamp, gb_expiry
+from centralauth_p.globalblocks
+where gb_address in (%s)
+'''
+
+# addresses whose global blocks were changed since a timestamp
+GLOBAL_BLOCK_LOG_QUERY = '''
+select distinct log_title
+from logging_logindex
+where
+    log_type = 'gblblock'
+    and log_namespace = 2
+    and log_timestamp >= %s
+'''
+
+# how long a loaded index is used before checking the block log for changes
+GLOBAL_BLOCK_INDEX_REFRESH_SECONDS = 5 * 60
+
+# the block log is read from a bit before the previous refresh, in case of replication lag
+GLOBAL_BLOCK_LOG_OVERLAP_SECONDS = 10 * 60
+
+
+class GlobalBlock:
+    def __init__(self, address: str, by: str, timestamp: str, expiry: str):
+        self.address = address
+        self.by = by
+        self.timestamp = timestamp
+        self.expiry = expiry
+
+        network = ipaddress.ip_network(address, strict=False)
+        self.version = network.version
+        self.start = int(network.network_address)
+        self.end = int(network.broadcast_address)
+
+    def __repr__(self):
+        return 'GlobalBlock(address=' + self.address + ',by=' + self.by + ')'
+
+    def is_expired(self, now: str) -> bool:
+        # 'infinity' sorts after every timestamp, like in MediaWiki
+        return self.expiry <= now
+
+    def get_timestamp(self) -> datetime:
+        return datetime.strptime(self.timestamp, REPLICA_DATE_FORMAT)
+
+
+class IntervalIndex:
+    '''
+    Sorted list of address ranges of one IP version. Global blocks are always CIDR ranges, so
+    any two of them are either nested or disjoint, and each range links to the range directly
+    containing it. Finding the ranges containing an address is a binary search followed by
+    following those links.
+    '''
+
+    def __init__(self, blocks: list):
+        self.blocks = sorted(blocks, key=(lambda block: (block.start, -block.end)))
+        self.starts = [block.start for block in self.blocks]
+        # index of the block directly containing each block, or None
+        self.parents = []
+
+        stack = []
+        for i, block in enumerate(self.blocks):
+            while len(stack) > 0 and self.blocks[stack[-1]].end < block.end:
+                stack.pop()
+            self.parents.append(stack[-1] if len(stack) > 0 else None)
+            stack.append(i)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def find(self, start: int, end: int) -> list:
+        '''Returns all blocks containing the range from start to end, the smallest one first'''
+        i = bisect_right(self.starts, start) - 1
+        # blocks containing the range start at or before it, so the block at i is either one of
+        # them or nested inside all of them
+        while i is not None and i >= 0 and self.blocks[i].end < end:
+            i = self.parents[i]
+
+        results = []
+        while i is not None and i >= 0:
+            results.append(self.blocks[i])
+            i = self.parents[i]
+        return results
+
+
+class GlobalBlockIndex:
+    '''
+    Active global blocks loaded from the CentralAuth replica, for checking whether IPs and
+    ranges are blocked without a request per address. Updated incrementally by refresh().
+    '''
+
+    def __init__(self, replica: ReplicaDatabase):
+        self.replica = replica
+        self.lock = threading.Lock()
+
+        # normalized address => GlobalBlock
+        self.blocks = {}
+        # IP version => IntervalIndex
+        self.indexes = {}
+        self.loaded_at = None
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def _build(self):
+        self.indexes = {
+            version: IntervalIndex(
+                [block for block in self.blocks.values() if block.version == version]
+            )
+            for version in [4, 6]
+        }
+
+    def _add_rows(self, rows):
+        for address, by, timestamp, expiry in rows:
+            try:
+                block = GlobalBlock(
+                    address.decode('utf-8'),
+                    by.decode('utf-8'),
+                    timestamp.decode('utf-8'),
+                    expiry.decode('utf-8'),
+                )
+            except ValueError:
+                print('Ignoring global block of invalid address', address)
+                continue
+            self.blocks[block.address] = block
+
+    def load(self):
+        '''Loads all active global blocks'''
+        started_at = time.time()
+        now = datetime.utcnow().strftime(REPLICA_DATE_FORMAT)
+
+        with self.lock:
+            self.blocks = {}
+            self._add_rows(self.replica.get_all(GLOBAL_BLOCKS_QUERY, (now,)))
+            self._build()
+            self.loaded_at = started_at
+
+        print('Loaded %s global blocks' % len(self.blocks))
+
+    def refresh(self):
+        '''Reloads the blocks of addresses that have been blocked or unblocked since last time'''
+        if self.loaded_at is None:
+            self.load()
+            return
+
+        started_at = time.time()
+        since = (
+            datetime.utcfromtimestamp(self.loaded_at)
+            - timedelta(seconds=GLOBAL_BLOCK_LOG_OVERLAP_SECONDS)
+        ).strftime(REPLICA_DATE_FORMAT)
+
+        addresses = [
+            row[0].decode('utf-8')
+            for row in self.replica.get_all(GLOBAL_BLOCK_LOG_QUERY, (since,))
+        ]
+
+        with self.lock:
+            if len(addresses) > 0:
+                # the log uses the same sanitized form of the address as the blocks table
+                for address in addresses:
+                    self.blocks.pop(address, None)
+                self._add_rows(
+                    self.replica.get_all_in_chunks(GLOBAL_BLOCKS_FOR_ADDRESSES_QUERY, addresses)
+                )
+                self._build()
+            self.loaded_at = started_at
+
+        print('Refreshed global blocks of %s addresses' % len(addresses))
+
+    def refresh_if_needed(self, max_age=GLOBAL_BLOCK_INDEX_REFRESH_SECONDS):
+        if self.loaded_at is None or time.time() - self.loaded_at > max_age:
+            self.refresh()
+
+    def get_blocks(self, ip_or_range: str) -> list:
+        '''
+        Returns the active global blocks covering an IP or a range, the narrowest one first.
+        Raises ValueError if ip_or_range is not a valid IP address or range.
+        '''
+        network = ipaddress.ip_network(ip_or_range, strict=False)
+        now = datetime.utcnow().strftime(REPLICA_DATE_FORMAT)
+
+        index = self.indexes.get(network.version)
+        if index is None:
+            return []
+
+        blocks = index.find(int(network.network_address), int(network.broadcast_address))
+        return [block for block in blocks if not block.is_expired(now)]
+
+    def get_block(self, ip_or_range: str):
+        '''Returns the narrowest active global block covering an IP or a range, or None'''
+        blocks = self.get_blocks(ip_or_range)
+        return blocks[0] if len(blocks) > 0 else None
+
+
+# db name => GlobalBlockIndex, kept between runs of tasks in the same process
+global_block_indexes = {}
+global_block_indexes_lock = threading.Lock()
+
+
+def get_global_block_index(db_name: str = 'metawiki') -> GlobalBlockIndex:
+    '''Returns an up to date index of global blocks, loaded from the replica of db_name'''
+    with global_block_indexes_lock:
+        if db_name not in global_block_indexes:
+            global_block_indexes[db_name] = GlobalBlockIndex(ReplicaDatabase(db_name))
+        index = global_block_indexes[db_name]
+
+    index.refresh_if_needed()
+    return index
@@ -1,15 +1,109 @@
+from collections import OrderedDict
+import copy
 import re
+import threading
 import pywikibot
 import dateparser
 from pywikibot.data import api
 from pywikibot.comms.eventstreams import EventStreams, site_rc_listener
+from majavahbot.api.throttle import throttle, THROTTLE_ACTION_EDIT, THROTTLE_ACTION_READ
+from majavahbot.api.utils import TtlCache
 
 SIGNATURE_TIME_REGEX = re.compile(r'\d\d:\d\d, \d{1,2} \w*? \d\d\d\d \(UTC\)')
 
+# maximum amount of titles per request for non-bot users
+WIKIDATA_ID_BATCH_SIZE = 50
+
+
+# page texts kept in memory per site, and how long they are reused before being loaded again
+PAGE_CACHE_SIZE = 256
+PAGE_CACHE_TTL = 5 * 60
+
+# maximum amount of sites kept in memory
+MEDIAWIKI_API_CACHE_SIZE = 32
+
+
+class CachedPage(pywikibot.Page):
+    '''
+    Page that shares its loaded revision with other page objects for the same title through
+    the page cache of its MediawikiApi, and removes it from there when it is saved. Every
+    caller gets its own object, so setting text on one does not affect the others. The cached
+    revision is also the base revision of an edit, so saving text that is out of date fails
+    with an edit conflict instead of overwriting newer edits.
+
+    Saves go through the edit throttle of the wiki, and loading the text or the history
+    through the read throttle.
+    '''
+
+    def __init__(self, mediawiki_api, title, revision_id=None):
+        super().__init__(mediawiki_api.get_site(), title)
+        self.mediawiki_api = mediawiki_api
+        # if set, cached text of other revisions is not used
+        self.required_revision_id = revision_id
+
+    def _load(self, force, get_redirect, *args, **kwargs) -> tuple:
+        throttle.call(
+            self.site.dbName(),
+            THROTTLE_ACTION_READ,
+            lambda: super(CachedPage, self).get(force, get_redirect, *args, **kwargs),
+        )
+        # the revision has both the text and the timestamp pywikibot sends as basetimestamp
+        return copy.copy(self.latest_revision), getattr(self, '_isredir', False)
+
+    def _restore(self, revision, is_redirect: bool):
+        '''Sets the attributes pywikibot would set when loading the given revision'''
+        self._revid = revision.revid
+        self._revisions[revision.revid] = copy.copy(revision)
+        self._isredir = is_redirect
+
+    def get(self, force=False, get_redirect=False, *args, **kwargs):
+        cache = self.mediawiki_api.page_cache
+        title = self.title()
+        if force:
+            cache.invalidate(title)
+
+        revision, is_redirect = cache.get_or_load(
+            title, lambda key: self._load(force, get_redirect, *args, **kwargs)
+        )
+
+        if (
+            self.required_revision_id is not None and revision.revid != self.required_revision_id
+        ) or (is_redirect and not get_redirect):
+            # let pywikibot load the page again, and raise if it is a redirect
+            cache.invalidate(title)
+            revision, is_redirect = cache.get_or_load(
+                title, lambda key: self._load(True, get_redirect, *args, **kwargs)
+            )
+
+        self._restore(revision, is_redirect)
+        return revision.text
+
+    def revisions(self, *args, **kwargs):
+        '''Same as Page.revisions(), but loads all of the requested revisions at once'''
+        revisions = super().revisions(*args, **kwargs)
+        return iter(
+            throttle.call(self.site.dbName(), THROTTLE_ACTION_READ, lambda: list(revisions))
+        )
+
+    def save(self, *args, **kwargs):
+        try:
+            return throttle.call(
+                self.site.dbName(),
+                THROTTLE_ACTION_EDIT,
+                lambda: super(CachedPage, self).save(*args, **kwargs),
+            )
+        finally:
+            self.mediawiki_api.invalidate_page(self.title())
+
 
 class MediawikiApi:
-    def __init__(self, site, family):
+    def __init__(
+        self, site, family, page_cache_size=PAGE_CACHE_SIZE, page_cache_ttl=PAGE_CACHE_TTL
+    ):
         self.site = pywikibot.Site(site, family)
+        # normalized title => (latest revision, is redirect), so content that was already
+        # loaded is not fetched again
+        self.page_cache = TtlCache(page_cache_ttl, max_size=page_cache_size)
 
     def __repr__(self):
         self.site.login()
@@ -25,8 +119,28 @@ class MediawikiApi:
     def get_site(self) -> pywikibot.Site:
         return self.site
 
-    def get_page(self, page_name: str) -> pywikibot.Page:
-        return pywikibot.Page(self.site, page_name)
+    def get_page(self, page_name: str, revision_id=None) -> pywikibot.Page:
+        '''
+        Returns a new page object, that reuses text loaded recently for the same title. If
+        revision_id is given, cached text of a different revision is loaded again.
+        '''
+        return CachedPage(self, page_name, revision_id)
+
+    def submit_throttled(self, request: api.Request, action=THROTTLE_ACTION_READ) -> dict:
+        '''Submits an API request once the throttle of this wiki allows it'''
+        return throttle.call(self.site.dbName(), action, request.submit)
+
+    def get_latest_revision_id(self, page_name: str):
+        '''Returns the latest revision ID of a page without loading its text, None if missing'''
+        response = self.submit_throttled(
+            api.Request(self.site, action='query', prop='info', titles=page_name)
+        )
+        for page in response['query']['pages'].values():
+            return page.get('lastrevid')
+        return None
+
+    def invalidate_page(self, page_name: str):
+        self.page_cache.invalidate(pywikibot.Page(self.site, page_name).title())
 
     def get_user(self, user_name) -> pywikibot.User:
         return pywikibot.User(self.site, user_name)
@@ -52,7 +166,7 @@ class MediawikiApi:
             afllimit='1',
             aflprop='ids|user|title|action|result|timestamp|filter|details',
         )
-        response = request.submit()['query']['abuselog']
+        response = self.submit_throttled(request)['query']['abuselog']
         if len(response) > 0:
             return response[0]
         return None
@@ -68,7 +182,7 @@ class MediawikiApi:
             abflimit=1,
             abfshow='private',
         )
-        response = request.submit()['query']['abusefilters']
+        response = self.submit_throttled(request)['query']['abusefilters']
         return len(response) > 0
 
     def get_last_reply(self, section: str):
@@ -93,16 +207,60 @@ class MediawikiApi:
             return None
         return item.title()
 
+    def get_wikidata_ids(self, titles: list) -> dict:
+        '''
+        Resolves Wikidata item IDs of many pages at once, following redirects. Returns a dict of
+        requested title => item ID, or None if the page is not connected to Wikidata.
+        Pages that do not exist are left out.
+        '''
+        titles = list(OrderedDict.fromkeys(titles))
+        results = {}
+
+        for i in range(0, len(titles), WIKIDATA_ID_BATCH_SIZE):
+            batch = titles[i : i + WIKIDATA_ID_BATCH_SIZE]
+            response = self.submit_throttled(
+                api.Request(
+                    self.site,
+                    action='query',
+                    prop='pageprops',
+                    ppprop='wikibase_item',
+                    redirects=True,
+                    titles='|'.join(batch),
+                )
+            )['query']
+
+            # requested title => title of the page it resolves to
+            targets = {title: title for title in batch}
+            for key in ['normalized', 'redirects']:
+                renames = {rename['from']: rename['to'] for rename in response.get(key, [])}
+                for title, target in targets.items():
+                    targets[title] = renames.get(target, target)
+
+            pages = {page['title']: page for page in response.get('pages', {}).values()}
+            for title, target in targets.items():
+                page = pages.get(target)
+                if page is None or 'missing' in page or 'invalid' in page:
+                    continue
+                results[title] = page.get('pageprops', {}).get('wikibase_item')
+
+        return results
+
     def compare_page_titles(self, first: str, second: str) -> bool:
         return first.lower().replace('_', ' ') == second.lower().replace('_', ' ')
 
 
-mediawiki_apis = {}
+# (family, site) => MediawikiApi, least recently used first
+mediawiki_apis = OrderedDict()
+mediawiki_apis_lock = threading.RLock()
 
 
 def get_mediawiki_api(site='en', family='wikipedia') -> MediawikiApi:
-    if family not in mediawiki_apis:
-        mediawiki_apis[family] = {}
-    if site not in mediawiki_apis[family]:
-        mediawiki_apis[family][site] = MediawikiApi(site, family)
-    return mediawiki_apis[family][site]
+    # tasks running in the same process (see the supervisor) share their sessions
+    with mediawiki_apis_lock:
+        key = (family, site)
+        if key not in mediawiki_apis:
+            mediawiki_apis[key] = MediawikiApi(site, family)
+            while len(mediawiki_apis) > MEDIAWIKI_API_CACHE_SIZE:
+                mediawiki_apis.popitem(last=False)
+        mediawiki_apis.move_to_end(key)
+        return mediawiki_apis[key]
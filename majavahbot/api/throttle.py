@@ -0,0 +1,204 @@
+from collections import deque
+import threading
+import time
+
+THROTTLE_ACTION_EDIT = 'edit'
+THROTTLE_ACTION_READ = 'read'
+# requests that load lots of data at once, like everything about a single bot for task 3
+THROTTLE_ACTION_HEAVY_READ = 'heavy_read'
+
+# action => (requests per second, maximum burst size)
+THROTTLE_RATES = {
+    THROTTLE_ACTION_EDIT: (10 / 60, 1),
+    THROTTLE_ACTION_READ: (2, 4),
+    THROTTLE_ACTION_HEAVY_READ: (1 / 5, 1),
+}
+
+# how many times the rate of a bucket can be halved after errors
+THROTTLE_MIN_RATE_DIVISOR = 8
+
+# API error code => seconds to wait if the server does not say how long
+THROTTLE_ERROR_CODES = {
+    'maxlag': 5,
+    'ratelimited': 60,
+    'readonly': 60,
+}
+
+# observed rates are calculated over this many seconds
+THROTTLE_RATE_WINDOW = 60
+
+
+class TokenBucket:
+    '''
+    Token bucket that slows down after errors: backoff() pauses it and halves its rate,
+    which recovers gradually with every successful request.
+    '''
+
+    def __init__(self, rate, capacity):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+        self.waiting = 0
+        self.acquired_count = 0
+        self.backoff_count = 0
+        self.acquired_times = deque()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _remove_old_acquired_times(self, now):
+        while len(self.acquired_times) > 0 and now - self.acquired_times[0] > THROTTLE_RATE_WINDOW:
+            self.acquired_times.popleft()
+
+    def acquire(self):
+        '''Blocks until a request can be made'''
+        with self.lock:
+            self.waiting += 1
+
+        try:
+            while True:
+                with self.lock:
+                    now = time.time()
+                    self._refill(now)
+                    if now >= self.paused_until and self.tokens >= 1:
+                        self.tokens -= 1
+                        self.acquired_count += 1
+                        self.acquired_times.append(now)
+                        self._remove_old_acquired_times(now)
+                        return
+                    delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+                time.sleep(delay)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def backoff(self, seconds):
+        with self.lock:
+            self._refill(time.time())
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            self.rate = max(self.base_rate / THROTTLE_MIN_RATE_DIVISOR, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            self.backoff_count += 1
+
+    def report_success(self):
+        with self.lock:
+            self._refill(time.time())
+            self.rate = min(self.base_rate, self.rate + self.base_rate / THROTTLE_MIN_RATE_DIVISOR)
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            now = time.time()
+            self._remove_old_acquired_times(now)
+            return {
+                'rate': self.rate,
+                'base_rate': self.base_rate,
+                'observed_rate': len(self.acquired_times) / THROTTLE_RATE_WINDOW,
+                'queue_depth': self.waiting,
+                'paused_for': max(0, self.paused_until - now),
+                'acquired': self.acquired_count,
+                'backoffs': self.backoff_count,
+            }
+
+
+def get_error_code(error: Exception):
+    '''Returns the MediaWiki API error code of an exception, also when pywikibot wrapped it'''
+    code = getattr(error, 'code', None)
+    if code is None and isinstance(getattr(error, 'reason', None), Exception):
+        return get_error_code(error.reason)
+    return code
+
+
+def get_retry_after(error: Exception):
+    '''Returns how many seconds the server asked to wait before trying again, if it did'''
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    if 'Retry-After' in headers:
+        try:
+            return int(headers['Retry-After'])
+        except ValueError:
+            pass
+
+    other = getattr(error, 'other', None) or {}
+    if 'lag' in other:
+        return int(float(other['lag']))
+
+    if isinstance(getattr(error, 'reason', None), Exception):
+        return get_retry_after(error.reason)
+    return None
+
+
+class Throttle:
+    '''
+    Spaces out requests with a token bucket per wiki and action type. There is one instance
+    per process, so tasks running in the same process (see the supervisor) share their limits.
+    '''
+
+    def __init__(self, rates=THROTTLE_RATES):
+        self.rates = rates
+        # (wiki, action) => TokenBucket
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, wiki: str, action: str) -> TokenBucket:
+        with self.lock:
+            key = (wiki, action)
+            if key not in self.buckets:
+                rate, capacity = self.rates[action]
+                self.buckets[key] = TokenBucket(rate, capacity)
+            return self.buckets[key]
+
+    def acquire(self, wiki: str, action: str):
+        self.get_bucket(wiki, action).acquire()
+
+    def report_success(self, wiki: str, action: str):
+        self.get_bucket(wiki, action).report_success()
+
+    def backoff(self, wiki: str, action: str, seconds):
+        print('Throttling', action, 'requests to', wiki, 'for', seconds, 'seconds')
+        self.get_bucket(wiki, action).backoff(seconds)
+
+    def report_error(self, wiki: str, action: str, error: Exception) -> bool:
+        '''Backs off if error means that requests are too fast, returns whether it did'''
+        code = get_error_code(error)
+        retry_after = get_retry_after(error)
+
+        if code not in THROTTLE_ERROR_CODES and retry_after is None:
+            return False
+
+        if retry_after is None:
+            retry_after = THROTTLE_ERROR_CODES[code]
+        self.backoff(wiki, action, retry_after)
+        return True
+
+    def call(self, wiki: str, action: str, function):
+        '''Calls function once a request can be made, and reports how the request went'''
+        self.acquire(wiki, action)
+        try:
+            result = function()
+        except Exception as e:
+            self.report_error(wiki, action, e)
+            raise e
+        self.report_success(wiki, action)
+        return result
+
+    def get_metrics(self) -> list:
+        with self.lock:
+            buckets = list(self.buckets.items())
+
+        metrics = []
+        for (wiki, action), bucket in sorted(buckets, key=(lambda item: item[0])):
+            metrics.append(dict(bucket.get_metrics(), wiki=wiki, action=action))
+        return metrics
+
+
+throttle = Throttle()
+
+
+def get_throttle_metrics() -> list:
+    return throttle.get_metrics()
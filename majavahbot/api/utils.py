@@ -1,8 +1,10 @@
+from collections import OrderedDict
 import time
 import dateparser
 import re
 import subprocess
 import datetime
+import threading
 
 multiline_reply_regex = re.compile('\n+([^\n]+~~~~)')
 
@@ -25,22 +27,71 @@ def get_revision() -> str:
         return ''
 
 
-class Delay:
-    def __init__(self, seconds):
-        self.seconds = seconds
-        self.started = time.time()
+class TtlCache:
+    '''
+    Thread-safe key-value cache where entries expire after ttl seconds. If max_size is set,
+    the least recently used entries are evicted when the cache is full.
+    '''
 
-    def get_remaining(self):
-        return self.seconds - (time.time() - self.started)
+    def __init__(self, ttl, max_size=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
 
-    def wait(self):
-        delay = self.get_remaining()
-        if delay > 0:
-            time.sleep(delay)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
+    def __len__(self):
+        return len(self.entries)
 
-def create_delay(seconds) -> Delay:
-    return Delay(seconds)
+    def get_or_load(self, key, loader):
+        '''Returns the cached value for key, or calls loader(key) and caches its result'''
+        with self.lock:
+            if key in self.entries:
+                stored_at, value = self.entries[key]
+                if time.time() - stored_at <= self.ttl:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return value
+                del self.entries[key]
+            self.misses += 1
+
+        value = loader(key)
+
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while self.max_size is not None and len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+
+    def remove_expired(self):
+        with self.lock:
+            now = time.time()
+            for key in [key for key, entry in self.entries.items() if now - entry[0] > self.ttl]:
+                del self.entries[key]
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
 
 
 def was_enough_time_ago(time_text: str, seconds: int) -> bool:
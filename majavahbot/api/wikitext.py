@@ -0,0 +1,291 @@
+from bisect import bisect_right
+import mwparserfromhell
+import re
+
+# tags whose contents mwparserfromhell does not parse as wikitext
+PROTECTED_TAGS = [
+    'categorytree',
+    'gallery',
+    'hiero',
+    'imagemap',
+    'inputbox',
+    'math',
+    'nowiki',
+    'pre',
+    'score',
+    'section',
+    'source',
+    'syntaxhighlight',
+    'templatedata',
+    'timeline',
+]
+
+PROTECTED_REGION_REGEX = re.compile(
+    r'<!--.*?-->|<(%s)\b[^>]*?/>|<(%s)\b[^>]*>.*?</\2\s*>'
+    % ('|'.join(PROTECTED_TAGS), '|'.join(PROTECTED_TAGS)),
+    flags=re.IGNORECASE | re.DOTALL,
+)
+UNCLOSED_PROTECTED_REGION_REGEX = re.compile(
+    r'<!--|<(%s)\b' % '|'.join(PROTECTED_TAGS), flags=re.IGNORECASE
+)
+
+TEMPLATE_START_REGEX = re.compile(r'{{')
+BRACE_REGEX = re.compile(r'{{|}}')
+HEADING_REGEX = re.compile(r'(=+)(.+?)(=+)[ \t]*$', flags=re.MULTILINE)
+# mwparserfromhell also finds headings in some lines that don't end with =
+HEADING_LINE_REGEX = re.compile(r'^=.*$', flags=re.MULTILINE)
+
+# constructs that can contain a heading line so that it does not start a section
+CONTEXT_REGEX = re.compile(
+    r'{{|}}|\[\[|]]|^{\||^\|}|<(/?)([a-zA-Z][a-zA-Z0-9]*)\b[^>]*?(/?)>', flags=re.MULTILINE
+)
+VOID_TAGS = ['br', 'hr', 'meta', 'link', 'img', 'wbr']
+
+# characters that can make a template name match after mwparserfromhell strips markup from it
+COMPLEX_NAME_CHARACTERS = ['<', '{', '[', '&', "'"]
+
+
+def normalize_template_name(name: str) -> str:
+    '''Normalizes a template name like mwparserfromhell's Wikicode.matches() does'''
+    name = name.strip()
+    return name[:1].upper() + name[1:]
+
+
+class PartialWikicode:
+    '''
+    Wikitext where only some spans have been parsed with mwparserfromhell. Converting it to a
+    string puts the (possibly modified) parsed spans back to the original text, so text that
+    is not modified stays byte-identical.
+    '''
+
+    def __init__(self, text: str, spans: list):
+        self.text = text
+        self.spans = spans
+        self.parsed = [mwparserfromhell.parse(text[start:end]) for start, end in spans]
+
+    def __str__(self):
+        parts = []
+        position = 0
+        for (start, end), parsed in zip(self.spans, self.parsed):
+            parts.append(self.text[position:start])
+            parts.append(str(parsed))
+            position = end
+        parts.append(self.text[position:])
+        return ''.join(parts)
+
+    def filter_templates(self, *args, **kwargs) -> list:
+        templates = []
+        for parsed in self.parsed:
+            templates += parsed.filter_templates(*args, **kwargs)
+        return templates
+
+
+class PartialSections(PartialWikicode):
+    def __init__(self, text: str, spans: list, level: int, full_parse=False):
+        super().__init__(text, spans)
+        if full_parse:
+            self.sections = self.parsed[0].get_sections(levels=[level])
+        else:
+            self.sections = self.parsed
+
+    def get_sections(self) -> list:
+        return self.sections
+
+
+def get_protected_regions(text: str):
+    '''
+    Returns a sorted list of (start, end) of comments and tags with unparsed contents, or None
+    if there is one that is never closed.
+    '''
+    regions = [match.span() for match in PROTECTED_REGION_REGEX.finditer(text)]
+
+    position = 0
+    for start, end in regions + [(len(text), len(text))]:
+        if UNCLOSED_PROTECTED_REGION_REGEX.search(text, position, start) is not None:
+            return None
+        position = end
+
+    return regions
+
+
+def is_protected(regions: list, starts: list, position: int) -> bool:
+    i = bisect_right(starts, position) - 1
+    return i >= 0 and regions[i][0] <= position < regions[i][1]
+
+
+def find_template_end(text: str, start: int, regions: list, starts: list):
+    '''Returns the end of the template starting at start, or None if it is never closed'''
+    depth = 0
+    for match in BRACE_REGEX.finditer(text, start):
+        if is_protected(regions, starts, match.start()):
+            continue
+        depth += 1 if match.group(0) == '{{' else -1
+        if depth == 0:
+            return match.end()
+    return None
+
+
+def is_candidate_name(text: str, start: int, names: set) -> bool:
+    '''Checks if the name of the template starting at start can match one of names'''
+    end = len(text)
+    for separator in ['|', '}}']:
+        position = text.find(separator, start + 2)
+        if position != -1:
+            end = min(end, position)
+    name = text[start + 2 : end]
+
+    if any(character in name for character in COMPLEX_NAME_CHARACTERS):
+        return True
+    return normalize_template_name(name) in names
+
+
+def find_candidate_templates(text: str, names: list, regions: list) -> list:
+    '''
+    Returns (start, end) of every template that can have one of names, outermost only, or
+    None if one of them is not closed
+    '''
+    names = set(normalize_template_name(name) for name in names)
+    starts = [region[0] for region in regions]
+    spans = []
+
+    for match in TEMPLATE_START_REGEX.finditer(text):
+        start = match.start()
+        if len(spans) > 0 and start < spans[-1][1]:
+            # nested in a template that is parsed anyway
+            continue
+        if is_protected(regions, starts, start) or not is_candidate_name(text, start, names):
+            continue
+
+        end = find_template_end(text, start, regions, starts)
+        if end is None:
+            # mwparserfromhell can still pair it with stray closing braces later on
+            return None
+        spans.append((start, end))
+
+    return spans
+
+
+def has_open_context(text: str, position: int, end: int, regions: list, starts: list, depths):
+    '''
+    Updates depths with the constructs opened and closed between position and end, and
+    returns whether any of them is still open at end or was closed without being opened
+    '''
+    for match in CONTEXT_REGEX.finditer(text, position, end):
+        if is_protected(regions, starts, match.start()):
+            continue
+
+        token = match.group(0)
+        if match.group(2) is not None:
+            tag = match.group(2).lower()
+            if tag in VOID_TAGS or match.group(3) == '/':
+                continue
+            key = '<' + tag
+            change = -1 if match.group(1) == '/' else 1
+        elif token in ['{{', '[[', '{|']:
+            key, change = token, 1
+        else:
+            key, change = {'}}': '{{', ']]': '[[', '|}': '{|'}[token], -1
+
+        depth = depths.get(key, 0) + change
+        if depth < 0:
+            # a stray closing token, mwparserfromhell might pair it with something else
+            return True
+        depths[key] = depth
+
+    return any(depth > 0 for depth in depths.values())
+
+
+def parse_templates(text: str, names: list) -> PartialWikicode:
+    '''
+    Parses only the templates that can have one of the given names (compared like
+    mwparserfromhell's matches()), including any templates inside them. Falls back to
+    parsing everything if the text contains something the prefilter can't handle.
+    '''
+    text = str(text)
+    regions = get_protected_regions(text)
+
+    # template arguments and unclosed comments are rare, leave them to mwparserfromhell
+    if regions is None or '{{{' in text:
+        return PartialWikicode(text, [(0, len(text))])
+
+    spans = find_candidate_templates(text, names, regions)
+    if spans is None:
+        return PartialWikicode(text, [(0, len(text))])
+
+    starts = [region[0] for region in regions]
+    for start, end in spans:
+        if has_open_context(text, start, end, regions, starts, {}):
+            # a tag or link crossing the end of the template changes where it ends
+            return PartialWikicode(text, [(0, len(text))])
+
+    result = PartialWikicode(text, spans)
+
+    for parsed in result.parsed:
+        if len(parsed.nodes) != 1 or not isinstance(
+            parsed.nodes[0], mwparserfromhell.nodes.Template
+        ):
+            return PartialWikicode(text, [(0, len(text))])
+
+    return result
+
+
+def parse_sections(text: str, level: int, names: list) -> PartialSections:
+    '''
+    Parses only the sections of the given level (including their subsections) that contain
+    a template that can have one of the given names. get_sections() of the result returns
+    those sections, like Wikicode.get_sections(levels=[level]) would for the full text,
+    except for sections without such templates.
+    '''
+    text = str(text)
+    regions = get_protected_regions(text)
+
+    if regions is None or '{{{' in text:
+        return PartialSections(text, [(0, len(text))], level, full_parse=True)
+
+    templates = find_candidate_templates(text, names, regions)
+    if templates is None:
+        return PartialSections(text, [(0, len(text))], level, full_parse=True)
+
+    starts = [region[0] for region in regions]
+
+    # (start, level) of headings that start or end sections of the requested level
+    headings = []
+    depths = {}
+    position = 0
+    for line in HEADING_LINE_REGEX.finditer(text):
+        if is_protected(regions, starts, line.start()):
+            continue
+
+        match = HEADING_REGEX.match(text, line.start(), line.end())
+        if match is None:
+            return PartialSections(text, [(0, len(text))], level, full_parse=True)
+
+        heading_level = min(len(match.group(1)), len(match.group(3)), 6)
+        if heading_level > level:
+            continue
+
+        if has_open_context(text, position, match.start(), regions, starts, depths):
+            # the heading might be inside something else
+            return PartialSections(text, [(0, len(text))], level, full_parse=True)
+        position = match.start()
+        headings.append((match.start(), heading_level))
+
+    if has_open_context(text, position, len(text), regions, starts, depths):
+        return PartialSections(text, [(0, len(text))], level, full_parse=True)
+
+    spans = []
+    for i, (start, heading_level) in enumerate(headings):
+        if heading_level != level:
+            continue
+        end = headings[i + 1][0] if i + 1 < len(headings) else len(text)
+        if any(start <= template[0] < end for template in templates):
+            spans.append((start, end))
+
+    result = PartialSections(text, spans, level)
+
+    for (start, end), parsed in zip(spans, result.parsed):
+        sections = parsed.get_sections(levels=[level])
+        if len(sections) != 1 or str(sections[0]) != text[start:end]:
+            return PartialSections(text, [(0, len(text))], level, full_parse=True)
+
+    return result
@@ -0,0 +1,219 @@
+from majavahbot.api.database import get_connection_pool_metrics
+from majavahbot.api.throttle import get_throttle_metrics
+from majavahbot.tasks.task import Task, run_job
+from datetime import datetime
+import threading
+import traceback
+import json
+
+SUPERVISOR_STATE_STARTING = 'starting'
+SUPERVISOR_STATE_RUNNING = 'running'
+SUPERVISOR_STATE_WAITING = 'waiting'
+SUPERVISOR_STATE_RESTARTING = 'restarting'
+SUPERVISOR_STATE_DISABLED = 'disabled'
+SUPERVISOR_STATE_STOPPED = 'stopped'
+
+
+class TaskSupervisor:
+    '''
+    Runs continuous tasks (and optionally scheduled ones) in threads of a single process, so
+    they share MediaWiki API sessions and database connection pools. Continuous tasks are
+    restarted with exponential backoff when they crash or their event stream dries.
+    '''
+
+    def __init__(
+        self,
+        tasks: list,
+        scheduled_interval=None,
+        job_name='supervisor',
+        restart_delay=10,
+        max_restart_delay=10 * 60,
+    ):
+        self.tasks = tasks
+        self.scheduled_interval = scheduled_interval
+        self.job_name = job_name
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.threads = []
+
+        self.health = {}
+        for task in tasks:
+            self.health[task.number] = {
+                'number': task.number,
+                'name': task.name,
+                'site': task.site,
+                'family': task.family,
+                'continuous': task.is_continuous,
+                'state': SUPERVISOR_STATE_STARTING,
+                'started_at': None,
+                'finished_at': None,
+                'runs': 0,
+                'failures': 0,
+                'last_error': None,
+            }
+
+    def _update_health(self, task: Task, **values):
+        with self.lock:
+            self.health[task.number].update(values)
+
+    def _increment_health(self, task: Task, key: str):
+        with self.lock:
+            self.health[task.number][key] += 1
+
+    def get_health(self) -> list:
+        with self.lock:
+            health = [dict(values) for values in self.health.values()]
+        health.sort(key=(lambda values: values['number']))
+        return health
+
+    def _run_once(self, task: Task) -> bool:
+        if not task.should_edit():
+            print('Task', task.number, 'is not approved, not running it')
+            self._update_health(task, state=SUPERVISOR_STATE_DISABLED)
+            return False
+
+        self._update_health(task, state=SUPERVISOR_STATE_RUNNING, started_at=datetime.now())
+        self._increment_health(task, 'runs')
+
+        try:
+            if task.is_continuous:
+                task.run()
+            else:
+                run_job(task, self.job_name)
+            self._update_health(task, last_error=None)
+        except Exception as e:
+            traceback.print_exc()
+            self._increment_health(task, 'failures')
+            self._update_health(task, last_error=repr(e))
+
+        self._update_health(task, finished_at=datetime.now())
+        return True
+
+    def _supervise_continuous(self, task: Task):
+        delay = self.restart_delay
+
+        while not self.stop_event.is_set():
+            started = datetime.now()
+            if not self._run_once(task):
+                return
+
+            if self.stop_event.is_set():
+                break
+
+            # a task that ran for a while before failing gets restarted quickly again
+            if (datetime.now() - started).total_seconds() > self.max_restart_delay:
+                delay = self.restart_delay
+
+            print('Task', task.number, 'stopped, restarting in', delay, 'seconds')
+            self._update_health(task, state=SUPERVISOR_STATE_RESTARTING)
+            self.stop_event.wait(delay)
+            delay = min(delay * 2, self.max_restart_delay)
+
+        self._update_health(task, state=SUPERVISOR_STATE_STOPPED)
+
+    def _supervise_scheduled(self, task: Task):
+        while not self.stop_event.is_set():
+            if not self._run_once(task):
+                return
+
+            self._update_health(task, state=SUPERVISOR_STATE_WAITING)
+            self.stop_event.wait(self.scheduled_interval)
+
+        self._update_health(task, state=SUPERVISOR_STATE_STOPPED)
+
+    def start(self):
+        for task in self.tasks:
+            if task.is_continuous:
+                target = self._supervise_continuous
+            elif self.scheduled_interval is not None:
+                target = self._supervise_scheduled
+            else:
+                continue
+
+            thread = threading.Thread(target=target, args=(task,), name='task-%s' % task.number)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+        for task in self.tasks:
+            task.stop()
+
+    def print_health(self, health_file=None):
+        health = self.get_health()
+        for values in health:
+            print(
+                'Task %s (%s): %s, %s runs, %s failures, last error: %s'
+                % (
+                    values['number'],
+                    values['name'],
+                    values['state'],
+                    values['runs'],
+                    values['failures'],
+                    values['last_error'],
+                )
+            )
+
+        throttles = get_throttle_metrics()
+        for values in throttles:
+            print(
+                'Throttle %s %s: %.3f/%.3f requests per second, %s waiting, paused for %.0f s'
+                % (
+                    values['wiki'],
+                    values['action'],
+                    values['observed_rate'],
+                    values['rate'],
+                    values['queue_depth'],
+                    values['paused_for'],
+                )
+            )
+
+        pools = get_connection_pool_metrics()
+        for values in pools:
+            print(
+                'Database %s/%s: %s of %s connections in use, %s created, %s reused, %s waits'
+                % (
+                    values['host'],
+                    values['database'],
+                    values['in_use'],
+                    values['max_size'],
+                    values['created'],
+                    values['reused'],
+                    values['checkout_waits'],
+                )
+            )
+
+        if health_file:
+            with open(health_file, 'w') as file:
+                json.dump(
+                    {
+                        'updated_at': datetime.now(),
+                        'tasks': health,
+                        'throttles': throttles,
+                        'connection_pools': pools,
+                    },
+                    file,
+                    default=str,
+                    indent=2,
+                )
+
+    def run(self, health_interval=60, health_file=None):
+        '''Starts all tasks and blocks until interrupted'''
+        self.start()
+
+        if len(self.threads) == 0:
+            print('No tasks to supervise')
+            return
+
+        try:
+            while not self.stop_event.wait(health_interval):
+                self.print_health(health_file)
+        except KeyboardInterrupt:
+            print('Stopping all tasks')
+            self.stop()
+
+        self.print_health(health_file)
@@ -1,13 +1,31 @@
-from majavahbot.api import task_database, get_mediawiki_api, MediawikiApi
+from majavahbot.api import task_database, get_mediawiki_api, MediawikiApi, ReplicaDatabase
+from majavahbot.api.consts import JOB_STATUS_DONE, JOB_STATUS_FAIL
+from concurrent.futures import ThreadPoolExecutor
 from importlib import import_module
+from collections import deque
 from datetime import datetime
 from typing import Optional
+import ast
 import json
 import os
 import re
+import threading
+import time
+import traceback
+
+CONFIGURATION_COMMENT_REGEX = re.compile(r'[\n ]//.*', flags=re.MULTILINE)
+
+# how often the task configuration page is checked for new revisions, in seconds
+TASK_CONFIGURATION_CHECK_INTERVAL = 60
+
+# how long tasks wait for replication lag to drop before giving up on a run
+REPLAG_WAIT_TIMEOUT = 30 * 60
 
 
 class Task:
+    # configuration keys containing a regex or a list of regexes, compiled when loaded
+    regex_configuration_keys = []
+
     def __init__(self, number, name, site, family):
         self.number = number
         self.name = name
@@ -19,15 +37,58 @@ class Task:
         self.is_continuous = False
         self.supports_manual_run = False
         self.is_manual_run = False
+        # id of the row in the jobs table while running as a job
+        self.job_id = None
 
         self.task_configuration = {}
         self.base_task_configuration = {}
         self.task_configuration_page = None
         self.task_configuration_last_loaded = None
+        self.task_configuration_last_checked = None
+        self.task_configuration_revision_id = None
+        self.task_configuration_lock = threading.Lock()
+        # configuration key => compiled regex or list of them, for the loaded revision
+        self.compiled_task_configuration = {}
+
+        # approval and trial status are loaded in bulk by TaskRegistry.load_task_states(),
+        # or lazily on first access when the task was created outside of the registry
+        self.state_loaded = False
+        self._approved = False
+        self._trial = None
+
+    def load_state(self, approved: bool, trial: Optional[dict]):
+        self._approved = approved
+        self._trial = trial
+        self.state_loaded = True
+
+    def _ensure_state_loaded(self):
+        if self.state_loaded:
+            return
 
         task_database.insert_task(self.number, self.name)
-        self.approved = task_database.is_approved(self.number)
-        self.trial = task_database.get_trial(self.number)
+        self.load_state(
+            task_database.is_approved(self.number), task_database.get_trial(self.number)
+        )
+
+    @property
+    def approved(self) -> bool:
+        self._ensure_state_loaded()
+        return self._approved
+
+    @approved.setter
+    def approved(self, approved: bool):
+        self._ensure_state_loaded()
+        self._approved = approved
+
+    @property
+    def trial(self) -> Optional[dict]:
+        self._ensure_state_loaded()
+        return self._trial
+
+    @trial.setter
+    def trial(self, trial: Optional[dict]):
+        self._ensure_state_loaded()
+        self._trial = trial
 
     def __repr__(self):
         return 'Task(number=' + str(self.number) + ',name=' + self.name + ')'
@@ -35,6 +96,10 @@ class Task:
     def run(self):
         raise Exception('Not implemented yet')
 
+    def stop(self):
+        '''Asks a running continuous task to return from run() as soon as possible'''
+        pass
+
     def do_manual_run(self):
         self.is_manual_run = True
 
@@ -72,40 +137,116 @@ class Task:
     def get_mediawiki_api(self) -> MediawikiApi:
         return get_mediawiki_api(self.site, self.family)
 
+    def wait_for_replag(
+        self, replica: ReplicaDatabase, max_replag=10, timeout=REPLAG_WAIT_TIMEOUT
+    ) -> bool:
+        '''
+        Waits until the replication lag of replica is at most max_replag seconds, and records
+        the time spent waiting in the job row. Returns False if the lag did not drop in time.
+        '''
+        started = time.time()
+        result = replica.wait_for_replag(max_replag, timeout)
+
+        waited = int(time.time() - started)
+        if waited > 0 and self.job_id is not None:
+            task_database.record_job_lag_wait(self.job_id, waited)
+
+        if not result:
+            print(
+                'Replag is over %s seconds, not processing! (%s)'
+                % (max_replag, replica.get_replag())
+            )
+        return result
+
     def task_configuration_reloaded(self, old, new):
         pass
 
     def _load_task_configuration(self, contents: str):
-        config_text = re.sub(r'[\n ]//.*', '', contents, flags=re.MULTILINE)
+        config_text = CONFIGURATION_COMMENT_REGEX.sub('', contents)
 
         if len(config_text) == 0:
             config_text = '{}'
 
         config = json.loads(config_text)
 
+        old = self.task_configuration
         self.task_configuration = config
         self._merge_task_configuration()
 
-        self.task_configuration_reloaded(self.task_configuration, config)
+        # compiled from the new configuration directly, get_task_configuration() would try to
+        # take the lock held while loading it
+        self.compiled_task_configuration = {}
+        for key in self.regex_configuration_keys:
+            if key in self.task_configuration:
+                self._compile_task_configuration_regex(key, self.task_configuration[key])
+
+        self.task_configuration_reloaded(old, config)
         self.task_configuration_last_loaded = datetime.now()
 
     def register_task_configuration(self, config_page_name: str):
         self.task_configuration_page = config_page_name
 
-    def get_task_configuration(self, key: str = ''):
-        if (
-            self.task_configuration_last_loaded is None
-            or (datetime.now() - self.task_configuration_last_loaded).total_seconds() > 60 * 15
-        ):
+    def _check_task_configuration(self):
+        '''Reloads the configuration if its page has been edited since it was last loaded'''
+        with self.task_configuration_lock:
+            if (
+                self.task_configuration_last_checked is not None
+                and (datetime.now() - self.task_configuration_last_checked).total_seconds()
+                < TASK_CONFIGURATION_CHECK_INTERVAL
+            ):
+                return
+
             api = self.get_mediawiki_api()
-            page = api.get_page(self.task_configuration_page)
-            self._load_task_configuration(page.text)
+            revision_id = api.get_latest_revision_id(self.task_configuration_page)
+            self.task_configuration_last_checked = datetime.now()
+
+            if (
+                self.task_configuration_last_loaded is not None
+                and revision_id == self.task_configuration_revision_id
+            ):
+                return
+
+            if revision_id is None:
+                contents = ''
+            else:
+                contents = api.get_page(self.task_configuration_page, revision_id).text
+
+            self._load_task_configuration(contents)
+            self.task_configuration_revision_id = revision_id
+
+    def get_task_configuration(self, key: str = ''):
+        '''
+        Returns the value of a configuration key. Keys of nested objects can be accessed by
+        separating them with dots (for example 'archive_delays.{{effp|a}}'), unless the
+        configuration has a top-level key with that name.
+        '''
+        self._check_task_configuration()
 
         if len(key) == 0:
             return self.task_configuration
 
-        # TODO: support for nested keys
-        return self.task_configuration[key]
+        if key in self.task_configuration:
+            return self.task_configuration[key]
+
+        value = self.task_configuration
+        for part in key.split('.'):
+            value = value[part]
+        return value
+
+    def get_task_configuration_regex(self, key: str):
+        '''Returns a configuration value that is a regex, or a list of them, compiled'''
+        return self._compile_task_configuration_regex(key, self.get_task_configuration(key))
+
+    def _compile_task_configuration_regex(self, key: str, value):
+        compiled = self.compiled_task_configuration.get(key)
+        if compiled is None or compiled[0] != value:
+            if isinstance(value, list):
+                compiled = (value, [re.compile(pattern) for pattern in value])
+            else:
+                compiled = (value, re.compile(value))
+            self.compiled_task_configuration[key] = compiled
+
+        return compiled[1]
 
     def merge_task_configuration(self, **fill):
         self.base_task_configuration = fill
@@ -118,9 +259,180 @@ class Task:
                 self.task_configuration[key] = value
 
 
+def run_job(task: Task, job_name: str):
+    '''Runs a non-continuous task and records it as a job in the task database'''
+    job_id = task_database.start_job(
+        job_name, task.number, task.get_mediawiki_api().get_site().dbName()
+    )
+    task.job_id = job_id
+    try:
+        task.run()
+        task_database.stop_job(job_id, JOB_STATUS_DONE)
+    except Exception as e:
+        task_database.stop_job(job_id, JOB_STATUS_FAIL)
+        raise e
+    except KeyboardInterrupt as e:
+        task_database.stop_job(job_id, JOB_STATUS_FAIL)
+        raise e
+    finally:
+        task.job_id = None
+
+
+class WorkerPool:
+    '''
+    Processes a batch of items (usually pages from a replica query) in two stages. prepare(item)
+    runs concurrently in a bounded thread pool and does the reading and parsing; it returns
+    whatever save needs, or None if the item does not need to be edited. save(item, prepared)
+    runs in the calling thread, one item at a time in the original order. Saves go through the
+    edit throttle of the wiki (see majavahbot.api.throttle), which slows down on maxlag and rate
+    limit errors, and pywikibot waits on its own when the servers are lagged; both pause the
+    whole save stage.
+
+    As only the save stage checks Task.should_edit() and records trial edits, trial edit
+    accounting works the same as when processing the items sequentially. Manual runs always
+    process the items sequentially so that confirmation prompts are not mixed with output
+    from the workers.
+    '''
+
+    def __init__(self, task: Task, max_workers=4):
+        self.task = task
+        self.max_workers = max_workers
+        # limit how far ahead of the saves pages are read, so that they don't get stale
+        self.max_pending = max_workers * 2
+
+        self.prepared_count = 0
+        self.saved_count = 0
+        self.failed_count = 0
+
+    def get_metrics(self) -> dict:
+        return {
+            'prepared': self.prepared_count,
+            'saved': self.saved_count,
+            'failed': self.failed_count,
+        }
+
+    def _save(self, item, prepared, save) -> bool:
+        if prepared is None:
+            return True
+        if not self.task.should_edit():
+            print("Can't edit anymore, done")
+            return False
+
+        if save(item, prepared):
+            self.saved_count += 1
+        return True
+
+    def _run_sequential(self, items, prepare, save):
+        for item in items:
+            try:
+                prepared = prepare(item)
+                self.prepared_count += 1
+            except Exception:
+                self.failed_count += 1
+                traceback.print_exc()
+                continue
+
+            if not self._save(item, prepared, save):
+                return
+
+    def run(self, items, prepare, save):
+        '''
+        Runs prepare and save for all items. save(item, prepared) should return True if it
+        made an edit. Exceptions from prepare are printed and the item is skipped.
+        '''
+        if not self.task.should_edit():
+            print("Can't edit, not processing anything")
+            return
+
+        if self.task.is_manual_run or self.max_workers <= 1:
+            self._run_sequential(items, prepare, save)
+            return
+
+        iterator = iter(items)
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                while True:
+                    while len(pending) < self.max_pending:
+                        item = next(iterator, None)
+                        if item is None:
+                            break
+                        pending.append((item, executor.submit(prepare, item)))
+
+                    if len(pending) == 0:
+                        break
+
+                    item, future = pending.popleft()
+                    try:
+                        prepared = future.result()
+                        self.prepared_count += 1
+                    except Exception:
+                        self.failed_count += 1
+                        traceback.print_exc()
+                        continue
+
+                    if not self._save(item, prepared, save):
+                        break
+            finally:
+                for item, future in pending:
+                    future.cancel()
+
+
+TASK_MODULE_REGEX = re.compile(r'^task_(\d+)_\w+\.py$')
+
+
+class TaskInfo:
+    '''Describes a task module without importing it'''
+
+    def __init__(self, number: int, module: str, name=None, site=None, family=None):
+        self.number = number
+        self.module = module
+        self.name = name
+        self.site = site
+        self.family = family
+
+    def __repr__(self):
+        return 'TaskInfo(number=' + str(self.number) + ',module=' + self.module + ')'
+
+
+def read_task_info(number: int, module: str, path: str) -> TaskInfo:
+    '''
+    Reads the task name, site and family from the task_registry.add_task(SomeTask(...)) call
+    in a task module by parsing its source code instead of importing it.
+    '''
+    info = TaskInfo(number, module)
+
+    with open(path, encoding='utf-8') as file:
+        tree = ast.parse(file.read(), path)
+
+    for node in ast.walk(tree):
+        if not (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Attribute)
+            and node.func.attr == 'add_task'
+            and len(node.args) == 1
+            and isinstance(node.args[0], ast.Call)
+            and len(node.args[0].args) == 4
+        ):
+            continue
+
+        try:
+            args = [ast.literal_eval(arg) for arg in node.args[0].args]
+        except ValueError:
+            continue
+
+        if args[0] == number:
+            info.name, info.site, info.family = args[1:]
+            break
+
+    return info
+
+
 class TaskRegistry:
     def __init__(self):
         self.tasks = []
+        self.task_infos = None
 
     def add_task(self, task: Task):
         self.tasks.append(task)
@@ -130,24 +442,79 @@ class TaskRegistry:
         tasks.sort(key=(lambda task: task.number))
         return tasks
 
+    def discover_tasks(self) -> list:
+        '''Lists all task modules without importing any of them'''
+        if self.task_infos is None:
+            task_infos = {}
+            directory = os.path.dirname(__file__)
+            for module in os.listdir(directory):
+                match = TASK_MODULE_REGEX.match(module)
+                if match is None:
+                    continue
+                number = int(match.group(1))
+                task_infos[number] = read_task_info(
+                    number, 'majavahbot.tasks.' + module[:-3], os.path.join(directory, module)
+                )
+            self.task_infos = task_infos
+
+        task_infos = list(self.task_infos.values())
+        task_infos.sort(key=(lambda info: info.number))
+        return task_infos
+
+    def get_task_info(self, number: int) -> Optional[TaskInfo]:
+        for info in self.discover_tasks():
+            if info.number == number:
+                return info
+        return None
+
+    def _import_tasks(self, task_infos: list):
+        for info in task_infos:
+            import_module(info.module)
+        self.load_task_states()
+
     def get_task_by_number(self, number: int) -> Optional[Task]:
-        for task in self.get_tasks():
+        for task in self.tasks:
+            if task.number == number:
+                return task
+
+        # only import the module containing the requested task
+        info = self.get_task_info(number)
+        if info is None:
+            return None
+        self._import_tasks([info])
+
+        for task in self.tasks:
             if task.number == number:
                 return task
         return None
 
     def get_tasks_for_wiki(self, family: str, lang: str):
+        self._import_tasks(
+            [
+                info
+                for info in self.discover_tasks()
+                if info.site is None or (info.family == family and info.site == lang)
+            ]
+        )
+
         tasks = filter(lambda task: (task.family == family and task.site == lang), self.tasks)
         tasks = list(tasks)
         tasks.sort(key=(lambda task: task.number))
         return tasks
 
     def add_all_tasks(self):
-        for module in os.listdir(os.path.dirname(__file__)):
-            if module == '__init__.py' or module == 'task.py' or module[-3:] != '.py':
-                continue
-            name = 'majavahbot.tasks.' + module[:-3]
-            import_module(name)
+        self._import_tasks(self.discover_tasks())
+
+    def load_task_states(self):
+        '''Registers all known tasks and loads their approval and trial status in bulk'''
+        tasks = [task for task in self.tasks if not task.state_loaded]
+        if len(tasks) == 0:
+            return
+
+        states = task_database.register_tasks({task.number: task.name for task in tasks})
+        for task in tasks:
+            approved, trial = states.get(task.number, (False, None))
+            task.load_state(approved, trial)
 
 
 task_registry = TaskRegistry()
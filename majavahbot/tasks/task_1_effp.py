@@ -1,9 +1,39 @@
 from majavahbot.api import MediawikiApi
+from majavahbot.api.continuous import ContinuousRunner
+from majavahbot.api.utils import TtlCache
 from majavahbot.tasks import Task, task_registry
 from majavahbot.config import effpr_config_page
 from dateutil import parser
-from re import search, sub, compile
+from typing import Pattern
+from functools import lru_cache
+from hashlib import sha1
 import datetime
+import time
+
+
+@lru_cache(maxsize=4)
+def split_sections(page: str, section_header_pattern: Pattern) -> tuple:
+    # cached, since the previous revision of the reports page was the current one
+    # when the previous change event was processed
+    sections = []
+
+    # add a \n to beginning, since the regex needs one
+    page = '\n' + page
+    matches = list(section_header_pattern.finditer(page))
+
+    if len(matches) == 0:
+        return page, ()
+
+    for i in range(len(matches)):
+        match = matches[i]
+        end = matches[i + 1].start() - 1 if i < (len(matches) - 1) else len(page)
+        sections.append((match.group(1), page[match.start() : end] + '\n'))
+
+    header = page[: matches[0].start() - 1]
+    # cut out the first line ending added when passing the page text to the regex
+    header = header[1:]
+
+    return header + '\n', tuple(sections)
 
 
 class EffpTask(Task):
@@ -18,15 +48,37 @@ class EffpTask(Task):
      e) Archive
     '''
 
+    regex_configuration_keys = ['page_title_regex', 'section_header', 'page_title_wrong_formats']
+
     def __init__(self, number, name, site, family):
         super().__init__(number, name, site, family)
         self.is_continuous = True
         self.stream = None
+        self.runner = None
+        # set when the reports page changes, so that run() starts listening to the new one
+        self.restart_requested = False
+        self.stopping = False
         self.register_task_configuration(effpr_config_page)
+        self.merge_task_configuration(
+            incremental_processing=True,
+            section_cache_time=15 * 60,
+            block_cache_time=5 * 60,
+            abuse_log_cache_time=60,
+            event_coalesce_time=5,
+        )
+
+        # section hash => (time processed, text after processing it as a new report,
+        # edit summaries), blocks are checked again every time
+        self.section_cache = {}
+
+        # user name => (user name, blocked by or None)
+        self.block_cache = TtlCache(self.base_task_configuration['block_cache_time'])
+        # user name => latest abuse log entry or None
+        self.abuse_log_cache = TtlCache(self.base_task_configuration['abuse_log_cache_time'])
 
     def locate_page_name(self, section):
         '''Used to locate page name from a section'''
-        results = search(self.get_task_configuration('page_title_regex'), section)
+        results = self.get_task_configuration_regex('page_title_regex').search(section)
 
         if results is None:
             return None
@@ -53,7 +105,7 @@ class EffpTask(Task):
         new_section = section
         edit_summary = []
 
-        last_hit = api.get_last_abuse_filter_trigger(user_name)
+        last_hit = self.abuse_log_cache.get_or_load(user_name, api.get_last_abuse_filter_trigger)
 
         # If filter was triggered more than 3 hours ago, assume it is not the one being reported
         if last_hit is not None:
@@ -82,8 +134,8 @@ class EffpTask(Task):
                     if api.compare_page_titles(last_hit_page_title, page_title):
                         page_title_obviously_wrong = True
 
-                for pattern in self.get_task_configuration('page_title_wrong_formats'):
-                    wrong_spelling = search(pattern, page_title)
+                for pattern in self.get_task_configuration_regex('page_title_wrong_formats'):
+                    wrong_spelling = pattern.search(page_title)
                     if wrong_spelling is not None:
                         if api.compare_page_titles(wrong_spelling.group(1), last_hit_page_title):
                             page_title_obviously_wrong = True
@@ -93,8 +145,7 @@ class EffpTask(Task):
                     'abuse_log_format'
                 ) % api.get_page(last_hit_page_title).title(as_url=True)
 
-                new_section = sub(
-                    self.get_task_configuration('page_title_regex'),
+                new_section = self.get_task_configuration_regex('page_title_regex').sub(
                     ';Page you were editing\n: [['
                     + last_hit_page_title
                     + ']] (<span class="plainlinks">['
@@ -130,40 +181,57 @@ class EffpTask(Task):
         new_section = section
         edit_summary = []
 
-        user = api.get_user(user_name)
+        username, blocked_by = self.block_cache.get_or_load(
+            user_name, lambda name: self.get_block_status(name, api)
+        )
 
         # subtask d: notify if blocked
-        if user.isBlocked():
-            blocked_by = user.getprops()['blockedby']
-            new_section += ':{{EFFP|b|%s|%s|bot=1}} ~~~~\n' % (user.username, blocked_by)
+        if blocked_by is not None:
+            new_section += ':{{EFFP|b|%s|%s|bot=1}} ~~~~\n' % (username, blocked_by)
             edit_summary.append('Notify if user is blocked. (task 1d)')
 
         if new_section != section:
             return new_section, edit_summary
         return section, []
 
+    def get_block_status(self, user_name: str, api: MediawikiApi) -> tuple:
+        '''Returns the normalized user name and the blocking admin, or None if not blocked'''
+        user = api.get_user(user_name)
+        if user.isBlocked():
+            return user.username, user.getprops()['blockedby']
+        return user.username, None
+
     def get_sections(self, page: str) -> tuple:
         '''Parses a page and returns all sections in it'''
-        section_header_pattern = compile(self.get_task_configuration('section_header'))
-        sections = []
-
-        # add a \n to beginning, since the regex needs one
-        page = '\n' + page
-        matches = list(section_header_pattern.finditer(page))
-
-        if len(matches) == 0:
-            return page, []
+        header, sections = split_sections(
+            page, self.get_task_configuration_regex('section_header')
+        )
+        return header, list(sections)
+
+    def hash_section(self, section: tuple) -> str:
+        '''Hashes a (header, text) section tuple returned by get_sections()'''
+        return sha1((section[0] + '\n' + section[1]).encode('utf-8')).hexdigest()
+
+    def get_cached_section(self, section_hash: str):
+        '''
+        Returns (text, edit summaries) of a section after process_new_report() if it was
+        recently processed
+        '''
+        if section_hash not in self.section_cache:
+            return None
 
-        for i in range(len(matches)):
-            match = matches[i]
-            end = matches[i + 1].start() - 1 if i < (len(matches) - 1) else len(page)
-            sections.append((match.group(1), page[match.start() : end] + '\n'))
+        processed_at, text, summaries = self.section_cache[section_hash]
+        if time.time() - processed_at > self.get_task_configuration('section_cache_time'):
+            del self.section_cache[section_hash]
+            return None
 
-        header = page[: matches[0].start() - 1]
-        # cut out the first line ending added when passing the page text to the regex
-        header = header[1:]
+        return text, list(summaries)
 
-        return header + '\n', sections
+    def prune_section_cache(self, section_hashes: set):
+        '''Forgets sections that are no longer on the reports page'''
+        for section_hash in list(self.section_cache.keys()):
+            if section_hash not in section_hashes:
+                del self.section_cache[section_hash]
 
     def create_edit_summary(self, archived_sections: list, given_summaries: dict) -> str:
         processed_sections = list(given_summaries.keys())
@@ -204,6 +272,37 @@ class EffpTask(Task):
 
         return 'Bot clerking: ' + ', '.join(summary)
 
+    def process_open_section(
+        self,
+        section_user: str,
+        section_text: str,
+        section_hash: str,
+        is_new: bool,
+        use_cache: bool,
+        api: MediawikiApi,
+    ) -> tuple:
+        '''Returns the processed text and the edit summaries of a section that is not closed'''
+        cached = self.get_cached_section(section_hash) if use_cache else None
+
+        if cached is not None:
+            print('Section by', section_user, 'is unchanged, using cached results')
+            new_text, new_summaries = cached
+        else:
+            print('Processing section by', section_user)
+
+            new_text = section_text
+            new_summaries = []
+            if is_new:
+                new_text, new_summaries = self.process_new_report(new_text, section_user, api)
+
+            if self.get_task_configuration('incremental_processing') is True:
+                self.section_cache[section_hash] = (time.time(), new_text, new_summaries)
+
+        # not cached with the section, so that blocks are noticed as soon as the block
+        # cache expires
+        new_text, existing_summaries = self.process_existing_report(new_text, section_user, api)
+        return new_text, new_summaries + existing_summaries
+
     def process_page(self, page: str, api: MediawikiApi):
         if not self.should_edit():
             print('Should not edit; will not process page')
@@ -227,6 +326,10 @@ class EffpTask(Task):
             print('Assuming something was just archived or un-done, not doing anything')
             return
 
+        incremental = self.get_task_configuration('incremental_processing') is True
+        old_section_hashes = set(self.hash_section(section) for section in old_sections)
+        current_section_hashes = set()
+
         save = False
         summaries = {}
 
@@ -237,16 +340,17 @@ class EffpTask(Task):
         for i in range(len(current_sections)):
             section_user = current_sections[i][0]
             section_text = current_sections[i][1]
+            section_hash = self.hash_section(current_sections[i])
+            current_section_hashes.add(section_hash)
 
             if not self.is_closed(section_text):
-                print('Processing section by', section_user)
-
-                new_text = section_text
-                new_summaries = []
-                if i >= len(old_sections):
-                    new_text, new_summaries = self.process_new_report(new_text, section_user, api)
-                new_text, existing_summaries = self.process_existing_report(
-                    new_text, section_user, api
+                new_text, section_summaries = self.process_open_section(
+                    section_user,
+                    section_text,
+                    section_hash,
+                    i >= len(old_sections),
+                    incremental and section_hash in old_section_hashes,
+                    api,
                 )
 
                 if self.should_archive(new_text, api):
@@ -257,7 +361,7 @@ class EffpTask(Task):
                 elif new_text != section_text:
                     section_texts.append(new_text)
                     print('Modified open section', section_user)
-                    summaries[section_user] = new_summaries + existing_summaries
+                    summaries[section_user] = section_summaries
                     save = True
                 else:
                     print("Didn't modify open section", section_user)
@@ -270,6 +374,9 @@ class EffpTask(Task):
             else:
                 section_texts.append(section_text)
 
+        if incremental:
+            self.prune_section_cache(current_section_hashes)
+
         if save and self.should_edit():
             if len(archived_sections) > 0:
                 print('Saving archived sections, len =', len(archived_sections))
@@ -317,32 +424,81 @@ class EffpTask(Task):
 
     def run(self):
         api = self.get_mediawiki_api()
+        self.stopping = False
+
+        while True:
+            self.restart_requested = False
+            self.listen(api)
+            if not self.restart_requested or self.stopping:
+                break
+            print('Reports page changed, restarting')
+
+        # the supervisor subcommand restarts continuous tasks when their stream dries
+        if self.runner is not None:
+            print('EventStream dried', self.runner.get_metrics())
+
+    def listen(self, api: MediawikiApi):
+        reports_page = self.get_task_configuration('reports_page')
 
         print('Processing page once')
-        self.process_page(self.get_task_configuration('reports_page'), api)
+        self.process_page(reports_page, api)
 
         # if change streams are available for that page, use it; otherwise just process it once
         try:
-            self.stream = api.get_page_change_stream(self.get_task_configuration('reports_page'))
+            self.stream = api.get_page_change_stream(reports_page)
         except:
             print("Can't subscribe to EFFPR report page")
             return
 
         print('Now listening for EFFPR edits')
-        for change in self.stream:
-            if (
-                '!nobot!' in change['comment']
-                or 'Reverted ' in change['comment']
-                or 'Reverting ' in change['comment']
-                or 'Undid revision ' in change['comment']
-            ):
-                continue
-            self.process_page(self.get_task_configuration('reports_page'), api)
-        print('EventStream dried')  # auto restart?
+        self.runner = ContinuousRunner(
+            lambda page: self.process_page(page, api),
+            coalesce_seconds=self.get_task_configuration('event_coalesce_time'),
+            max_concurrency=1,
+        )
+        if self.restart_requested or self.stopping:
+            # changed while processing the page, before the runner could be stopped
+            return
+        self.runner.run(
+            self.stream,
+            lambda change: reports_page,
+            self.should_process_change,
+        )
+
+    def stop(self):
+        self.stopping = True
+        if self.runner is not None:
+            self.runner.stop()
+
+    def should_process_change(self, change) -> bool:
+        return not (
+            '!nobot!' in change['comment']
+            or 'Reverted ' in change['comment']
+            or 'Reverting ' in change['comment']
+            or 'Undid revision ' in change['comment']
+        )
 
     def task_configuration_reloaded(self, old, new):
         if 'reports_page' in old and old['reports_page'] != new['reports_page']:
-            self.stream = []  # dry stream
+            # stop listening to the old page, run() starts a new runner for the new one
+            self.restart_requested = True
+            if self.runner is not None:
+                self.runner.stop()
+            self.block_cache.clear()
+            self.abuse_log_cache.clear()
+
+        if old != new:
+            # processed sections depend on the configuration, for example page_title_regex
+            self.section_cache = {}
+
+        self.block_cache.ttl = new['block_cache_time']
+        self.abuse_log_cache.ttl = new['abuse_log_cache_time']
+        self.block_cache.remove_expired()
+        self.abuse_log_cache.remove_expired()
+        print(
+            'User caches: blocks %s, abuse log %s'
+            % (self.block_cache.get_metrics(), self.abuse_log_cache.get_metrics())
+        )
 
     def should_archive(self, text: str, api: MediawikiApi) -> bool:
         # if there is a signature in text, do not archive as it was modified in this round.
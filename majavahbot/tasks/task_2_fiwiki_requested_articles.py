@@ -1,7 +1,6 @@
 from majavahbot.api import MediawikiApi, ReplicaDatabase, manual_run, get_mediawiki_api
 from majavahbot.config import requested_articles_config_page
 from majavahbot.tasks import Task, task_registry
-from pywikibot import Page
 from re import compile
 
 
@@ -25,36 +24,65 @@ class FiwikiRequestedArticlesTask(Task):
         self.register_task_configuration(requested_articles_config_page)
         self.supports_manual_run = True
 
-    def compare_wikidata_qs(self, page: Page, api: MediawikiApi, other_links: list):
+    def resolve_wikidata_ids(self, api: MediawikiApi, local_titles: list, other_links: list):
+        '''
+        Resolves Wikidata IDs for all given local titles and interwiki links with one batched
+        lookup per wiki. Returns (local title => ID, language => (title => ID)), where the
+        inner dict is None if looking up IDs from that wiki failed. Local titles whose ID could
+        not be looked up are left out.
+        '''
         try:
-            local_wikidata_id = api.get_wikidata_id(page)
-            found_wikidata_ids = set()
-            found_wikidata_ids.add(str(local_wikidata_id))
-
-            for other_link in other_links:
-                other_site = get_mediawiki_api(other_link.group(1), api.get_site().family)
-                if not other_site:
-                    continue
-                other_page = other_site.get_page(other_link.group(2))
-                if not other_page or not other_page.exists():
-                    continue
+            local_ids = api.get_wikidata_ids(local_titles)
+        except:
+            print('Got an error while loading Wikidata Qs, loading them one by one')
+            local_ids = {}
+            for title in local_titles:
+                try:
+                    local_ids.update(api.get_wikidata_ids([title]))
+                except:
+                    print('Got an error while loading the Wikidata Q of', title)
+
+        other_titles = {}
+        for other_link in other_links:
+            other_titles.setdefault(other_link.group(1), []).append(other_link.group(2))
+
+        other_ids = {}
+        for language, titles in other_titles.items():
+            try:
+                other_site = get_mediawiki_api(language, api.get_site().family)
+                other_ids[language] = other_site.get_wikidata_ids(titles)
+            except:
+                print('Got an error while loading Wikidata Qs from', language)
+                other_ids[language] = None
+
+        return local_ids, other_ids
+
+    def compare_wikidata_qs(self, page_title: str, other_links: list, local_ids, other_ids):
+        if page_title not in local_ids:
+            print('Could not load the Wikidata Q of', page_title)
+            return False
+
+        found_wikidata_ids = set()
+        found_wikidata_ids.add(str(local_ids.get(page_title)))
+
+        for other_link in other_links:
+            ids = other_ids.get(other_link.group(1))
+            if ids is None:
+                print('Could not compare Wikidata Qs with', other_link.group(1))
+                return False
 
-                other_wikidata_id = other_site.get_wikidata_id(other_page)
-                found_wikidata_ids.add(str(other_wikidata_id))
+            # not existing pages are ignored
+            if other_link.group(2) not in ids:
+                continue
+            found_wikidata_ids.add(str(ids[other_link.group(2)]))
 
-            if len(found_wikidata_ids) != 1:
-                print(
-                    'Found %s different Wikidata Qs: %s'
-                    % (len(found_wikidata_ids), ', '.join(found_wikidata_ids))
-                )
-                return False
-            return True
-        except:
+        if len(found_wikidata_ids) != 1:
             print(
-                'Got an error while comparing Wikidata Qs, check if page is connected to wikidata'
-            )  # ignore; will return false
-
-        return False
+                'Found %s different Wikidata Qs: %s'
+                % (len(found_wikidata_ids), ', '.join(found_wikidata_ids))
+            )
+            return False
+        return True
 
     def process_page(self, page: str, api: MediawikiApi, replica: ReplicaDatabase):
         page = api.get_page(page)
@@ -76,25 +104,40 @@ class FiwikiRequestedArticlesTask(Task):
                     request_text = request_text[0].capitalize() + request_text[1:]
                     requests[request_text] = entry.group(0)
 
-        page_titles = requests.keys()
-        format_strings = ','.join(['%s'] * len(page_titles))
-        existing_pages = replica.get_all(EXISTING_PAGE_QUERY % format_strings, tuple(page_titles))
+        existing_pages = list(replica.get_all_in_chunks(EXISTING_PAGE_QUERY, requests.keys()))
 
         removed_entries = []
         new_text = text
 
         print('-- Found %s filled requests' % (str(len(existing_pages))))
+        existing_pages = [existing_page[0].decode('utf-8') for existing_page in existing_pages]
+
+        entry_other_links = {}
+        for existing_page in existing_pages:
+            entry_other_links[existing_page] = list(
+                OTHER_WIKI_LINK_REGEX.finditer(requests[existing_page])
+            )
+
+        # look up Wikidata Qs for all entries at once instead of one page at a time
+        compared_pages = [page for page in existing_pages if len(entry_other_links[page]) >= 1]
+        local_ids, other_ids = {}, {}
+        if len(compared_pages) > 0:
+            print("Loading Wikidata Q's for %s requests..." % len(compared_pages))
+            local_ids, other_ids = self.resolve_wikidata_ids(
+                api,
+                compared_pages,
+                [link for page in compared_pages for link in entry_other_links[page]],
+            )
+
         for existing_page in existing_pages:
-            existing_page = existing_page[0].decode('utf-8')
             existing_page_entry = requests[existing_page]
             print('- Request %s (%s)' % (existing_page, existing_page_entry.replace('\n', '')))
 
-            other_links = list(OTHER_WIKI_LINK_REGEX.finditer(existing_page_entry))
+            other_links = entry_other_links[existing_page]
 
             if len(other_links) >= 1:
                 print("Found at least 1 link to other wiki, comparing Wikidata Q's...")
-                local_page = api.get_page(existing_page)
-                if not self.compare_wikidata_qs(local_page, api, other_links):
+                if not self.compare_wikidata_qs(existing_page, other_links, local_ids, other_ids):
                     continue
 
             if not self.is_manual_run or manual_run.confirm_with_enter():
@@ -1,9 +1,12 @@
 from pywikibot.data.api import QueryGenerator
+from majavahbot.api import ReplicaDatabase, task_database
 from majavahbot.tasks import Task, task_registry
-from majavahbot.api.consts import MEDIAWIKI_DATE_FORMAT, HUMAN_DATE_FORMAT
-from majavahbot.api.utils import create_delay
+from majavahbot.api.consts import MEDIAWIKI_DATE_FORMAT, HUMAN_DATE_FORMAT, REPLICA_DATE_FORMAT
+from majavahbot.api.throttle import THROTTLE_ACTION_HEAVY_READ
+from majavahbot.api.wikitext import parse_templates
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import mwparserfromhell
 import sys
 
 # Groups in this array will not be shown as additional user rights
@@ -11,6 +14,58 @@ STANDARD_GROUPS = ['bot', '*', 'user', 'autoconfirmed', 'extendedconfirmed']
 
 PAGE_NAME = 'User:MajavahBot/Bot status report'
 
+BOTS_QUERY = '''
+select user_id, user_name, user_editcount
+from user
+join user_groups on ug_user = user_id
+where ug_group = 'bot'
+and (ug_expiry is null or ug_expiry > %s)
+order by user_name
+'''
+
+BOT_GROUPS_QUERY = '''
+select ug_user, ug_group
+from user_groups
+where ug_user in (select ug_user from user_groups where ug_group = 'bot')
+and (ug_expiry is null or ug_expiry > %s)
+'''
+
+BOT_ACTIVITY_QUERY = '''
+select
+    actor_user,
+    (
+        select rev_timestamp
+        from revision_userindex
+        where rev_actor = actor_id
+        order by rev_timestamp desc
+        limit 1
+    ) as last_edit,
+    (
+        select log_timestamp
+        from logging_userindex
+        where log_actor = actor_id
+        order by log_timestamp desc
+        limit 1
+    ) as last_log
+from actor
+where actor_user in (select ug_user from user_groups where ug_group = 'bot')
+'''
+
+BOT_BLOCKS_QUERY = '''
+select ipb_user, ipb_id, actor_name, comment_text, ipb_timestamp, ipb_expiry, ipb_sitewide
+from ipblocks
+join actor on actor_id = ipb_by_actor
+join comment on comment_id = ipb_reason_id
+where ipb_user in (select ug_user from user_groups where ug_group = 'bot')
+'''
+
+# keys for the snapshot of the previous run stored in the task database
+SNAPSHOT_BOT_PREFIX = 'bot:'
+SNAPSHOT_LAST_RUN_KEY = 'last_run'
+
+# how long changes stay in Special:RecentChanges, older snapshots can't be updated incrementally
+RECENT_CHANGES_MAX_AGE = 30 * 86400
+
 TABLE_HEADER = '''
 {| class="wikitable sortable" style="width:100%"
 |-
@@ -49,7 +104,9 @@ class BotStatusData:
         block_data,
     ):
         self.name = name
-        self.operators = set(operators)
+        # remove duplicates but keep the order, so that unchanged data renders identically
+        self.operators = list(OrderedDict.fromkeys(operators))
+        self.user_page_revid = None
 
         self.last_edit_timestamp = None
         self.last_log_timestamp = None
@@ -129,66 +186,129 @@ class BotStatusData:
             return '<center>—</center>'
         return '{{no ping|' + '}}, {{no ping|'.join(self.operators) + '}}'
 
+    def format_timestamp(self, date):
+        if date is None:
+            return None
+        return date.strftime(MEDIAWIKI_DATE_FORMAT)
+
+    def to_dict(self) -> dict:
+        '''Serializes this to a dict that can be stored as JSON and read back with from_dict()'''
+        return {
+            'name': self.name,
+            'operators': self.operators,
+            'last_edit_timestamp': self.format_timestamp(self.last_edit_timestamp),
+            'last_log_timestamp': self.format_timestamp(self.last_log_timestamp),
+            'edit_count': self.edit_count,
+            'groups': self.groups,
+            'block_data': self.block_data,
+            'user_page_revid': self.user_page_revid,
+        }
+
+    @staticmethod
+    def from_dict(data: dict):
+        bot = BotStatusData(
+            name=data['name'],
+            operators=data['operators'],
+            last_edit_timestamp=data['last_edit_timestamp'],
+            last_log_timestamp=data['last_log_timestamp'],
+            edit_count=data['edit_count'],
+            groups=data['groups'],
+            block_data=data['block_data'],
+        )
+        bot.user_page_revid = data['user_page_revid']
+        return bot
+
+
+def get_block_data(user: dict):
+    '''Reads block information from a list=users API result with usprop=blockinfo'''
+    if 'blockid' not in user:
+        return None
+
+    return {
+        'id': user['blockid'],
+        'by': user['blockedby'],
+        'reason': user['blockreason'],
+        'at': user['blockedtimestamp'],
+        'expiry': user['blockexpiry'],
+        'partial': 'blockpartial' in user,
+    }
+
+
+def decode_replica_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8')
+    return value
+
+
+def convert_replica_timestamp(value):
+    '''Converts a MediaWiki database timestamp to the format the API uses'''
+    value = decode_replica_value(value)
+    if value is None:
+        return None
+    if value == 'infinity':
+        return 'infinite'
+    return datetime.strptime(value, REPLICA_DATE_FORMAT).strftime(MEDIAWIKI_DATE_FORMAT)
+
+
+def get_operators(page_text: str) -> list:
+    '''Reads bot operators from {{Bot}} templates on a bot user page'''
+    operators = []
+    parsed = parse_templates(page_text, ['Bot', 'Bot2'])
+    for template in parsed.filter_templates():
+        if template.name.matches('Bot') or template.name.matches('Bot2'):
+            for param in template.params:
+                if not param.can_hide_key(param.name):
+                    continue
+                param_text = param.value.strip_code()
+                if len(param_text) == 0:
+                    continue
+                operators.append(param_text)
+    return operators
+
 
 class BotStatusTask(Task):
-    def __init__(self, number, name, site, family):
-        super().__init__(number, name, site, family)
+    # users and user pages loaded with a single API request in batched mode
+    batch_size = 50
+    # concurrent requests for latest contributions and log entries in batched mode
+    max_workers = 4
 
     def get_bot_data(self, username):
         # get all data needed with one big query
-        data = QueryGenerator(
-            site=self.get_mediawiki_api().get_site(),
-            prop='revisions',
-            list='users|usercontribs|logevents',
-            # for prop=revisions
-            titles='User:' + username,
-            redirects=True,
-            rvprop='content',
-            rvslots='main',
-            rvlimit='1',
-            # for list=usercontribs
-            uclimit=1,
-            ucuser=username,
-            ucdir='older',
-            # for list=users
-            usprop='blockinfo|groups|editcount',
-            ususers=username,
-            # for list=logevents
-            lelimit=1,
-            leuser=username,
-            ledir='older',
-        ).request.submit()
+        data = self.get_mediawiki_api().submit_throttled(
+            QueryGenerator(
+                site=self.get_mediawiki_api().get_site(),
+                prop='revisions',
+                list='users|usercontribs|logevents',
+                # for prop=revisions
+                titles='User:' + username,
+                redirects=True,
+                rvprop='content',
+                rvslots='main',
+                rvlimit='1',
+                # for list=usercontribs
+                uclimit=1,
+                ucuser=username,
+                ucdir='older',
+                # for list=users
+                usprop='blockinfo|groups|editcount',
+                ususers=username,
+                # for list=logevents
+                lelimit=1,
+                leuser=username,
+                ledir='older',
+            ).request,
+            THROTTLE_ACTION_HEAVY_READ,
+        )
         if 'query' in data:
             data = data['query']
 
-            block = None
-            if 'blockid' in data['users'][0]:
-                block = {
-                    'id': data['users'][0]['blockid'],
-                    'by': data['users'][0]['blockedby'],
-                    'reason': data['users'][0]['blockreason'],
-                    'at': data['users'][0]['blockedtimestamp'],
-                    'expiry': data['users'][0]['blockexpiry'],
-                    'partial': 'blockpartial' in data['users'][0],
-                }
-
             operators = []
             for page_id in data['pages']:
                 if page_id == '-1':
                     continue
                 page = data['pages'][page_id]
                 if page['title'] == 'User:' + username and 'missing' not in page:
-                    page_text = page['revisions'][0]['slots']['main']['*']
-                    parsed = mwparserfromhell.parse(page_text)
-                    for template in parsed.filter_templates():
-                        if template.name.matches('Bot') or template.name.matches('Bot2'):
-                            for param in template.params:
-                                if not param.can_hide_key(param.name):
-                                    continue
-                                param_text = param.value.strip_code()
-                                if len(param_text) == 0:
-                                    continue
-                                operators.append(param_text)
+                    operators += get_operators(page['revisions'][0]['slots']['main']['*'])
 
             return BotStatusData(
                 name=data['users'][0]['name'],
@@ -201,17 +321,341 @@ class BotStatusTask(Task):
                 else data['logevents'][0]['timestamp'],
                 edit_count=data['users'][0]['editcount'],
                 groups=data['users'][0]['groups'],
-                block_data=block,
+                block_data=get_block_data(data['users'][0]),
             )
 
         raise Exception('Failed loading bot data for ' + username + ': ' + str(data))
 
-    def run(self):
-        api = self.get_mediawiki_api()
-        table = str(TABLE_HEADER)
+    def get_last_activity(self, username) -> tuple:
+        '''Returns timestamps of the latest contribution and logged action of an user'''
+        data = self.get_mediawiki_api().submit_throttled(
+            QueryGenerator(
+                site=self.get_mediawiki_api().get_site(),
+                list='usercontribs|logevents',
+                # for list=usercontribs
+                uclimit=1,
+                ucuser=username,
+                ucdir='older',
+                # for list=logevents
+                lelimit=1,
+                leuser=username,
+                ledir='older',
+            ).request
+        )
+
+        if 'query' not in data:
+            raise Exception('Failed loading activity for ' + username + ': ' + str(data))
+
+        data = data['query']
+        return (
+            None if len(data['usercontribs']) == 0 else data['usercontribs'][0]['timestamp'],
+            None if len(data['logevents']) == 0 else data['logevents'][0]['timestamp'],
+        )
+
+    def get_user_page_revisions(self, usernames: list, rvprop='content') -> dict:
+        '''
+        Loads the latest revisions of the user pages of up to batch_size bots. The API leaves
+        out the content of some pages if it does not fit in one response, so this follows
+        continuations until all of them are loaded. Returns a dict of page title => revision
+        '''
+        parameters = {
+            'prop': 'revisions',
+            'titles': '|'.join(['User:' + username for username in usernames]),
+            'redirects': True,
+            'rvprop': rvprop,
+            'rvslots': 'main',
+        }
+
+        revisions = {}
+        while True:
+            data = self.get_mediawiki_api().submit_throttled(
+                QueryGenerator(site=self.get_mediawiki_api().get_site(), **parameters).request
+            )
+            if 'query' not in data:
+                raise Exception(
+                    'Failed loading user pages for ' + ', '.join(usernames) + ': ' + str(data)
+                )
+
+            for page_id, page in data['query'].get('pages', {}).items():
+                # pages left for a later continuation don't have revisions yet
+                if int(page_id) < 0 or 'missing' in page or 'revisions' not in page:
+                    continue
+                revisions[page['title']] = page['revisions'][0]
+
+            if 'continue' not in data:
+                return revisions
+            parameters.update(data['continue'])
+
+    def get_bot_data_batch(self, usernames: list, executor: ThreadPoolExecutor) -> list:
+        '''Loads data for up to batch_size bots, fetching their latest activity concurrently'''
+        activity = {
+            username: executor.submit(self.get_last_activity, username) for username in usernames
+        }
+
+        data = self.get_mediawiki_api().submit_throttled(
+            QueryGenerator(
+                site=self.get_mediawiki_api().get_site(),
+                list='users',
+                usprop='blockinfo|groups|editcount',
+                ususers='|'.join(usernames),
+            ).request
+        )
+
+        if 'query' not in data:
+            raise Exception(
+                'Failed loading bot data for ' + ', '.join(usernames) + ': ' + str(data)
+            )
+        data = data['query']
+
+        revisions = self.get_user_page_revisions(usernames, 'content|ids')
+
+        results = []
+        for user in data['users']:
+            username = user['name']
+            try:
+                if 'missing' in user or 'invalid' in user:
+                    raise Exception('Failed loading bot data for ' + username + ': ' + str(user))
+                last_edit_timestamp, last_log_timestamp = activity[username].result()
+                revision = revisions.get('User:' + username)
+                bot = BotStatusData(
+                    name=username,
+                    operators=[]
+                    if revision is None
+                    else get_operators(revision['slots']['main']['*']),
+                    last_edit_timestamp=last_edit_timestamp,
+                    last_log_timestamp=last_log_timestamp,
+                    edit_count=user['editcount'],
+                    groups=user['groups'],
+                    block_data=get_block_data(user),
+                )
+                bot.user_page_revid = None if revision is None else revision['revid']
+                results.append(bot)
+            except Exception as e:
+                print(e, file=sys.stderr)
+        return results
+
+    def get_operators_batch(self, usernames: list) -> dict:
+        '''Reads operators from the user pages of up to batch_size bots'''
+        return {
+            title: get_operators(revision['slots']['main']['*'])
+            for title, revision in self.get_user_page_revisions(usernames).items()
+        }
+
+    def get_bot_data_from_replica(self, replica: ReplicaDatabase) -> list:
+        '''Loads data for all bots from the wiki replicas, except for operators'''
+        now = datetime.utcnow().strftime(REPLICA_DATE_FORMAT)
+
+        replica.request()
+        try:
+            bots = replica.get_all(BOTS_QUERY, (now,))
+            groups = replica.get_all(BOT_GROUPS_QUERY, (now,))
+            activity = replica.get_all(BOT_ACTIVITY_QUERY)
+            blocks = replica.get_all(BOT_BLOCKS_QUERY)
+        finally:
+            replica.close()
+
+        user_groups = {}
+        for user_id, group in groups:
+            user_groups.setdefault(user_id, []).append(decode_replica_value(group))
+
+        user_activity = {}
+        for user_id, last_edit, last_log in activity:
+            user_activity[user_id] = (
+                convert_replica_timestamp(last_edit),
+                convert_replica_timestamp(last_log),
+            )
+
+        user_blocks = {}
+        for user_id, block_id, by, reason, timestamp, expiry, sitewide in blocks:
+            user_blocks[user_id] = {
+                'id': block_id,
+                'by': decode_replica_value(by),
+                'reason': decode_replica_value(reason),
+                'at': convert_replica_timestamp(timestamp),
+                'expiry': convert_replica_timestamp(expiry),
+                'partial': not sitewide,
+            }
+
+        results = []
+        for user_id, username, edit_count in bots:
+            last_edit_timestamp, last_log_timestamp = user_activity.get(user_id, (None, None))
+            results.append(
+                BotStatusData(
+                    name=decode_replica_value(username),
+                    operators=[],
+                    last_edit_timestamp=last_edit_timestamp,
+                    last_log_timestamp=last_log_timestamp,
+                    edit_count=edit_count,
+                    groups=user_groups.get(user_id, []),
+                    block_data=user_blocks.get(user_id),
+                )
+            )
+        return results
+
+    def get_user_states(self, usernames: list) -> dict:
+        '''
+        Loads the cheap parts of bot data (edit count, groups, block and the latest user page
+        revision) for up to batch_size bots with one request. Returns a dict of
+        user name => (list=users result, user page revision id)
+        '''
+        data = self.get_mediawiki_api().submit_throttled(
+            QueryGenerator(
+                site=self.get_mediawiki_api().get_site(),
+                prop='info',
+                list='users',
+                # for prop=info
+                titles='|'.join(['User:' + username for username in usernames]),
+                # for list=users
+                usprop='blockinfo|groups|editcount',
+                ususers='|'.join(usernames),
+            ).request
+        )
+
+        if 'query' not in data:
+            raise Exception(
+                'Failed loading bot data for ' + ', '.join(usernames) + ': ' + str(data)
+            )
+        data = data['query']
+
+        user_page_revids = {}
+        for page_id in data.get('pages', {}):
+            page = data['pages'][page_id]
+            if int(page_id) < 0 or 'missing' in page:
+                continue
+            user_page_revids[page['title']] = page['lastrevid']
+
+        return {
+            user['name']: (user, user_page_revids.get('User:' + user['name']))
+            for user in data['users']
+            if 'missing' not in user and 'invalid' not in user
+        }
+
+    def get_users_with_logged_actions(self, since: str) -> set:
+        '''Returns names of bots that performed logged actions since the given timestamp'''
+        parameters = {
+            'list': 'recentchanges',
+            'rcstart': since,
+            'rcdir': 'newer',
+            'rctype': 'log',
+            'rcshow': 'bot',
+            'rcprop': 'user',
+            'rclimit': 'max',
+        }
+
+        users = set()
+        while True:
+            data = self.get_mediawiki_api().submit_throttled(
+                QueryGenerator(site=self.get_mediawiki_api().get_site(), **parameters).request
+            )
+            if 'query' not in data:
+                raise Exception('Failed loading logged actions since ' + since + ': ' + str(data))
+
+            for change in data['query']['recentchanges']:
+                if 'user' in change:
+                    users.add(change['user'])
+
+            if 'continue' not in data:
+                return users
+            parameters.update(data['continue'])
+
+    def run_incremental(self, api) -> str:
+        '''
+        Only reloads bots that were active since the last run, using the snapshot stored in
+        the task database for everyone else.
+        '''
+        started_at = datetime.utcnow()
+
+        stored = task_database.get_task_data(self.number)
+        last_run = stored.get(SNAPSHOT_LAST_RUN_KEY)
+        snapshot = {
+            key[len(SNAPSHOT_BOT_PREFIX) :]: value
+            for key, value in stored.items()
+            if key.startswith(SNAPSHOT_BOT_PREFIX)
+        }
+
+        active_users = None
+        if (
+            last_run is not None
+            and (started_at - datetime.strptime(last_run, MEDIAWIKI_DATE_FORMAT)).total_seconds()
+            < RECENT_CHANGES_MAX_AGE
+        ):
+            active_users = self.get_users_with_logged_actions(last_run)
+            print('-- %s bots have logged actions since %s' % (len(active_users), last_run))
+        else:
+            print('-- No recent snapshot found, loading all bots')
+
+        usernames = [user['name'] for user in api.get_site().allusers(group='bot')]
+        rows = {}
+        to_reload = []
+
+        for i in range(0, len(usernames), self.batch_size):
+            batch = usernames[i : i + self.batch_size]
+            try:
+                states = self.get_user_states(batch)
+            except Exception as e:
+                print(e, file=sys.stderr)
+                to_reload += batch
+                continue
+
+            for username in batch:
+                old = snapshot.get(username)
+                if username not in states:
+                    to_reload.append(username)
+                    continue
+
+                user, user_page_revid = states[username]
+                if (
+                    old is None
+                    or active_users is None
+                    or username in active_users
+                    or old['edit_count'] != user['editcount']
+                    or old['user_page_revid'] != user_page_revid
+                ):
+                    to_reload.append(username)
+                    continue
+
+                # no activity, but groups and blocks can change without the bot doing anything
+                rows[username] = BotStatusData.from_dict(
+                    dict(old, groups=user['groups'], block_data=get_block_data(user))
+                )
+
+        print('-- Reloading %s of %s bots' % (len(to_reload), len(usernames)))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for i in range(0, len(to_reload), self.batch_size):
+                batch = to_reload[i : i + self.batch_size]
+                try:
+                    for data in self.get_bot_data_batch(batch, executor):
+                        rows[data.name] = data
+                except Exception as e:
+                    print(e, file=sys.stderr)
+
+        changed = {}
+        for username, data in rows.items():
+            new = data.to_dict()
+            if snapshot.get(username) != new:
+                changed[SNAPSHOT_BOT_PREFIX + username] = new
+        changed[SNAPSHOT_LAST_RUN_KEY] = started_at.strftime(MEDIAWIKI_DATE_FORMAT)
+
+        removed = [
+            SNAPSHOT_BOT_PREFIX + username for username in snapshot if username not in usernames
+        ]
+
+        print('-- Updating snapshot of %s bots, removing %s' % (len(changed) - 1, len(removed)))
+        task_database.set_task_data(self.number, changed)
+        if len(removed) > 0:
+            task_database.delete_task_data(self.number, removed)
+
+        # keep the order allusers returned the bots in
+        return ''.join(
+            [rows[username].to_table_row() for username in usernames if username in rows]
+        )
+
+    def run_sequential(self, api) -> str:
+        table = ''
 
         for user in api.get_site().allusers(group='bot'):
-            delay = create_delay(5)
+            # to not create unnecessary lag, get_bot_data() loads max 1 bot in 5 seconds as
+            # speed is not needed on cronjobs
             username = user['name']
             print('Loading data for bot', username)
             try:
@@ -220,12 +664,69 @@ class BotStatusTask(Task):
             except Exception as e:
                 # TODO: make better error handling
                 print(e, file=sys.stderr)
-            # to not create unnecessary lag, let's process max 1 bot in 5 seconds as speed is not needed on cronjobs
-            delay.wait()
+
+        return table
+
+    def run_batched(self, api) -> str:
+        usernames = [user['name'] for user in api.get_site().allusers(group='bot')]
+        rows = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for i in range(0, len(usernames), self.batch_size):
+                batch = usernames[i : i + self.batch_size]
+                print('Loading data for bots', i + 1, '-', i + len(batch), 'of', len(usernames))
+                try:
+                    for data in self.get_bot_data_batch(batch, executor):
+                        rows[data.name] = data.to_table_row()
+                except Exception as e:
+                    print(e, file=sys.stderr)
+
+        # keep the order allusers returned the bots in
+        return ''.join([rows[username] for username in usernames if username in rows])
+
+    def run_replica(self, api) -> str:
+        replica = ReplicaDatabase(api.get_site().dbName())
+
+        replag = replica.get_replag()
+        if replag > 10:
+            print('Replag is over 10 seconds, using the API instead (' + str(replag) + ')')
+            return self.run_batched(api)
+
+        bots = self.get_bot_data_from_replica(replica)
+        print('-- Got %s bots' % (str(len(bots))))
+
+        for i in range(0, len(bots), self.batch_size):
+            batch = bots[i : i + self.batch_size]
+            try:
+                operators = self.get_operators_batch([data.name for data in batch])
+                for data in batch:
+                    data.operators = operators.get('User:' + data.name, [])
+            except Exception as e:
+                print(e, file=sys.stderr)
+
+        return ''.join([data.to_table_row() for data in bots])
+
+    def run(self):
+        api = self.get_mediawiki_api()
+        table = str(TABLE_HEADER)
+
+        if self.param == 'sequential':
+            table += self.run_sequential(api)
+        elif self.param == 'replica':
+            table += self.run_replica(api)
+        elif self.param == 'full':
+            table += self.run_batched(api)
+        else:
+            table += self.run_incremental(api)
 
         table += '|}'
 
         page = api.get_page(PAGE_NAME)
+        # MediaWiki strips whitespace around the saved text
+        if page.exists() and page.text.strip() == table.strip():
+            print('Report is unchanged, not saving')
+            return
+
         page.text = table
         page.save('Bot updating status report', botflag=self.should_use_bot_flag())
 
@@ -1,6 +1,6 @@
 from majavahbot.api import ReplicaDatabase
 from majavahbot.api.manual_run import confirm_edit
-from majavahbot.tasks import Task, task_registry
+from majavahbot.tasks import Task, WorkerPool, task_registry
 
 
 QUERY = '''
@@ -56,14 +56,16 @@ class AchieverBot(Task):
         api = self.get_mediawiki_api()
         replicadb = ReplicaDatabase(api.get_site().dbName())
 
-        replag = replicadb.get_replag()
-        if replag > 10:
-            print('Replag is over 10 seconds, not processing! (' + str(replag) + ')')
+        if not self.wait_for_replag(replicadb):
             return
 
         results = replicadb.get_all(QUERY)
         print('-- Got %s pages' % (str(len(results))))
-        for page_from_db in results:
+
+        tag = self.get_task_configuration('autosetup_tag')
+        summary = self.get_task_configuration('autosetup_summary')
+
+        def prepare(page_from_db):
             page_id = page_from_db[0]
             page_name = page_from_db[1].decode('utf-8')
 
@@ -71,22 +73,29 @@ class AchieverBot(Task):
             page_text = page.get()
             assert page.pageid == page_id
 
+            new_text = tag + '\n\n' + page_text
+            if new_text == page_text:
+                return None
+            return page, new_text
+
+        def save(page_from_db, prepared):
+            page, new_text = prepared
             print('Tagging page ', page.title())
-            new_text = self.get_task_configuration('autosetup_tag') + '\n\n' + page_text
-            if (
-                new_text != page_text
-                and self.should_edit()
-                and (not self.is_manual_run or confirm_edit())
-            ):
-                api.site.login()
-                page.text = new_text
-                page.save(
-                    self.get_task_configuration('autosetup_summary'),
-                    watch=False,
-                    minor=False,
-                    botflag=self.should_use_bot_flag(),
-                )
-                self.record_trial_edit()
+            if self.is_manual_run and not confirm_edit():
+                return False
+
+            api.site.login()
+            page.text = new_text
+            page.save(
+                summary,
+                watch=False,
+                minor=False,
+                botflag=self.should_use_bot_flag(),
+            )
+            self.record_trial_edit()
+            return True
+
+        WorkerPool(self).run(results, prepare, save)
 
 
 task_registry.add_task(AchieverBot(4, 'Archive utility', 'sq', 'wikipedia'))
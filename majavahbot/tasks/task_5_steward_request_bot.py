@@ -1,11 +1,91 @@
+from majavahbot.api.consts import MEDIAWIKI_DATE_FORMAT, REPLICA_DATE_FORMAT
+from majavahbot.api.database import ReplicaDatabase, task_database
+from majavahbot.api.global_blocks import get_global_block_index
 from majavahbot.api.manual_run import confirm_edit
 from majavahbot.api.mediawiki import MediawikiApi
 from majavahbot.api.utils import remove_empty_lines_before_replies, was_enough_time_ago
+from majavahbot.api.wikitext import parse_sections
 from majavahbot.config import steward_request_bot_config_page
 from majavahbot.tasks import Task, task_registry
 from pywikibot.data.api import QueryGenerator
-import mwparserfromhell
+from datetime import datetime
+from hashlib import sha1
 import ipaddress
+import time
+import re
+
+
+# centralauth_p is on the same replica section as metawiki
+LOCKED_ACCOUNTS_QUERY = '''
+select gu_name
+from centralauth_p.globaluser
+where
+    gu_locked = 1
+    and gu_name in (%s)
+'''
+
+
+LOCK_LOG_QUERY = '''
+select log_title, actor_name, log_timestamp, log_action, log_params
+from logging_logindex
+join actor_logging on actor_id = log_actor
+where
+    log_type = 'globalauth'
+    and log_namespace = 2
+    and log_title in (%s)
+'''
+
+
+# maximum amount of addresses in a single list=globalblocks request for non-bot users
+GLOBAL_BLOCK_BATCH_SIZE = 50
+
+# keys in the task_data table for sections that were checked and not marked as done yet,
+# and for the page revision they were on
+SECTION_CACHE_PREFIX = 'section:'
+SECTION_CACHE_PAGE_KEY = 'page'
+
+# ranges with at most this many prefix bits, by IP version, are too broad for list=globalblocks
+# (cidrtoobroad), and people do suggest blocking those sometimes
+GLOBAL_BLOCK_API_CIDR_LIMITS = {4: 16, 6: 19}
+
+LOCK_LOG_ADDED_REGEX = re.compile(r'"4::added";a:\d+:{([^}]*)}')
+
+
+def normalize_user_name(name: str) -> str:
+    name = name.replace('_', ' ').strip()
+    return name[:1].upper() + name[1:]
+
+
+def is_lock_log_entry(action: str, params: str) -> bool:
+    '''Checks if a globalauth log entry from the database locked the account'''
+    if action == 'lock':
+        return True
+    if action != 'setstatus':
+        return False
+
+    match = LOCK_LOG_ADDED_REGEX.search(params)
+    if match is not None:
+        return '"locked"' in match.group(1)
+
+    # old entries have the added and removed statuses on separate lines
+    return 'locked' in params.split('\n')[0]
+
+
+def get_section_fingerprint(header: str, accounts: list, ips: list) -> str:
+    '''Identifies a request by its header and targets, ignoring comments added to it'''
+    header = ' '.join(header.strip('= \n').lower().split())
+    return sha1('\n'.join([header] + sorted(accounts + ips)).encode('utf-8')).hexdigest()
+
+
+def normalize_ip_or_range(ip_or_range: str):
+    try:
+        return ipaddress.ip_network(ip_or_range, strict=False)
+    except ValueError:
+        return None
+
+
+def is_range_too_broad(network) -> bool:
+    return network.prefixlen <= GLOBAL_BLOCK_API_CIDR_LIMITS[network.version]
 
 
 class StewardRequestTask(Task):
@@ -15,11 +95,13 @@ class StewardRequestTask(Task):
         self.supports_manual_run = True
 
     def get_steward_who_gblocked_ip(self, api: MediawikiApi, ip_or_range):
-        data = QueryGenerator(
-            site=api.get_site(),
-            list='globalblocks',
-            bgip=ip_or_range,
-        ).request.submit()['query']['globalblocks']
+        data = api.submit_throttled(
+            QueryGenerator(
+                site=api.get_site(),
+                list='globalblocks',
+                bgip=ip_or_range,
+            ).request
+        )['query']['globalblocks']
         if len(data) == 0:
             return None
 
@@ -29,12 +111,14 @@ class StewardRequestTask(Task):
         return data[0]['by']
 
     def get_steward_who_locked_account(self, api: MediawikiApi, account_name):
-        data = QueryGenerator(
-            site=api.get_site(),
-            list='logevents',
-            letype='globalauth',
-            letitle='User:' + account_name + '@global',
-        ).request.submit()['query']['logevents']
+        data = api.submit_throttled(
+            QueryGenerator(
+                site=api.get_site(),
+                list='logevents',
+                letype='globalauth',
+                letitle='User:' + account_name + '@global',
+            ).request
+        )['query']['logevents']
 
         if len(data) == 0 or 'locked' not in data[0]['params']['0']:
             return None
@@ -44,12 +128,151 @@ class StewardRequestTask(Task):
 
         return data[0]['user']
 
+    def get_stewards_who_gblocked_ips(self, api: MediawikiApi, ips: list) -> dict:
+        '''
+        Returns a dict of IP or range => steward who globally blocked it, or None if it is not
+        blocked (or was blocked too recently), using an index of all global blocks.
+        '''
+        replica = ReplicaDatabase(api.get_site().dbName())
+
+        replag = replica.get_replag()
+        if replag > 10:
+            print('Replag is over 10 seconds, checking blocks from the API (' + str(replag) + ')')
+            return self.get_stewards_who_gblocked_ips_from_api(api, ips)
+
+        index = get_global_block_index(api.get_site().dbName())
+
+        results = {}
+        for ip in ips:
+            block = index.get_block(ip)
+            if block is None:
+                results[ip] = None
+                continue
+
+            timestamp = block.get_timestamp().strftime(MEDIAWIKI_DATE_FORMAT)
+            if not was_enough_time_ago(timestamp, self.get_task_configuration('time_min')):
+                results[ip] = None
+                continue
+
+            results[ip] = block.by
+
+        return results
+
+    def get_stewards_who_gblocked_ips_from_api(self, api: MediawikiApi, ips: list) -> dict:
+        '''
+        Same as get_stewards_who_gblocked_ips, but using the API. Blocks of the exact addresses
+        are loaded in batches, only addresses without one are checked for blocks of larger ranges.
+        Ranges too broad for the API are never considered blocked.
+        '''
+        results = {}
+        networks = {ip: normalize_ip_or_range(ip) for ip in ips}
+        for ip, network in networks.items():
+            if network is None or is_range_too_broad(network):
+                print('Range', ip, 'is too broad to check from the API, skipping')
+                results[ip] = None
+
+        batch_ips = [ip for ip in dict.fromkeys(ips) if ip not in results]
+
+        for i in range(0, len(batch_ips), GLOBAL_BLOCK_BATCH_SIZE):
+            batch = batch_ips[i : i + GLOBAL_BLOCK_BATCH_SIZE]
+            request = QueryGenerator(
+                site=api.get_site(),
+                list='globalblocks',
+                bgaddresses='|'.join(batch),
+                bgprop='address|by|timestamp',
+                bglimit='max',
+            ).request
+            blocks = {}
+            for block in api.submit_throttled(request)['query']['globalblocks']:
+                blocks[normalize_ip_or_range(block['address'])] = block
+
+            for ip in batch:
+                block = blocks.get(networks[ip])
+                if block is None:
+                    continue
+                if not was_enough_time_ago(
+                    block['timestamp'], self.get_task_configuration('time_min')
+                ):
+                    results[ip] = None
+                    continue
+                results[ip] = block['by']
+
+        for ip in ips:
+            if ip not in results:
+                results[ip] = self.get_steward_who_gblocked_ip(api, ip)
+
+        return results
+
+    def get_stewards_who_locked_accounts(self, api: MediawikiApi, accounts: list) -> dict:
+        '''
+        Returns a dict of account name => steward who locked it, or None if it is not locked
+        (or was locked too recently), using the CentralAuth replica.
+        '''
+        replica = ReplicaDatabase(api.get_site().dbName())
+
+        replag = replica.get_replag()
+        if replag > 10:
+            print('Replag is over 10 seconds, checking locks from the API (' + str(replag) + ')')
+            return {
+                account: self.get_steward_who_locked_account(api, account) for account in accounts
+            }
+
+        names = {account: normalize_user_name(account) for account in accounts}
+
+        locked = set()
+        for row in replica.get_all_in_chunks(LOCKED_ACCOUNTS_QUERY, names.values()):
+            locked.add(row[0].decode('utf-8'))
+
+        # account name => latest globalauth log entry
+        latest = {}
+        for title, actor, timestamp, action, params in replica.get_all_in_chunks(
+            LOCK_LOG_QUERY, [name.replace(' ', '_') + '@global' for name in locked]
+        ):
+            name = title.decode('utf-8')[: -len('@global')].replace('_', ' ')
+            timestamp = timestamp.decode('utf-8')
+            if name not in latest or timestamp > latest[name][1]:
+                latest[name] = (
+                    actor.decode('utf-8'),
+                    timestamp,
+                    action.decode('utf-8'),
+                    params.decode('utf-8'),
+                )
+
+        results = {}
+        for account, name in names.items():
+            entry = latest.get(name)
+            if entry is None or not is_lock_log_entry(entry[2], entry[3]):
+                results[account] = None
+                continue
+
+            timestamp = datetime.strptime(entry[1], REPLICA_DATE_FORMAT).strftime(
+                MEDIAWIKI_DATE_FORMAT
+            )
+            if not was_enough_time_ago(timestamp, self.get_task_configuration('time_min')):
+                results[account] = None
+                continue
+
+            results[account] = entry[0]
+
+        return results
+
+    def get_stewards(self, api: MediawikiApi, accounts: list, ips: list) -> dict:
+        '''Returns a dict of account, IP or range => steward who locked or blocked it, or None'''
+        stewards = {}
+        if len(ips) > 0:
+            stewards.update(self.get_stewards_who_gblocked_ips(api, ips))
+        if len(accounts) > 0:
+            stewards.update(self.get_stewards_who_locked_accounts(api, accounts))
+        return stewards
+
     def run(self):
         self.merge_task_configuration(
             run=True,
             page='Steward requests/Global',
             summary='BOT: Marking done requests as done',
             time_min=5 * 60,
+            section_recheck_time=5 * 60,
+            section_recheck_max_time=60 * 60,
         )
 
         if self.get_task_configuration('run') is not True:
@@ -59,8 +282,26 @@ class StewardRequestTask(Task):
         api = self.get_mediawiki_api()
         page = api.get_page(self.get_task_configuration('page'))
         page_text = page.get(force=True)
-        parsed = mwparserfromhell.parse(page_text)
-        sections = parsed.get_sections(levels=[3])
+
+        now = int(time.time())
+        section_cache = task_database.get_task_data(self.number)
+        page_state = section_cache.get(SECTION_CACHE_PAGE_KEY)
+        if (
+            page_state is not None
+            and page_state['revision_id'] == page.latest_revision_id
+            and (page_state['next_check_at'] is None or page_state['next_check_at'] > now)
+        ):
+            print('Page has not changed and no requests need to be checked again yet')
+            return
+
+        # sections without a {{status}} template are skipped anyway, so don't parse them
+        parsed = parse_sections(page_text, 3, ['status'])
+        sections = parsed.get_sections()
+
+        # (section, status template, accounts, ips, fingerprint) of open requests
+        requests = []
+        # fingerprint => section cache entry, for all open requests
+        checked_sections = {}
 
         for section in sections:
             header = section.filter_headings()[0]
@@ -75,8 +316,6 @@ class StewardRequestTask(Task):
             accounts = []
             ips = []
 
-            awesome_people = []
-
             for template in section.filter_templates():
                 if template.name.matches('status'):
                     status = template
@@ -93,20 +332,9 @@ class StewardRequestTask(Task):
                         if len(param_text) == 0:
                             continue
 
-                        validate_text = param_text
-                        if validate_text.count('/') == 1:
-                            first, second = validate_text.split('/')
-
-                            # if the part after the slash is numeric, check if the part before is an ip
-                            # so CIDR ranges are checked if they are globally blocked instead of locked
-                            if second.isdigit():
-                                # since some people suggest blocking ranges larger than /16, don't crash
-                                second = int(second)
-                                if second > 16:
-                                    validate_text = first
-
                         try:
-                            ipaddress.ip_address(validate_text)
+                            # CIDR ranges are checked if they are globally blocked instead of locked
+                            ipaddress.ip_network(param_text, strict=False)
                             ips.append(param_text)
                         except ValueError:
                             accounts.append(param_text)
@@ -116,17 +344,28 @@ class StewardRequestTask(Task):
                 print('Section has non-ok status', status, accounts, ips)
                 continue
 
-            mark_done = True
+            fingerprint = get_section_fingerprint(str(header), accounts, ips)
+            cached = section_cache.get(SECTION_CACHE_PREFIX + fingerprint)
+            if cached is not None and cached['next_check_at'] > now:
+                print('Section', header, 'was checked recently, skipping')
+                checked_sections[fingerprint] = cached
+                continue
 
-            for ip in ips:
-                steward = self.get_steward_who_gblocked_ip(api, ip)
-                if steward is None:
-                    mark_done = False
-                else:
-                    awesome_people.append(steward)
+            requests.append((section, status, accounts, ips, fingerprint))
+
+        # resolve everything on the page at once instead of asking about each name separately
+        stewards = self.get_stewards(
+            api,
+            [account for request in requests for account in request[2]],
+            [ip for request in requests for ip in request[3]],
+        )
+
+        for section, status, accounts, ips, fingerprint in requests:
+            mark_done = True
+            awesome_people = []
 
-            for account in accounts:
-                steward = self.get_steward_who_locked_account(api, account)
+            for target in ips + accounts:
+                steward = stewards.get(target)
                 if steward is None:
                     mark_done = False
                 else:
@@ -134,6 +373,9 @@ class StewardRequestTask(Task):
 
             print(accounts, ips, awesome_people, mark_done)
             if not mark_done or len(awesome_people) == 0:
+                checked_sections[fingerprint] = self.get_section_cache_entry(
+                    section_cache.get(SECTION_CACHE_PREFIX + fingerprint), now
+                )
                 continue
 
             # remove duplicates
@@ -149,6 +391,9 @@ class StewardRequestTask(Task):
         new_text = str(parsed)
         new_text = remove_empty_lines_before_replies(new_text)
 
+        # requests marked as done but not saved need to be checked again on the next run
+        next_check_at = now if new_text != page_text else None
+
         if (
             new_text != page_text
             and self.should_edit()
@@ -158,6 +403,48 @@ class StewardRequestTask(Task):
             page.text = new_text
             page.save(self.get_task_configuration('summary'), botflag=self.should_use_bot_flag())
             self.record_trial_edit()
+            next_check_at = None
+
+        self.save_section_cache(
+            section_cache, checked_sections, page.latest_revision_id, next_check_at
+        )
+
+    def get_section_cache_entry(self, old, now: int) -> dict:
+        '''Schedules the next check of a request, waiting longer each time it was not done'''
+        checks = 1 if old is None else old['checks'] + 1
+        delay = min(
+            self.get_task_configuration('section_recheck_time') * 2 ** (checks - 1),
+            self.get_task_configuration('section_recheck_max_time'),
+        )
+        return {'checked_at': now, 'checks': checks, 'next_check_at': now + delay}
+
+    def save_section_cache(
+        self, old: dict, checked_sections: dict, revision_id: int, next_check_at=None
+    ):
+        values = {
+            SECTION_CACHE_PREFIX + fingerprint: entry
+            for fingerprint, entry in checked_sections.items()
+            if old.get(SECTION_CACHE_PREFIX + fingerprint) != entry
+        }
+        values[SECTION_CACHE_PAGE_KEY] = {
+            'revision_id': revision_id,
+            'next_check_at': min(
+                [entry['next_check_at'] for entry in checked_sections.values()]
+                + ([next_check_at] if next_check_at is not None else []),
+                default=None,
+            ),
+        }
+        task_database.set_task_data(self.number, values)
+
+        # requests that were marked as done or removed from the page
+        removed = [
+            key
+            for key in old
+            if key.startswith(SECTION_CACHE_PREFIX)
+            and key[len(SECTION_CACHE_PREFIX) :] not in checked_sections
+        ]
+        if len(removed) > 0:
+            task_database.delete_task_data(self.number, removed)
 
 
 task_registry.add_task(StewardRequestTask(5, 'Steward request bot', 'meta', 'meta'))
@@ -1,11 +1,16 @@
+from majavahbot.api.consts import CACHE_DIRECTORY
 from majavahbot.api.database import ReplicaDatabase
 from majavahbot.api.manual_run import confirm_edit
-from majavahbot.tasks import Task, task_registry
+from majavahbot.api.wikitext import parse_templates
+from majavahbot.tasks import Task, WorkerPool, task_registry
 from pywikibot import Page, PageRelatedError
 from functools import lru_cache
-import mwparserfromhell
+from typing import Optional
+import threading
 import traceback
 import datetime
+import json
+import os
 import re
 
 
@@ -35,6 +40,45 @@ limit 1000;
 '''
 
 
+# old names of articles, from moves of the page with that title
+MOVED_FROM_QUERY = '''
+select page_title, log_title
+from page
+join logging_logindex on log_page = page_id
+where
+    page_namespace = 0
+    and log_type = 'move'
+    and log_namespace = 0
+    and page_title in (%s)
+'''
+
+# old move log entries don't have log_page set, but moves also leave a revision with a comment
+# like "Example moved page [[Foo]] to [[Bar]]" in the history of the moved page
+MOVED_FROM_COMMENTS_QUERY = '''
+select page_title, comment_text
+from page
+join revision on rev_page = page_id
+join comment_revision on comment_id = rev_comment_id
+where
+    page_namespace = 0
+    and page_title in (%s)
+    and comment_text like '%%moved %%[[%%]] to [[%%'
+'''
+
+
+# redirects pointing to articles
+REDIRECTS_QUERY = '''
+select rd_title, page_title
+from redirect
+join page on page_id = rd_from
+where
+    rd_namespace = 0
+    and rd_interwiki = ''
+    and page_namespace = 0
+    and rd_title in (%s)
+'''
+
+
 MONTH_REPLACEMENTS = {
     'Jan': 'January',
     'Feb': 'February',
@@ -51,21 +95,66 @@ MONTH_REPLACEMENTS = {
 }
 
 
-NAME_REPLACEMENTS = {
-    re.compile(r'{{(?:ship|warship)\|([a-zA-Z0-9\- ]+)\|([a-zA-Z0-9\- ]+)}}'): r'[[\g<1> \g<2>]]',
-    re.compile(
-        r'{{(?:ship|warship)\|([a-zA-Z0-9\- ]+)\|([a-zA-Z0-9\- ]+)\|([a-zA-Z0-9\- ]+)}}'
-    ): r'[[\g<1> \g<2> (\g<3>)]]',
-    re.compile(r'{{sclass\|([a-zA-Z0-9\- ]+)\|([a-zA-Z0-9\- ]+)}}'): r'[[\g<1> class \g<2>]]',
-}
+# Expands ship name templates to the links they produce. The parameter character class does
+# not contain braces, so matches of different templates can't overlap.
+SHIP_TEMPLATE_REGEX = re.compile(
+    r'{{(warship|ship|sclass|hmas|hms|hmt|sms|usat|uss|ss)((?:\|[a-zA-Z0-9\- ]+)+)}}'
+)
+SHIP_TEMPLATE_YEAR_REGEX = re.compile(r'[0-9]+')
+
+
+def expand_ship_template(match) -> str:
+    name = match.group(1)
+    params = match.group(2).split('|')[1:]
+
+    if name == 'ship' or name == 'warship':
+        if len(params) == 2:
+            return '[[%s %s]]' % tuple(params)
+        if len(params) == 3:
+            return '[[%s %s (%s)]]' % tuple(params)
+    elif name == 'sclass':
+        if len(params) == 2:
+            return '[[%s class %s]]' % tuple(params)
+    else:
+        if len(params) == 1:
+            return '[[%s %s]]' % (name, params[0])
+        if len(params) == 2 or (
+            len(params) == 3 and SHIP_TEMPLATE_YEAR_REGEX.fullmatch(params[2]) is not None
+        ):
+            return '[[%s %s (%s)]]' % (name, params[0], params[1])
 
-for name in ['hms', 'hmas', 'hmt', 'sms', 'ss', 'usat', 'uss']:
-    NAME_REPLACEMENTS[re.compile(r'{{' + name + r'\|([a-zA-Z0-9\- ]+)}}')] = (
-        r'[[' + name + r' \g<1>]]'
-    )
-    NAME_REPLACEMENTS[
-        re.compile(r'{{' + name + r'\|([a-zA-Z0-9\- ]+)\|([a-zA-Z0-9\- ]+)(\|[0-9]+)?}}')
-    ] = (r'[[' + name + r' \g<1> (\g<2>)]]')
+    # not a form of the template that produces a simple link
+    return match.group(0)
+
+
+def expand_ship_templates(row: str) -> str:
+    return SHIP_TEMPLATE_REGEX.sub(expand_ship_template, row)
+
+
+BOLD_LINK_REGEX = re.compile(r"'''\[\[([^\]|#]+)")
+
+ARCHIVE_INDEX_DIRECTORY = os.path.join(CACHE_DIRECTORY, 'dyk_archive_index')
+
+
+def normalize_entry_title(title: str) -> str:
+    return title.replace('_', ' ').strip().lower()
+
+
+def build_archive_index(archive_text: str) -> dict:
+    '''
+    Maps normalized targets of bolded links in a Recent additions archive page to
+    [row number, row text] of the first row linking to them.
+    '''
+    index = {}
+
+    for row_number, row in enumerate(str(archive_text).split('\n')):
+        row_to_search = expand_ship_templates(row.lower())
+        for match in BOLD_LINK_REGEX.finditer(row_to_search):
+            key = normalize_entry_title(match.group(1))
+            if key not in index:
+                index[key] = [row_number, row[1:]]  # remove * from beginning
+
+    return index
 
 
 class DykEntryTalkTask(Task):
@@ -73,8 +162,8 @@ class DykEntryTalkTask(Task):
         super().__init__(number, name, site, family)
         self.supports_manual_run = True
         self.register_task_configuration('User:MajavahBot/DYK options')
+        self.archive_index_lock = threading.Lock()
 
-    @lru_cache()
     def get_archive_page(self, year, month):
         archive_page_name = 'Wikipedia:Recent additions/' + str(year) + '/' + str(month)
         try:
@@ -84,7 +173,73 @@ class DykEntryTalkTask(Task):
             traceback.print_exc()
             return ''
 
-    def get_entry_for_page(self, year, month, day, page: Page):
+    @lru_cache()
+    def get_archive_index(self, year, month) -> dict:
+        '''Loads the index of an archive page, only parsing it again if it has been edited'''
+        # pages are processed in multiple threads, make sure only one of them writes the file
+        with self.archive_index_lock:
+            return self._load_archive_index(year, month)
+
+    def _load_archive_index(self, year, month) -> dict:
+        archive_page_name = 'Wikipedia:Recent additions/' + str(year) + '/' + str(month)
+        index_file = os.path.join(ARCHIVE_INDEX_DIRECTORY, '%s-%s.json' % (year, month))
+
+        # a throttled request that does not load the text
+        revision_id = self.get_mediawiki_api().get_latest_revision_id(archive_page_name)
+        if revision_id is None:
+            print('Failed getting for page', year, month)
+            return {}
+
+        if os.path.exists(index_file):
+            try:
+                with open(index_file, encoding='utf-8') as file:
+                    stored = json.load(file)
+                if stored['revision_id'] == revision_id:
+                    return stored['index']
+            except (ValueError, KeyError):
+                print('Ignoring broken archive index', index_file)
+
+        archive_text = self.get_archive_page(year, month)
+        if len(archive_text) == 0:
+            return {}
+
+        index = build_archive_index(archive_text)
+
+        os.makedirs(ARCHIVE_INDEX_DIRECTORY, exist_ok=True)
+        with open(index_file + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump({'revision_id': revision_id, 'index': index}, file)
+        os.replace(index_file + '.tmp', index_file)
+
+        return index
+
+    def get_page_aliases(self, replica: ReplicaDatabase, page_titles: list) -> dict:
+        '''
+        Loads the names that DYK archives can use for the given articles (their current title,
+        titles they were moved from and redirects to them) for all of them at once. Move
+        sources are found both from the move log and from the comments of the revisions
+        moves created, like the API lookup does.
+        Returns a dict of title (as in the database) => list of normalized names.
+        '''
+        aliases = {title: [normalize_entry_title(title)] for title in page_titles}
+
+        def add_alias(title, alias):
+            title = title.decode('utf-8')
+            alias = normalize_entry_title(alias)
+            if title in aliases and alias not in aliases[title]:
+                aliases[title].append(alias)
+
+        for query in [MOVED_FROM_QUERY, REDIRECTS_QUERY]:
+            for title, alias in replica.get_all_in_chunks(query, page_titles):
+                add_alias(title, alias.decode('utf-8'))
+
+        for title, comment in replica.get_all_in_chunks(MOVED_FROM_COMMENTS_QUERY, page_titles):
+            result = MOVED_REGEX.match(comment.decode('utf-8'))
+            if result is not None:
+                add_alias(title, result.group(1))
+
+        return aliases
+
+    def get_entry_for_page(self, year, month, day, page: Page, aliases=None):
         # for weird syntax
         if month.endswith(','):
             month = month[:-1]
@@ -98,38 +253,42 @@ class DykEntryTalkTask(Task):
         if month in MONTH_REPLACEMENTS.keys():
             month = MONTH_REPLACEMENTS[month]
 
-        main_page = page.toggleTalkPage()
-        search_entries = ["'''[[" + main_page.title().lower()]
-
-        for revision in main_page.revisions():
-            result = MOVED_REGEX.match(revision.comment)
-            if result is not None:
-                old_name = result.group(1)
-                old_page = self.get_mediawiki_api().get_page(old_name)
-                search_entries.append("'''[[" + old_page.title().lower())
-        for incoming_redirect in main_page.backlinks(
-            filter_redirects=True, follow_redirects=False, namespaces=[0]
-        ):
-            search_entries.append("'''[[" + incoming_redirect.title().lower())
+        if aliases is not None:
+            # prefetched for the whole batch by get_page_aliases()
+            search_entries = aliases
+        else:
+            main_page = self.get_mediawiki_api().get_page(page.toggleTalkPage().title())
+            search_entries = [normalize_entry_title(main_page.title())]
+
+            for revision in main_page.revisions():
+                result = MOVED_REGEX.match(revision.comment)
+                if result is not None:
+                    old_name = result.group(1)
+                    old_page = self.get_mediawiki_api().get_page(old_name)
+                    search_entries.append(normalize_entry_title(old_page.title()))
+            for incoming_redirect in main_page.backlinks(
+                filter_redirects=True, follow_redirects=False, namespaces=[0]
+            ):
+                search_entries.append(normalize_entry_title(incoming_redirect.title()))
 
         print(search_entries)
 
-        archive_text = self.get_archive_page(year, month)
+        archive_index = self.get_archive_index(year, month)
+
+        # use the first row in the archive that links to any of the names
+        rows = [archive_index[entry] for entry in search_entries if entry in archive_index]
+        if len(rows) == 0:
+            return False
+
+        # you could check dates here, if wanted - please don't for now, see BRFA for more details
+        return min(rows)[1]
 
-        for row in str(archive_text).split('\n'):
-            row_to_search = row.lower()
-            for regex in NAME_REPLACEMENTS:
-                row_to_search = regex.sub(NAME_REPLACEMENTS[regex], row_to_search)
-            for search_entry in search_entries:
-                if search_entry in row_to_search:
-                    text = row[1:]  # remove * from beginning
-                    # you could check dates here, if wanted - please don't for now, see BRFA for more details
-                    return text
-        return False
-
-    def process_page(self, page: Page):
+    def prepare_page(self, page: Page, aliases=None) -> Optional[str]:
+        '''Returns the new text for a talk page, or None if it does not need to be edited'''
         page_text = page.get(force=True)
-        parsed = mwparserfromhell.parse(page_text)
+        parsed = parse_templates(
+            page_text, ['Dyktalk', 'DYK talk', 'ArticleHistory', 'Article history']
+        )
 
         year = None
         month = None
@@ -150,7 +309,7 @@ class DykEntryTalkTask(Task):
                     day, month = template.get(1).value.strip().split(' ')
 
                 if entry is None:
-                    entry = self.get_entry_for_page(year, month, day, page)
+                    entry = self.get_entry_for_page(year, month, day, page, aliases)
 
                 if entry:
                     print('Adding entry', entry, 'to {{DYK talk}}')
@@ -181,7 +340,7 @@ class DykEntryTalkTask(Task):
                 print(page.title(), year, month, day)
 
                 if entry is None:
-                    entry = self.get_entry_for_page(year, month, day, page)
+                    entry = self.get_entry_for_page(year, month, day, page, aliases)
 
                 if entry:
                     print('Adding entry', entry, 'to {{ArticleHistory}}')
@@ -189,21 +348,29 @@ class DykEntryTalkTask(Task):
 
         if entry:
             new_text = str(parsed)
-            if (
-                new_text != page.text
-                and self.should_edit()
-                and (not self.is_manual_run or confirm_edit())
-            ):
-                self.get_mediawiki_api().get_site().login()
-                page.text = str(parsed)
+            if new_text != page.text:
+                return new_text
+        return None
+
+    def save_page(self, page: Page, new_text: str) -> bool:
+        if self.is_manual_run and not confirm_edit():
+            return False
 
-                page.save(
-                    self.get_task_configuration('missing_blurb_edit_summary'),
-                    botflag=self.should_use_bot_flag(),
-                )
-                self.record_trial_edit()
-                return True
-        return False
+        self.get_mediawiki_api().get_site().login()
+        page.text = new_text
+
+        page.save(
+            self.get_task_configuration('missing_blurb_edit_summary'),
+            botflag=self.should_use_bot_flag(),
+        )
+        self.record_trial_edit()
+        return True
+
+    def process_page(self, page: Page, aliases=None) -> bool:
+        new_text = self.prepare_page(page, aliases)
+        if new_text is None or not self.should_edit():
+            return False
+        return self.save_page(page, new_text)
 
     def run(self):
         self.merge_task_configuration(
@@ -220,25 +387,34 @@ class DykEntryTalkTask(Task):
 
         replicadb = ReplicaDatabase(site.dbName())
 
-        replag = replicadb.get_replag()
-        if replag > 10:
-            print('Replag is over 10 seconds, not processing! (' + str(replag) + ')')
+        if not self.wait_for_replag(replicadb):
             return
 
         results = replicadb.get_all(QUERY)
         print('-- Got %s pages' % (str(len(results))))
-        for page_from_db in results:
-            if not self.should_edit():
-                print("Can't edit anymore, done")
-                break
 
+        aliases = self.get_page_aliases(
+            replicadb, [page_from_db[1].decode('utf-8') for page_from_db in results]
+        )
+
+        def prepare(page_from_db):
             page_id = page_from_db[0]
             page_name = page_from_db[1].decode('utf-8')
 
             page = api.get_page('Talk:' + page_name)
             assert page.pageid == page_id
 
-            self.process_page(page)
+            new_text = self.prepare_page(page, aliases.get(page_name))
+            if new_text is None:
+                return None
+            return page, new_text
+
+        def save(page_from_db, prepared):
+            return self.save_page(*prepared)
+
+        # load the configuration before the workers might need it
+        self.get_task_configuration('missing_blurb_edit_summary')
+        WorkerPool(self).run(results, prepare, save)
 
 
 task_registry.add_task(DykEntryTalkTask(6, 'DYK entry filler', 'en', 'wikipedia'))
@@ -1,25 +1,10 @@
-from majavahbot.api.database import task_database
-from majavahbot.api.utils import get_revision
 from majavahbot.api.consts import *
-from majavahbot.tasks import task_registry
-from flask import Blueprint, render_template
+from majavahbot.web.dashboard import dashboard_data
+from flask import Blueprint, make_response, render_template, request
 
 blueprint = Blueprint('majavah-bot', __name__)
 
 
-def map_task(db_row):
-    registry_task = task_registry.get_task_by_number(db_row[0])
-    return {
-        'number': db_row[0],
-        'name': db_row[1],
-        'is_continuous': registry_task.is_continuous,
-        'site': registry_task.site,
-        'family': registry_task.family,
-        'approved': db_row[2] == 1,
-        'trial': db_row[3] == 1,
-    }
-
-
 # utils to be used in tempale
 def get_badge_color_for_status(status):
     return {
@@ -41,53 +26,34 @@ def format_duration(job):
 @blueprint.context_processor
 def inject_base_variables():
     return {
-        'revision': get_revision(),
+        'revision': dashboard_data.revision,
     }
 
 
+def render_cached(etag: str, template: str, **context):
+    '''Renders a template, or responds with 304 if the client already has this version'''
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = make_response(
+            render_template(
+                template,
+                get_badge_color_for_status=get_badge_color_for_status,
+                format_duration=format_duration,
+                **context
+            )
+        )
+    response.set_etag(etag)
+    return response
+
+
 @blueprint.route('/')
 def index():
-    task_database.request()
-    task_database.init()
-    task_registry.add_all_tasks()
-    jobs = task_database.get_all(
-        'select id, status, job_name, task_id, task_wiki, started_at, ended_at from jobs order by `started_at` desc limit 20;'
-    )
-    tasks = task_database.get_all(
-        '''
-    select
-    id, name, approved,
-    exists(select id from task_trials where task_id = tasks.id and closed != 1) as in_trial
-    from tasks
-    order by `id`
-    '''
-    )
-    task_database.close()
-
-    return render_template(
-        'index.html',
-        jobs=jobs,
-        tasks=map(map_task, tasks),
-        get_badge_color_for_status=get_badge_color_for_status,
-        format_duration=format_duration,
-    )
+    data, etag = dashboard_data.get_index()
+    return render_cached(etag, 'index.html', jobs=data['jobs'], tasks=data['tasks'])
 
 
 @blueprint.route('/jobs/wiki/<wiki>')
 def jobs_per_wiki(wiki):
-    task_database.request()
-    task_database.init()
-    task_registry.add_all_tasks()
-    jobs = task_database.get_all(
-        'select id, status, job_name, task_id, task_wiki, started_at, ended_at from jobs where task_wiki = %s order by `started_at` desc limit 20',
-        (wiki,),
-    )
-    task_database.close()
-
-    return render_template(
-        'per_wiki.html',
-        wiki=wiki,
-        jobs=jobs,
-        get_badge_color_for_status=get_badge_color_for_status,
-        format_duration=format_duration,
-    )
+    data, etag = dashboard_data.get_jobs_per_wiki(wiki)
+    return render_cached(etag, 'per_wiki.html', wiki=data['wiki'], jobs=data['jobs'])
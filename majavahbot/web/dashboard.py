@@ -0,0 +1,119 @@
+from majavahbot.api.database import task_database
+from majavahbot.api.utils import TtlCache, get_revision
+from majavahbot.tasks import task_registry
+from hashlib import sha1
+import threading
+import traceback
+
+# monitors load the dashboard every minute, so this keeps most of those off the database
+DASHBOARD_CACHE_SECONDS = 30
+
+JOBS_QUERY = '''
+select id, status, job_name, task_id, task_wiki, started_at, ended_at
+from jobs
+order by `started_at` desc
+limit 20
+'''
+
+JOBS_PER_WIKI_QUERY = '''
+select id, status, job_name, task_id, task_wiki, started_at, ended_at
+from jobs
+where task_wiki = %s
+order by `started_at` desc
+limit 20
+'''
+
+TASKS_QUERY = '''
+select
+id, name, approved,
+exists(select id from task_trials where task_id = tasks.id and closed != 1) as in_trial
+from tasks
+order by `id`
+'''
+
+
+def map_task(db_row):
+    registry_task = task_registry.get_task_by_number(db_row[0])
+    return {
+        'number': db_row[0],
+        'name': db_row[1],
+        'is_continuous': registry_task.is_continuous,
+        'site': registry_task.site,
+        'family': registry_task.family,
+        'approved': db_row[2] == 1,
+        'trial': db_row[3] == 1,
+    }
+
+
+class DashboardData:
+    '''
+    Data shown on the dashboard. The schema and the list of tasks are set up once in init()
+    when the app starts, or on the first request if that failed. Query results are cached for
+    a short while together with an ETag, so that unchanged pages can be answered with 304 Not
+    Modified.
+    '''
+
+    def __init__(self, ttl=DASHBOARD_CACHE_SECONDS):
+        # key => (data, etag)
+        self.cache = TtlCache(ttl, max_size=100)
+        self.revision = ''
+        self.initialized = False
+        self.lock = threading.Lock()
+
+    def init(self):
+        '''Sets up the schema, the tasks and build info unless already done, raises on failure'''
+        with self.lock:
+            if self.initialized:
+                return
+            task_database.init()
+            task_registry.add_all_tasks()
+            self.revision = get_revision()
+            self.initialized = True
+
+    def try_init(self) -> bool:
+        '''Like init(), but only prints the error, so that the app starts without a database'''
+        try:
+            self.init()
+            return True
+        except Exception:
+            traceback.print_exc()
+            return False
+
+    def get_etag(self, data) -> str:
+        # the revision is shown on every page, so a deployment changes all of them
+        return sha1((self.revision + repr(data)).encode('utf-8')).hexdigest()
+
+    def _load_index(self, key):
+        task_database.request()
+        try:
+            jobs = task_database.get_all(JOBS_QUERY)
+            tasks = [map_task(row) for row in task_database.get_all(TASKS_QUERY)]
+        finally:
+            task_database.close()
+
+        data = {'jobs': jobs, 'tasks': tasks}
+        return data, self.get_etag(data)
+
+    def _load_jobs_per_wiki(self, key):
+        wiki = key[1]
+        task_database.request()
+        try:
+            jobs = task_database.get_all(JOBS_PER_WIKI_QUERY, (wiki,))
+        finally:
+            task_database.close()
+
+        data = {'wiki': wiki, 'jobs': jobs}
+        return data, self.get_etag(data)
+
+    def get_index(self):
+        '''Returns (data, etag) of the latest jobs and all tasks'''
+        self.init()
+        return self.cache.get_or_load(('index',), self._load_index)
+
+    def get_jobs_per_wiki(self, wiki: str):
+        '''Returns (data, etag) of the latest jobs on a wiki'''
+        self.init()
+        return self.cache.get_or_load(('jobs', wiki), self._load_jobs_per_wiki)
+
+
+dashboard_data = DashboardData()
@@ -0,0 +1,15 @@
+from importlib.util import module_from_spec, spec_from_file_location
+from os import path
+import sys
+
+# majavahbot/config.py is not committed, use the example configuration if it does not exist
+try:
+    import majavahbot.config  # noqa: F401
+except ImportError:
+    spec = spec_from_file_location(
+        'majavahbot.config',
+        path.join(path.dirname(__file__), '..', 'majavahbot', 'config.example.py'),
+    )
+    config = module_from_spec(spec)
+    spec.loader.exec_module(config)
+    sys.modules['majavahbot.config'] = config
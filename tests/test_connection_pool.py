@@ -0,0 +1,109 @@
+from majavahbot.api.database import ConnectionPool, PoolExhaustedError
+import mysql.connector
+import pytest
+import threading
+import time
+
+
+class FakeConnection:
+    def __init__(self, number):
+        self.number = number
+        self.connected = True
+        self.pings = 0
+        self.rollbacks = 0
+        self.rollback_fails = False
+
+    def is_connected(self):
+        self.pings += 1
+        return self.connected
+
+    def rollback(self):
+        if self.rollback_fails:
+            raise mysql.connector.Error('Unread result found')
+        self.rollbacks += 1
+
+    def disconnect(self):
+        self.connected = False
+
+
+class FakePool(ConnectionPool):
+    def __init__(self, **kwargs):
+        super().__init__('localhost', 3306, [], 'test', **kwargs)
+        self.connections = []
+
+    def _connect(self):
+        connection = FakeConnection(len(self.connections))
+        self.connections.append(connection)
+        return connection
+
+
+def test_reuses_recent_connections_without_pinging():
+    pool = FakePool()
+    connection = pool.checkout()
+    pool.checkin(connection)
+
+    assert pool.checkout() is connection
+    assert connection.pings == 0
+    assert pool.get_metrics()['created'] == 1
+    assert pool.get_metrics()['reused'] == 1
+
+
+def test_pings_connections_idle_for_a_while():
+    pool = FakePool(health_check_idle_seconds=0)
+    connection = pool.checkout()
+    pool.checkin(connection)
+    time.sleep(0.01)
+
+    assert pool.checkout() is connection
+    assert connection.pings == 1
+
+
+def test_replaces_dead_connections():
+    pool = FakePool(health_check_idle_seconds=0)
+    connection = pool.checkout()
+    pool.checkin(connection)
+    connection.connected = False
+    time.sleep(0.01)
+
+    new_connection = pool.checkout()
+    assert new_connection is not connection
+    assert pool.get_metrics()['discarded'] == 1
+    assert pool.get_metrics()['in_use'] == 1
+
+
+def test_failed_connections_are_rolled_back_or_discarded():
+    pool = FakePool()
+    connection = pool.checkout()
+    pool.checkin(connection, failed=True)
+    assert connection.rollbacks == 1
+    assert pool.get_metrics()['idle'] == 1
+
+    connection = pool.checkout()
+    connection.rollback_fails = True
+    pool.checkin(connection, failed=True)
+    assert not connection.connected
+    assert pool.get_metrics()['idle'] == 0
+    assert pool.size() == 0
+
+
+def test_evicts_old_idle_connections():
+    pool = FakePool(max_idle_seconds=0)
+    connection = pool.checkout()
+    pool.checkin(connection)
+    time.sleep(0.01)
+
+    pool.evict_idle()
+    assert not connection.connected
+    assert pool.size() == 0
+
+
+def test_waits_for_a_free_connection():
+    pool = FakePool(max_size=1)
+    connection = pool.checkout()
+
+    with pytest.raises(PoolExhaustedError):
+        pool.checkout(timeout=0.01)
+
+    threading.Timer(0.05, pool.checkin, args=(connection,)).start()
+    assert pool.checkout(timeout=5) is connection
+    assert len(pool.connections) == 1
@@ -0,0 +1,73 @@
+from majavahbot.api.continuous import ContinuousRunner
+import threading
+import time
+
+
+class BlockingStream:
+    '''Yields the given events, then blocks like an idle EventStreams until closed'''
+
+    def __init__(self, events):
+        self.events = list(events)
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if len(self.events) > 0:
+            return self.events.pop(0)
+        self.closed.wait()
+        raise ConnectionError('stream closed')
+
+    def close(self):
+        self.closed.set()
+
+
+def run_in_thread(runner, stream, **kwargs):
+    thread = threading.Thread(
+        target=runner.run, args=(stream, lambda event: event['key']), kwargs=kwargs, daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def test_coalesces_events_per_key():
+    processed = []
+    runner = ContinuousRunner(processed.append, coalesce_seconds=0.1)
+    stream = BlockingStream([{'key': 'a'}, {'key': 'a'}, {'key': 'b'}, {'key': 'a'}])
+    thread = run_in_thread(runner, stream)
+
+    time.sleep(0.5)
+    runner.stop()
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert sorted(processed) == ['a', 'b']
+    assert runner.get_metrics()['coalesced'] == 2
+
+
+def test_stop_interrupts_blocked_reader():
+    runner = ContinuousRunner(lambda key: None, coalesce_seconds=0)
+    stream = BlockingStream([])
+    thread = run_in_thread(runner, stream)
+
+    time.sleep(0.1)
+    started = time.time()
+    runner.stop()
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert stream.closed.is_set()
+    assert time.time() - started < 1
+
+
+def test_should_process_filters_events():
+    processed = []
+    runner = ContinuousRunner(processed.append, coalesce_seconds=0)
+    stream = BlockingStream([{'key': 'a', 'bot': True}, {'key': 'b', 'bot': False}])
+    thread = run_in_thread(runner, stream, should_process=lambda event: not event['bot'])
+
+    time.sleep(0.3)
+    runner.stop()
+    thread.join(5)
+    assert processed == ['b']
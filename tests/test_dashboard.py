@@ -0,0 +1,64 @@
+from majavahbot.web import dashboard
+from majavahbot.web.dashboard import DashboardData
+import pytest
+
+
+class FakeTaskDatabase:
+    def __init__(self):
+        self.reachable = False
+        self.open = 0
+        self.inits = 0
+
+    def init(self):
+        if not self.reachable:
+            raise ConnectionError('database is not reachable')
+        self.inits += 1
+
+    def request(self):
+        self.open += 1
+
+    def close(self):
+        self.open -= 1
+
+    def get_all(self, sql, params=None):
+        assert self.open > 0, 'queried without a connection'
+        return []
+
+
+class FakeTaskRegistry:
+    def add_all_tasks(self):
+        pass
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeTaskDatabase()
+    monkeypatch.setattr(dashboard, 'task_database', database)
+    monkeypatch.setattr(dashboard, 'task_registry', FakeTaskRegistry())
+    monkeypatch.setattr(dashboard, 'get_revision', lambda: 'abc123')
+    return database
+
+
+def test_init_is_retried_on_first_request(database):
+    data = DashboardData()
+    assert not data.try_init()
+
+    with pytest.raises(ConnectionError):
+        data.get_index()
+
+    database.reachable = True
+    assert data.get_index()[0] == {'jobs': [], 'tasks': []}
+    assert data.revision == 'abc123'
+
+    data.get_jobs_per_wiki('enwiki')
+    assert database.inits == 1
+
+
+def test_loaders_release_their_connections(database):
+    database.reachable = True
+    data = DashboardData()
+    assert data.try_init()
+
+    assert data.get_jobs_per_wiki('enwiki')[0] == {'wiki': 'enwiki', 'jobs': []}
+    data.get_index()
+    assert database.open == 0
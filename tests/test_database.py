@@ -0,0 +1,107 @@
+from majavahbot.api.database import BaseDatabase, ConnectionPool, ReplicaDatabase
+import mysql.connector
+import pytest
+
+
+class FakeCursor:
+    def __init__(self, connection, buffered):
+        self.connection = connection
+        self.buffered = buffered
+        self.rows = []
+
+    def execute(self, statement, values=()):
+        if 'fail' in statement:
+            raise mysql.connector.Error('query failed')
+        self.connection.statements.append((statement, values))
+        self.rows = [(value,) for value in values]
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if len(rows) > 0 else None
+
+    def close(self):
+        if not self.buffered and len(self.rows) > 0:
+            raise mysql.connector.InternalError('Unread result found')
+
+
+class FakeConnection:
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self, buffered=False, prepared=False):
+        return FakeCursor(self, buffered)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def is_connected(self):
+        return True
+
+    def disconnect(self):
+        pass
+
+
+class FakePool(ConnectionPool):
+    def __init__(self):
+        super().__init__('localhost', 3306, [], 'test')
+        self.connection = FakeConnection()
+
+    def _connect(self):
+        return self.connection
+
+
+class FakeDatabase(ReplicaDatabase):
+    def __init__(self):
+        BaseDatabase.__init__(self, 'localhost', 3306, [], 'test')
+        self.pool = FakePool()
+
+
+def test_get_all_in_chunks():
+    database = FakeDatabase()
+    keys = list(range(12)) + [3, 4]
+    rows = list(database.get_all_in_chunks('select x where x in (%s)', keys, chunk_size=5))
+
+    assert [row[0] for row in rows] == list(range(12))
+    statements = database.pool.connection.statements
+    assert [len(values) for statement, values in statements] == [5, 5, 2]
+    # full chunks share a statement
+    assert statements[0][0] == statements[1][0] == 'select x where x in (%s,%s,%s,%s,%s)'
+    assert database.pool.get_metrics()['idle'] == 1
+
+
+def test_get_all_in_chunks_closed_early():
+    database = FakeDatabase()
+    rows = database.get_all_in_chunks('select x where x in (%s)', range(10), chunk_size=5)
+    assert next(rows) == (0,)
+    rows.close()
+
+    assert database.pool.connection.rollbacks == 0
+    assert database.pool.connection.commits == 1
+    assert database.pool.get_metrics()['in_use'] == 0
+
+
+def test_failed_query_rolls_back_connection():
+    database = FakeDatabase()
+    assert database.get_one('select 1 where x = %s', (1,)) == (1,)
+    assert database.pool.connection.rollbacks == 0
+
+    with pytest.raises(mysql.connector.Error):
+        database.get_all('fail', ())
+    assert database.pool.connection.rollbacks == 1
+    assert database.pool.get_metrics()['in_use'] == 0
+
+    # the failure is not remembered for later queries
+    database.run('update x set y = %s', (1,))
+    assert database.pool.connection.rollbacks == 1
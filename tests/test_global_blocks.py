@@ -0,0 +1,117 @@
+from majavahbot.api.global_blocks import (
+    GLOBAL_BLOCK_LOG_QUERY,
+    GLOBAL_BLOCKS_QUERY,
+    GlobalBlock,
+    GlobalBlockIndex,
+    IntervalIndex,
+)
+import ipaddress
+import random
+
+
+def block(address, expiry='infinity'):
+    return GlobalBlock(address, 'Steward', '20200101000000', expiry)
+
+
+def row(address, expiry='infinity'):
+    return (
+        address.encode('utf-8'),
+        b'Steward',
+        b'20200101000000',
+        expiry.encode('utf-8'),
+    )
+
+
+class FakeReplica:
+    def __init__(self, blocks):
+        # address => row
+        self.blocks = {row(address)[0]: row(address) for address in blocks}
+        self.changed = []
+
+    def get_all(self, sql, params=None):
+        if sql == GLOBAL_BLOCKS_QUERY:
+            return list(self.blocks.values())
+        if sql == GLOBAL_BLOCK_LOG_QUERY:
+            return [(address.encode('utf-8'),) for address in self.changed]
+        raise AssertionError('unexpected query')
+
+    def get_all_in_chunks(self, sql, values):
+        for value in values:
+            if value.encode('utf-8') in self.blocks:
+                yield self.blocks[value.encode('utf-8')]
+
+
+def find(index, address):
+    network = ipaddress.ip_network(address, strict=False)
+    blocks = index.find(int(network.network_address), int(network.broadcast_address))
+    return [block.address for block in blocks]
+
+
+def test_interval_index_find():
+    index = IntervalIndex(
+        [block('10.0.0.0/8'), block('10.1.0.0/16'), block('10.1.2.3'), block('10.2.0.0/16')]
+    )
+    assert find(index, '10.1.2.3') == ['10.1.2.3', '10.1.0.0/16', '10.0.0.0/8']
+    assert find(index, '10.1.5.0/24') == ['10.1.0.0/16', '10.0.0.0/8']
+    assert find(index, '10.3.0.1') == ['10.0.0.0/8']
+    assert find(index, '10.0.0.0/7') == []
+    assert find(index, '9.255.255.255') == []
+    assert find(IntervalIndex([]), '10.0.0.1') == []
+
+
+def test_interval_index_matches_linear_search():
+    generator = random.Random(0)
+    networks = set()
+    for _ in range(200):
+        prefix = generator.randint(8, 32)
+        address = ipaddress.ip_address(generator.randint(0, 2 ** 16 - 1) << 16)
+        networks.add(ipaddress.ip_network('%s/%s' % (address, prefix), strict=False))
+    blocks = [block(str(network)) for network in networks]
+    index = IntervalIndex(blocks)
+
+    for _ in range(500):
+        address = ipaddress.ip_address(generator.randint(0, 2 ** 32 - 1))
+        expected = sorted(
+            (b for b in blocks if b.start <= int(address) <= b.end),
+            key=(lambda b: b.end - b.start),
+        )
+        assert find(index, str(address)) == [b.address for b in expected]
+
+
+def test_global_block_index_get_block():
+    index = GlobalBlockIndex(FakeReplica(['10.0.0.0/16', '10.0.1.1', '2001:db8::/32']))
+    index.load()
+    assert len(index) == 3
+
+    assert index.get_block('10.0.1.1').address == '10.0.1.1'
+    assert index.get_block('10.0.2.0/24').address == '10.0.0.0/16'
+    assert [b.address for b in index.get_blocks('10.0.1.1')] == ['10.0.1.1', '10.0.0.0/16']
+    assert index.get_block('2001:db8::1').address == '2001:db8::/32'
+    assert index.get_block('10.1.0.1') is None
+
+
+def test_global_block_index_ignores_expired_blocks():
+    index = GlobalBlockIndex(FakeReplica([]))
+    index.blocks = {
+        '10.0.0.1': block('10.0.0.1', expiry='20000101000000'),
+        '10.0.0.0/24': block('10.0.0.0/24'),
+    }
+    index._build()
+    assert index.get_block('10.0.0.1').address == '10.0.0.0/24'
+
+
+def test_global_block_index_refresh():
+    replica = FakeReplica(['10.0.0.1', '10.0.0.2'])
+    index = GlobalBlockIndex(replica)
+    index.refresh()
+    assert index.get_block('10.0.0.1') is not None
+
+    # 10.0.0.1 was unblocked and 10.0.0.3 blocked since the last refresh
+    del replica.blocks[b'10.0.0.1']
+    replica.blocks[b'10.0.0.3'] = row('10.0.0.3')
+    replica.changed = ['10.0.0.1', '10.0.0.3']
+    index.refresh()
+
+    assert index.get_block('10.0.0.1') is None
+    assert index.get_block('10.0.0.2') is not None
+    assert index.get_block('10.0.0.3') is not None
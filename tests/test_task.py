@@ -0,0 +1,81 @@
+from majavahbot.tasks import Task
+import threading
+
+
+class FakePage:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeApi:
+    def __init__(self, contents, revision_id=1):
+        self.contents = contents
+        self.revision_id = revision_id
+
+    def get_latest_revision_id(self, page_name):
+        return self.revision_id
+
+    def get_page(self, page_name, revision_id=None):
+        return FakePage(self.contents)
+
+
+class RegexTask(Task):
+    regex_configuration_keys = ['title_regex', 'header_regexes']
+
+    def __init__(self, api):
+        super().__init__(1, 'Regex task', 'en', 'wikipedia')
+        self.api = api
+        self.register_task_configuration('User:Example/Configuration')
+
+    def get_mediawiki_api(self):
+        return self.api
+
+
+def get_in_thread(function, timeout=5):
+    '''Calls function in another thread so that a deadlock fails the test instead of hanging'''
+    results = []
+    thread = threading.Thread(target=lambda: results.append(function()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'call did not return, deadlocked?'
+    return results[0]
+
+
+def test_load_configuration_with_regex_keys():
+    task = RegexTask(FakeApi('{"title_regex": "^Foo", "header_regexes": ["a+", "b+"]}'))
+
+    title_regex = get_in_thread(lambda: task.get_task_configuration_regex('title_regex'))
+    assert title_regex.match('Foobar')
+    assert [regex.pattern for regex in task.get_task_configuration_regex('header_regexes')] == [
+        'a+',
+        'b+',
+    ]
+
+
+def test_regex_recompiled_after_reload():
+    api = FakeApi('{"title_regex": "^Foo"}')
+    task = RegexTask(api)
+    assert get_in_thread(lambda: task.get_task_configuration_regex('title_regex')).match('Foo')
+
+    api.contents = '{\n// comment\n"title_regex": "^Bar"}'
+    api.revision_id = 2
+    task.task_configuration_last_checked = None
+
+    regex = get_in_thread(lambda: task.get_task_configuration_regex('title_regex'))
+    assert regex.match('Bar') and not regex.match('Foo')
+
+
+def test_configuration_not_reloaded_for_same_revision():
+    api = FakeApi('{"title_regex": "^Foo"}')
+    task = RegexTask(api)
+    task.get_task_configuration()
+
+    api.contents = '{"title_regex": "^Bar"}'
+    task.task_configuration_last_checked = None
+    assert task.get_task_configuration('title_regex') == '^Foo'
+
+
+def test_nested_configuration_keys():
+    task = RegexTask(FakeApi('{"archive_delays": {"a": 1}, "x.y": 2}'))
+    assert task.get_task_configuration('archive_delays.a') == 1
+    assert task.get_task_configuration('x.y') == 2
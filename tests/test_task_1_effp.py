@@ -0,0 +1,63 @@
+from majavahbot.tasks.task_1_effp import EffpTask, split_sections
+import re
+
+SECTION_HEADER = re.compile(r'^==\s*([^=]+?)\s*==$', flags=re.MULTILINE)
+
+
+def test_split_sections():
+    header, sections = split_sections('Intro\n== Foo ==\nfoo\n== Bar ==\nbar', SECTION_HEADER)
+    assert header == 'Intro\n'
+    assert sections == (('Foo', '== Foo ==\nfoo\n'), ('Bar', '== Bar ==\nbar\n'))
+
+
+def test_split_sections_without_sections():
+    assert split_sections('Just text', SECTION_HEADER) == ('\nJust text', ())
+
+
+def test_split_sections_cache_is_shared_by_text():
+    split_sections.cache_clear()
+    split_sections('a\n== A ==\n', SECTION_HEADER)
+    split_sections('a\n== A ==\n', SECTION_HEADER)
+    assert split_sections.cache_info().hits == 1
+
+
+class FakeApi:
+    def get_latest_revision_id(self, page_name):
+        return 1
+
+    def get_page(self, page_name, revision_id=None):
+        return FakePage()
+
+
+class FakePage:
+    text = '{}'
+
+
+class FakeEffpTask(EffpTask):
+    def __init__(self):
+        super().__init__(1, 'EFFP', 'en', 'wikipedia')
+        self.api = FakeApi()
+        self.blocked = {}
+
+    def get_mediawiki_api(self):
+        return self.api
+
+    def get_block_status(self, user_name, api):
+        return user_name, self.blocked.get(user_name)
+
+
+def test_cached_section_is_checked_for_blocks():
+    task = FakeEffpTask()
+    section = '== Foo ==\nreport\n'
+
+    assert task.process_open_section('Foo', section, 'hash', False, True, task.api) == (
+        section,
+        [],
+    )
+
+    # the block cache expires before the section cache
+    task.blocked['Foo'] = 'Admin'
+    task.block_cache.clear()
+    text, summaries = task.process_open_section('Foo', section, 'hash', False, True, task.api)
+    assert text == section + ':{{EFFP|b|Foo|Admin|bot=1}} ~~~~\n'
+    assert summaries == ['Notify if user is blocked. (task 1d)']
@@ -0,0 +1,76 @@
+from majavahbot.tasks.task_3_bot_status import BotStatusTask, get_operators
+import majavahbot.tasks.task_3_bot_status as task_3
+
+
+class FakeQueryGenerator:
+    def __init__(self, site=None, **parameters):
+        self.request = parameters
+
+
+class FakeApi:
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get_site(self):
+        return None
+
+    def submit_throttled(self, request, action=None):
+        self.requests.append(request)
+        return self.responses.pop(0)
+
+
+def user_page(title, text):
+    return {'title': title, 'revisions': [{'revid': 1, 'slots': {'main': {'*': text}}}]}
+
+
+def test_get_operators():
+    assert get_operators('{{Bot|Foo}} {{bot2|Bar|Baz}} {{Other|Qux}}') == ['Foo', 'Bar', 'Baz']
+
+
+def test_user_page_revisions_follow_continuation(monkeypatch):
+    monkeypatch.setattr(task_3, 'QueryGenerator', FakeQueryGenerator)
+    api = FakeApi(
+        [
+            {
+                'continue': {'rvcontinue': '2|123', 'continue': '||'},
+                'query': {
+                    'pages': {
+                        '1': user_page('User:FooBot', '{{Bot|Foo}}'),
+                        # content did not fit in the first response
+                        '2': {'title': 'User:BarBot'},
+                        '-1': {'title': 'User:MissingBot', 'missing': ''},
+                    }
+                },
+            },
+            {'query': {'pages': {'2': user_page('User:BarBot', '{{Bot|Bar}}')}}},
+        ]
+    )
+
+    task = BotStatusTask(3, 'Bot status', 'en', 'wikipedia')
+    monkeypatch.setattr(task, 'get_mediawiki_api', lambda: api)
+
+    operators = task.get_operators_batch(['FooBot', 'BarBot', 'MissingBot'])
+    assert operators == {'User:FooBot': ['Foo'], 'User:BarBot': ['Bar']}
+    assert len(api.requests) == 2
+    assert api.requests[1]['rvcontinue'] == '2|123'
+
+
+def test_users_with_logged_actions_follow_continuation(monkeypatch):
+    monkeypatch.setattr(task_3, 'QueryGenerator', FakeQueryGenerator)
+    api = FakeApi(
+        [
+            {
+                'continue': {'rccontinue': '20200101000000|2', 'continue': '-||'},
+                'query': {'recentchanges': [{'user': 'FooBot'}, {'userhidden': ''}]},
+            },
+            {'query': {'recentchanges': [{'user': 'BarBot'}, {'user': 'FooBot'}]}},
+        ]
+    )
+
+    task = BotStatusTask(3, 'Bot status', 'en', 'wikipedia')
+    monkeypatch.setattr(task, 'get_mediawiki_api', lambda: api)
+
+    assert task.get_users_with_logged_actions('20200101000000') == {'FooBot', 'BarBot'}
+    assert len(api.requests) == 2
+    assert api.requests[1]['rccontinue'] == '20200101000000|2'
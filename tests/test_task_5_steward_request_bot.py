@@ -0,0 +1,38 @@
+from majavahbot.tasks.task_5_steward_request_bot import (
+    get_section_fingerprint,
+    is_lock_log_entry,
+    is_range_too_broad,
+    normalize_ip_or_range,
+)
+
+
+def test_is_range_too_broad():
+    assert is_range_too_broad(normalize_ip_or_range('10.0.0.0/8'))
+    assert is_range_too_broad(normalize_ip_or_range('10.1.0.0/16'))
+    assert not is_range_too_broad(normalize_ip_or_range('10.1.2.0/17'))
+    assert not is_range_too_broad(normalize_ip_or_range('10.1.2.3'))
+    assert is_range_too_broad(normalize_ip_or_range('2001:db8::/19'))
+    assert not is_range_too_broad(normalize_ip_or_range('2001:db8::/32'))
+
+
+def test_normalize_ip_or_range():
+    assert normalize_ip_or_range('Example') is None
+    assert normalize_ip_or_range('10.1.2.3/16') == normalize_ip_or_range('10.1.0.0/16')
+
+
+def test_is_lock_log_entry():
+    assert is_lock_log_entry('lock', '')
+    assert not is_lock_log_entry('unlock', '')
+    assert is_lock_log_entry('setstatus', 'a:2:{s:9:"4::added";a:1:{i:0;s:6:"locked";}}')
+    assert not is_lock_log_entry('setstatus', 'a:2:{s:9:"4::added";a:0:{}s:11:"5::removed"}')
+    assert is_lock_log_entry('setstatus', 'locked\n(none)')
+    assert not is_lock_log_entry('setstatus', '(none)\nlocked')
+
+
+def test_section_fingerprint_ignores_formatting_and_order():
+    assert get_section_fingerprint('=== Global lock for  Foo ===', ['Foo', 'Bar'], []) == (
+        get_section_fingerprint('===global lock for Foo===\n', ['Bar', 'Foo'], [])
+    )
+    assert get_section_fingerprint('Foo', ['Foo'], []) != get_section_fingerprint(
+        'Foo', ['Bar'], []
+    )
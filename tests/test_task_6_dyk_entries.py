@@ -0,0 +1,88 @@
+from majavahbot.tasks.task_6_dyk_entries import (
+    MOVED_FROM_COMMENTS_QUERY,
+    MOVED_FROM_QUERY,
+    REDIRECTS_QUERY,
+    DykEntryTalkTask,
+    expand_ship_templates,
+)
+import re
+
+# the replacements expand_ship_templates() does in a single pass, applied one by one
+NAME_REPLACEMENTS = {
+    re.compile(r'{{(?:ship|warship)\|([a-zA-Z0-9\- ]+)\|([a-zA-Z0-9\- ]+)}}'): r'[[\g<1> \g<2>]]',
+    re.compile(
+        r'{{(?:ship|warship)\|([a-zA-Z0-9\- ]+)\|([a-zA-Z0-9\- ]+)\|([a-zA-Z0-9\- ]+)}}'
+    ): r'[[\g<1> \g<2> (\g<3>)]]',
+    re.compile(r'{{sclass\|([a-zA-Z0-9\- ]+)\|([a-zA-Z0-9\- ]+)}}'): r'[[\g<1> class \g<2>]]',
+}
+
+for name in ['hms', 'hmas', 'hmt', 'sms', 'ss', 'usat', 'uss']:
+    NAME_REPLACEMENTS[re.compile(r'{{' + name + r'\|([a-zA-Z0-9\- ]+)}}')] = (
+        r'[[' + name + r' \g<1>]]'
+    )
+    NAME_REPLACEMENTS[
+        re.compile(r'{{' + name + r'\|([a-zA-Z0-9\- ]+)\|([a-zA-Z0-9\- ]+)(\|[0-9]+)?}}')
+    ] = (r'[[' + name + r' \g<1> (\g<2>)]]')
+
+
+def apply_name_replacements(row: str) -> str:
+    for regex in NAME_REPLACEMENTS:
+        row = regex.sub(NAME_REPLACEMENTS[regex], row)
+    return row
+
+
+class FakeReplica:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_all_in_chunks(self, sql, keys):
+        keys = set(keys)
+        return [row for row in self.rows.get(sql, []) if row[0].decode('utf-8') in keys]
+
+
+def test_page_aliases():
+    replica = FakeReplica(
+        {
+            MOVED_FROM_QUERY: [(b'Foo_bar', b'Old_foo')],
+            REDIRECTS_QUERY: [(b'Foo_bar', b'Foo_redirect'), (b'Unrelated', b'X')],
+            MOVED_FROM_COMMENTS_QUERY: [
+                # moved before log entries had the page ID
+                (b'Foo_bar', b'Example moved page [[Ancient foo]] to [[Old foo]]'),
+                # same move as in the log
+                (b'Foo_bar', b'Example moved page [[Old foo]] to [[Foo bar]]: better title'),
+                (b'Baz', b'Example moved [[Old baz]] to [[Baz]]'),
+                (b'Baz', b'not a move: moved [[A]] to [[B]]'),
+            ],
+        }
+    )
+
+    task = DykEntryTalkTask(6, 'DYK entry filler', 'en', 'wikipedia')
+    assert task.get_page_aliases(replica, ['Foo_bar', 'Baz']) == {
+        'Foo_bar': ['foo bar', 'old foo', 'foo redirect', 'ancient foo'],
+        'Baz': ['baz', 'old baz'],
+    }
+
+
+def test_expand_ship_templates():
+    # archive rows are lowercased before the templates are expanded
+    rows = [
+        "* ... that '''{{hms|victory}}''' was launched in 1765?",
+        "* ... that '''{{uss|enterprise|cv-6}}''' and '''{{ss|edmund fitzgerald}}''' sank?",
+        "* ... that ''{{hmas|sydney|d48|1934}}'' was a cruiser?",
+        "* ... that '''''{{sms|emden}}''''' raided shipping?",
+        "* ... that '''{{ship|german submarine|u-9}}''' and {{warship|hms|dreadnought|1906}}?",
+        "* ... that the '''{{sclass|iowa|battleship}}''' had four ships?",
+        "* ... that {{usat|meigs}} and {{hmt|olympic|1911}} were troopships?",
+        # forms that are left alone
+        "* ... that '''{{ship|victory}}''' and {{hms|victory|1765|x}} stay unchanged?",
+        "* ... that {{sclass|iowa|battleship|1}} and {{hms|victory (1765)}} stay unchanged?",
+        "* ... that {{hms|{{!}}}} and {{convert|1|km}} are not ship templates?",
+        "* ... that '''[[victory]]''' has no templates?",
+        '',
+    ]
+    for row in rows:
+        assert expand_ship_templates(row) == apply_name_replacements(row), row
+
+    assert expand_ship_templates("'''{{uss|enterprise|cv-6}}'''") == (
+        "'''[[uss enterprise (cv-6)]]'''"
+    )
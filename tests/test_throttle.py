@@ -0,0 +1,104 @@
+from majavahbot.api.throttle import (
+    THROTTLE_MIN_RATE_DIVISOR,
+    Throttle,
+    TokenBucket,
+    get_error_code,
+    get_retry_after,
+)
+import pytest
+import time
+
+
+class FakeApiError(Exception):
+    def __init__(self, code, other=None, response=None):
+        super().__init__(code)
+        self.code = code
+        self.other = other
+        self.response = response
+
+
+class FakeResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class WrappedError(Exception):
+    def __init__(self, reason):
+        super().__init__(str(reason))
+        self.reason = reason
+
+
+def test_bucket_allows_burst_then_waits():
+    bucket = TokenBucket(20, 2)
+    started = time.time()
+    for _ in range(2):
+        bucket.acquire()
+    assert time.time() - started < 0.04
+
+    bucket.acquire()
+    assert time.time() - started >= 0.04
+    assert bucket.get_metrics()['acquired'] == 3
+
+
+def test_backoff_pauses_and_halves_rate():
+    bucket = TokenBucket(100, 1)
+    bucket.backoff(0.1)
+    metrics = bucket.get_metrics()
+    assert metrics['rate'] == 50
+    assert metrics['paused_for'] > 0
+    assert metrics['backoffs'] == 1
+
+    started = time.time()
+    bucket.acquire()
+    assert time.time() - started >= 0.09
+
+
+def test_rate_has_a_minimum_and_recovers():
+    bucket = TokenBucket(80, 1)
+    for _ in range(10):
+        bucket.backoff(0)
+    assert bucket.rate == 80 / THROTTLE_MIN_RATE_DIVISOR
+
+    for _ in range(THROTTLE_MIN_RATE_DIVISOR * 2):
+        bucket.report_success()
+    assert bucket.rate == 80
+
+
+def test_error_code_and_retry_after():
+    assert get_error_code(FakeApiError('maxlag')) == 'maxlag'
+    assert get_error_code(WrappedError(FakeApiError('ratelimited'))) == 'ratelimited'
+    assert get_error_code(ValueError()) is None
+
+    assert get_retry_after(FakeApiError('maxlag', other={'lag': '3.5'})) == 3
+    assert get_retry_after(FakeApiError('x', response=FakeResponse({'Retry-After': '7'}))) == 7
+    invalid = FakeApiError('x', response=FakeResponse({'Retry-After': 'soon'}))
+    assert get_retry_after(invalid) is None
+    assert get_retry_after(WrappedError(FakeApiError('maxlag', other={'lag': 2}))) == 2
+
+
+def test_report_error_only_backs_off_for_throttling_errors():
+    throttle = Throttle(rates={'read': (100, 1)})
+    assert not throttle.report_error('enwiki', 'read', FakeApiError('badtitle'))
+    assert throttle.get_bucket('enwiki', 'read').backoff_count == 0
+
+    assert throttle.report_error('enwiki', 'read', FakeApiError('maxlag', other={'lag': 0}))
+    assert throttle.get_bucket('enwiki', 'read').backoff_count == 1
+    # buckets are per wiki
+    assert throttle.get_bucket('fiwiki', 'read').backoff_count == 0
+
+
+def test_call_reports_outcome():
+    throttle = Throttle(rates={'read': (100, 5)})
+    assert throttle.call('enwiki', 'read', lambda: 'result') == 'result'
+
+    def fail():
+        raise FakeApiError('ratelimited', response=FakeResponse({'Retry-After': '0'}))
+
+    with pytest.raises(FakeApiError):
+        throttle.call('enwiki', 'read', fail)
+
+    metrics = throttle.get_metrics()
+    assert len(metrics) == 1
+    assert metrics[0]['wiki'] == 'enwiki'
+    assert metrics[0]['acquired'] == 2
+    assert metrics[0]['backoffs'] == 1
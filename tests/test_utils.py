@@ -0,0 +1,64 @@
+from majavahbot.api import utils
+from majavahbot.api.utils import TtlCache
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def test_ttl_cache_loads_once(monkeypatch):
+    monkeypatch.setattr(utils, 'time', FakeTime())
+    cache = TtlCache(10)
+    loaded = []
+
+    def loader(key):
+        loaded.append(key)
+        return key.upper()
+
+    assert cache.get_or_load('a', loader) == 'A'
+    assert cache.get_or_load('a', loader) == 'A'
+    assert loaded == ['a']
+    assert cache.get_metrics()['hits'] == 1
+    assert cache.get_metrics()['misses'] == 1
+
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(utils, 'time', clock)
+    cache = TtlCache(10)
+    cache.get_or_load('a', lambda key: 1)
+
+    clock.now += 11
+    assert cache.get_or_load('a', lambda key: 2) == 2
+
+    clock.now += 11
+    cache.remove_expired()
+    assert len(cache) == 0
+
+
+def test_ttl_cache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(utils, 'time', FakeTime())
+    cache = TtlCache(10, max_size=2)
+    cache.get_or_load('a', lambda key: 1)
+    cache.get_or_load('b', lambda key: 2)
+    # 'a' was used more recently than 'b'
+    cache.get_or_load('a', lambda key: 3)
+    cache.get_or_load('c', lambda key: 4)
+
+    assert list(cache.entries.keys()) == ['a', 'c']
+    assert cache.get_metrics()['evictions'] == 1
+
+
+def test_ttl_cache_invalidate(monkeypatch):
+    monkeypatch.setattr(utils, 'time', FakeTime())
+    cache = TtlCache(10)
+    cache.get_or_load('a', lambda key: 1)
+    cache.invalidate('a')
+    assert cache.get_or_load('a', lambda key: 2) == 2
+
+    cache.clear()
+    assert len(cache) == 0
@@ -0,0 +1,135 @@
+from majavahbot.api.wikitext import parse_sections, parse_templates
+import mwparserfromhell
+import random
+
+NAMES = ['Status', 'Bot']
+
+PIECES = [
+    '{{status}}',
+    '{{ status |done}}',
+    '{{Bot|Someone}}',
+    '{{Other|{{Bot|Nested}}}}',
+    '{{Other|x=[[a|b]]}}',
+    '<!-- {{Bot|Hidden}} -->',
+    '<nowiki>{{Bot|no}}</nowiki>',
+    '<span>',
+    '</span>',
+    '<div>',
+    '</div>',
+    '[[Link]]',
+    '[[x',
+    ']]',
+    '{{Bot',
+    '{{Bot|',
+    '{{Other|',
+    '{{',
+    '}}',
+    '|',
+    'text ',
+    '\n',
+    '\n=== Heading %d ===\n',
+    '\n== Level 2 %d ==\n',
+    '\n{|\n| cell\n|}\n',
+    '<ref>{{Bot|r}}</ref>',
+    '{{Bot|x\n=== In template ===\n}}',
+]
+
+
+def matching(templates):
+    return [template for template in templates if template.name.matches(NAMES)]
+
+
+def assert_same_templates(text):
+    full = mwparserfromhell.parse(text)
+    partial = parse_templates(text, NAMES)
+    assert [str(t) for t in matching(partial.filter_templates())] == [
+        str(t) for t in matching(full.filter_templates())
+    ]
+
+    for template in matching(full.filter_templates()):
+        template.add('checked', 'yes')
+    for template in matching(partial.filter_templates()):
+        template.add('checked', 'yes')
+    assert str(partial) == str(full)
+
+
+def assert_same_sections(text):
+    full = mwparserfromhell.parse(text)
+    partial = parse_sections(text, 3, NAMES)
+    full_sections = [s for s in full.get_sections(levels=[3]) if matching(s.filter_templates())]
+    partial_sections = [s for s in partial.get_sections() if matching(s.filter_templates())]
+    assert [str(s) for s in partial_sections] == [str(s) for s in full_sections]
+
+    for section in full_sections:
+        section.append('note\n')
+    for section in partial_sections:
+        section.append('note\n')
+    assert str(partial) == str(full)
+
+
+def test_parse_templates_only_parses_candidates():
+    text = 'a {{Other|b}} {{status|open}} {{Bot|Foo}}'
+    result = parse_templates(text, NAMES)
+    assert [str(t) for t in result.filter_templates()] == ['{{status|open}}', '{{Bot|Foo}}']
+
+    result.filter_templates()[0].add(1, 'done')
+    assert str(result) == 'a {{Other|b}} {{status|done}} {{Bot|Foo}}'
+
+
+def test_parse_templates_skips_comments():
+    assert parse_templates('<!-- {{Bot|Foo}} -->', NAMES).filter_templates() == []
+
+
+def test_parse_templates_falls_back_on_arguments():
+    result = parse_templates('{{{1}}} {{Bot|Foo}}', NAMES)
+    assert result.spans == [(0, 19)]
+
+
+def test_parse_templates_falls_back_on_unclosed_template():
+    # mwparserfromhell closes it with the stray braces at the end
+    assert_same_templates('{{Bot|\n</span>{{}}')
+
+
+def test_parse_templates_falls_back_on_tag_crossing_template_end():
+    # the tag takes the closing braces, so there is no template at all
+    assert_same_templates('x{{Bot|<span>}}{{Other|}}</span>')
+
+
+def test_parse_sections_only_parses_matching_sections():
+    text = '=== A ===\n{{Bot|Foo}}\n=== B ===\nnothing\n=== C ===\n{{status}}\n'
+    result = parse_sections(text, 3, NAMES)
+    assert [str(s) for s in result.get_sections()] == [
+        '=== A ===\n{{Bot|Foo}}\n',
+        '=== C ===\n{{status}}\n',
+    ]
+    assert_same_sections(text)
+
+
+def test_parse_sections_falls_back_on_heading_in_template():
+    text = '{{Bot|x\n=== In template ===\n}}\n=== A ===\n{{Bot|Foo}}\n'
+    result = parse_sections(text, 3, NAMES)
+    assert result.spans == [(0, len(text))]
+    assert_same_sections(text)
+
+
+def test_parse_sections_falls_back_on_stray_closing_markup():
+    for text in [
+        '}}{{Bot\n=== A ===\n{{Bot|Foo}}\n',
+        '</span><span>\n=== A ===\n{{Bot|Foo}}\n',
+        '=== A ===\n{{Bot|Foo}}\n}}\n',
+        '</div>}}\n=== A ===\n|}{{Bot|[[\n</span>{{}}',
+    ]:
+        result = parse_sections(text, 3, NAMES)
+        assert result.spans == [(0, len(text))], text
+        assert_same_sections(text)
+
+
+def test_matches_full_parse():
+    generator = random.Random(0)
+    for _ in range(1000):
+        pieces = [generator.choice(PIECES) for _ in range(generator.randint(0, 20))]
+        text = ''.join(
+            piece % i if '%d' in piece else piece for i, piece in enumerate(pieces)
+        )
+        assert_same_templates(text)
+        assert_same_sections(text)